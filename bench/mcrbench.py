@@ -0,0 +1,148 @@
+# This file is part of NoCurve.
+#
+#    NoCurve is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    NoCurve is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with NoCurve.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Region loading benchmark.
+
+Each scenario runs in its own process and reports decoded chunks per second,
+uncompressed MB per second and the process peak RSS:
+
+  region : MCR.use_region in full (non lazy) mode
+  lazy   : per chunk decoding with the tags scanner
+  nbt    : per chunk decoding as full NBT trees
+  baked  : per chunk reading from baked files (baked during a first pass)
+
+Usage: python mcrbench.py [options] <world directory>
+A synthetic world is generated first if the directory has no region files
+(see mcrgen.py options).
+"""
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import resource
+
+from time import time
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+
+import mcr
+import mcrgen
+
+SCENARIOS = ('region', 'lazy', 'nbt', 'baked')
+
+
+def _regions(region_dir):
+    for filename in sorted(glob.glob(os.path.join(region_dir, 'r.*.*.mcr'))):
+        _, rx, rz, _ = os.path.basename(filename).split('.')
+        yield int(rx), int(rz)
+
+def _read_all(m, region_dir):
+    count = size = 0
+    for rx, rz in _regions(region_dir):
+        region = m.use_region(rx, rz)
+        for idx in region.iter_chunks():
+            cx = (rx << 5) + (idx & 31)
+            cz = (rz << 5) + (idx >> 5)
+            _, n = m.read_level(region, cx, cz)
+            count += 1
+            size += n
+    return count, size
+
+def run_scenario(name, region_dir, tmpdir):
+    "Return (chunks count, uncompressed bytes, seconds)"
+
+    if name == 'region':
+        m = mcr.MCR(region_dir, lazy=False, cache_size=1 << 62)
+        t = time()
+        for rx, rz in _regions(region_dir):
+            m.use_region(rx, rz)
+        t = time() - t
+        stats = m.cache_stats
+        return stats['count'], stats['size'], t
+
+    if name == 'baked':
+        bake_root = os.path.join(tmpdir, 'baked')
+        _read_all(mcr.MCR(region_dir, bake_root=bake_root), region_dir)
+        m = mcr.MCR(region_dir, bake_root=bake_root)
+    else:
+        m = mcr.MCR(region_dir, full_nbt=(name == 'nbt'))
+
+    t = time()
+    count, size = _read_all(m, region_dir)
+    return count, size, time() - t
+
+def _child(name, region_dir, tmpdir, queue):
+    try:
+        count, size, t = run_scenario(name, region_dir, tmpdir)
+    except Exception, e:
+        queue.put((name, e))
+    else:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put((name, (count, size, t, rss)))
+
+def bench(region_dir, scenarios=SCENARIOS):
+    "Run scenarios and print results"
+
+    tmpdir = tempfile.mkdtemp(prefix='mcrbench')
+    try:
+        print "%-8s %8s %8s %12s %10s %10s" % ('scenario', 'chunks', 'time', 'chunks/s', 'MB/s', 'peak RSS')
+        for name in scenarios:
+            queue = Queue()
+            p = Process(target=_child, args=(name, region_dir, tmpdir, queue))
+            p.start()
+            name, result = queue.get()
+            p.join()
+
+            if isinstance(result, Exception):
+                print "%-8s failed: %s" % (name, result)
+                continue
+
+            count, size, t, rss = result
+            t = max(t, 1e-6)
+            # ru_maxrss is given in KiB on Linux
+            print "%-8s %8u %7.2fs %12.1f %10.1f %8.1fMB" % (name, count, t, count / t,
+                                                           size / t / (1 << 20), rss / 1024.)
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] <world directory>")
+    parser.add_option("-s", "--scenario", action="append", dest="scenarios",
+                      choices=list(SCENARIOS), help="scenario to run (default: all)")
+    parser.add_option("-r", "--regions", type="int", dest="regions", default=1,
+                      help="generated regions per side")
+    parser.add_option("-d", "--density", type="float", dest="density", default=1.0)
+    parser.add_option("-c", "--compression", type="choice", dest="compression",
+                      choices=['gzip', 'zlib'], default='zlib')
+    parser.add_option("-t", "--terrain", type="choice", dest="terrain",
+                      choices=list(mcrgen.TERRAINS), default='hills')
+
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("world directory required")
+
+    region_dir = os.path.join(args[0], 'region')
+    if not glob.glob(os.path.join(region_dir, 'r.*.*.mcr')):
+        n = mcrgen.generate(args[0], opts.regions, opts.density,
+                            1 if opts.compression == 'gzip' else 2, opts.terrain)
+        print "Generated %u chunks in '%s'" % (n, region_dir)
+
+    bench(region_dir, opts.scenarios or SCENARIOS)
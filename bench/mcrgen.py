@@ -0,0 +1,146 @@
+# This file is part of NoCurve.
+#
+#    NoCurve is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    NoCurve is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with NoCurve.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic region files generator.
+
+Writes worlds made of r.x.z.mcr files usable by MCR, with a configurable
+chunk density, compression method and terrain content:
+
+  flat   : stone, dirt and grass layers up to y=64
+  hills  : like flat with a sine based height map
+  random : random block ids (worst case for zlib)
+
+Usage: python mcrgen.py [options] <world directory>
+"""
+
+import os
+import sys
+import random
+
+from struct import pack
+from math import sin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+
+import mcr
+
+TERRAINS = ('flat', 'hills', 'random')
+
+## Minimal NBT writer
+
+def _name(name):
+    return pack('>H', len(name)) + name
+
+def _tag(tagtype, name, payload):
+    return chr(tagtype) + _name(name) + payload
+
+def _byte_array(name, data):
+    return _tag(7, name, pack('>i', len(data)) + data)
+
+def _empty_list(name):
+    return _tag(9, name, chr(10) + pack('>i', 0))
+
+## Terrain
+
+def column_height(terrain, x, z):
+    if terrain == 'hills':
+        return int(64 + 12 * sin(x / 23.) * sin(z / 17.))
+    return 64
+
+def chunk_blocks(terrain, cx, cz, rnd):
+    "Return Blocks and HeightMap arrays of a chunk (X.Z.Y order)"
+
+    if terrain == 'random':
+        blocks = ''.join(chr(rnd.randrange(1, 100)) for _ in xrange(32768))
+        return blocks, chr(127) * 256
+
+    columns = []
+    heights = bytearray(256)
+    for x in xrange(16):
+        for z in xrange(16):
+            h = column_height(terrain, (cx << 4) + x, (cz << 4) + z)
+            heights[z*16 + x] = h + 1
+            columns.append('\x07' + '\x01' * (h - 4) + '\x03' * 3 + '\x02' + '\x00' * (127 - h))
+    return ''.join(columns), str(heights)
+
+def chunk_nbt(terrain, cx, cz, rnd):
+    "Return uncompressed NBT data of a chunk"
+
+    blocks, heightmap = chunk_blocks(terrain, cx, cz, rnd)
+    level = ''.join([
+        _tag(3, 'xPos', pack('>i', cx)),
+        _tag(3, 'zPos', pack('>i', cz)),
+        _tag(4, 'LastUpdate', pack('>q', 0)),
+        _tag(1, 'TerrainPopulated', '\x01'),
+        _byte_array('Blocks', blocks),
+        _byte_array('Data', '\x00' * 16384),
+        _byte_array('SkyLight', '\xff' * 16384),
+        _byte_array('BlockLight', '\x00' * 16384),
+        _byte_array('HeightMap', heightmap),
+        _empty_list('Entities'),
+        _empty_list('TileEntities'),
+    ])
+    return _tag(10, '', _tag(10, 'Level', level + '\x00') + '\x00')
+
+def generate(root, regions=1, density=1.0, compression=2, terrain='flat', seed=0):
+    """Write regions x regions region files in root/region.
+
+    density is the probability for a chunk to exist.
+    Return the number of written chunks.
+    """
+
+    rnd = random.Random(seed)
+    region_dir = os.path.join(root, 'region')
+    if not os.path.isdir(region_dir):
+        os.makedirs(region_dir)
+
+    count = 0
+    for rx in xrange(regions):
+        for rz in xrange(regions):
+            filename = os.path.join(region_dir, "r.%d.%d.mcr" % (rx, rz))
+            if os.path.exists(filename):
+                os.remove(filename)
+            with mcr.RegionFile(filename, writable=True) as region:
+                for idx in xrange(mcr.CHUNKS_PER_REGION):
+                    if rnd.random() >= density:
+                        continue
+                    cx = (rx << 5) + (idx & 31)
+                    cz = (rz << 5) + (idx >> 5)
+                    region.write_chunk(idx, chunk_nbt(terrain, cx, cz, rnd),
+                                       timestamp=1, compression=compression)
+                    count += 1
+    return count
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] <world directory>")
+    parser.add_option("-r", "--regions", type="int", dest="regions", default=1,
+                      help="regions per side")
+    parser.add_option("-d", "--density", type="float", dest="density", default=1.0)
+    parser.add_option("-c", "--compression", type="choice", dest="compression",
+                      choices=['gzip', 'zlib'], default='zlib')
+    parser.add_option("-t", "--terrain", type="choice", dest="terrain",
+                      choices=list(TERRAINS), default='flat')
+    parser.add_option("-s", "--seed", type="int", dest="seed", default=0)
+
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("world directory required")
+
+    n = generate(args[0], opts.regions, opts.density,
+                 1 if opts.compression == 'gzip' else 2, opts.terrain, opts.seed)
+    print "%u chunks written" % n
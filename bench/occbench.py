@@ -0,0 +1,134 @@
+# This file is part of NoCurve.
+#
+#    NoCurve is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    NoCurve is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with NoCurve.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Block occlusion benchmark.
+
+Loads the chunks of a map window from a world and times the occlusion of
+whole columns with each method of lowlevel.Map:
+
+  scalar  : per block lookups of the six neighbours
+  bitmask : per column of blocks Y bitmasks (Map.occlusion_masks)
+
+'load' is the occlusion pass following add_blocks() of all chunks, 'forced'
+the average of do_occlusion(cx, cz) repeated on each column. Both methods
+must give the same faces count.
+
+Usage: python occbench.py [options] <world directory>
+A synthetic world is generated first if the directory has no region files
+(see mcrgen.py options).
+"""
+
+import os
+import sys
+import glob
+
+from time import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'model'))
+
+import lowlevel
+import mcr
+import mcrgen
+
+METHODS = ('scalar', 'bitmask')
+
+# blocks seen through: water, lava, leaves, glass, ice
+ALPHA_IDS = (8, 9, 10, 11, 18, 20, 79)
+
+
+def _new_mesh(idx):
+    mesh = lowlevel.Mesh(lowlevel.MESH_CUBE, 0, '\0' * (6*4*2*4))
+    mesh.alpha = idx in ALPHA_IDS
+    mesh.occlusion = 0 if mesh.alpha else 0x3f
+    return mesh
+
+def load_chunks(region_dir, size):
+    "Return blocks arrays of the size x size first chunks found, by position"
+
+    m = mcr.MCR(region_dir)
+    chunks = {}
+    for cx in xrange(size):
+        for cz in xrange(size):
+            try:
+                level = m.get_cluster_level(cx << 4, cz << 4)
+            except (KeyError, IOError):
+                continue
+            chunks[cx, cz] = str(level['Blocks'].value)
+    return chunks
+
+def run_method(name, chunks, repeat):
+    "Return (columns count, load pass seconds, forced pass seconds per column, faces count)"
+
+    m = lowlevel.Map()
+    m.occlusion_masks = (name == 'bitmask')
+
+    for pos, blocks in chunks.iteritems():
+        for idx in m.add_blocks(blocks, *pos):
+            if not m.has_mesh(idx):
+                m.set_mesh(idx, _new_mesh(idx))
+
+    t = time()
+    m.do_occlusion()
+    t_load = time() - t
+
+    t = time()
+    for _ in xrange(repeat):
+        for pos in chunks:
+            m.do_occlusion(*pos)
+    t_forced = (time() - t) / max(repeat * len(chunks), 1)
+
+    return len(chunks), t_load, t_forced, m.generate_faces()
+
+def bench(region_dir, size, repeat, methods=METHODS):
+    "Run methods and print results"
+
+    chunks = load_chunks(region_dir, size)
+    if not chunks:
+        print "no chunks found in '%s'" % region_dir
+        return
+
+    print "%-8s %8s %9s %12s %14s %10s" % ('method', 'columns', 'load', 'columns/s', 'forced/column', 'faces')
+    for name in methods:
+        count, t_load, t_forced, faces = run_method(name, chunks, repeat)
+        print "%-8s %8u %8.1fms %12.1f %12.3fms %10u" % (name, count, t_load * 1e3,
+                                                       count / max(t_load, 1e-6),
+                                                       t_forced * 1e3, faces)
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] <world directory>")
+    parser.add_option("-m", "--method", action="append", dest="methods",
+                      choices=list(METHODS), help="method to run (default: all)")
+    parser.add_option("-n", "--repeat", type="int", dest="repeat", default=4,
+                      help="forced passes per column")
+    parser.add_option("-w", "--window", type="int", dest="window", default=16,
+                      help="loaded chunks per side, at most the map window size")
+    parser.add_option("-t", "--terrain", type="choice", dest="terrain",
+                      choices=list(mcrgen.TERRAINS), default='hills')
+
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("world directory required")
+
+    region_dir = os.path.join(args[0], 'region')
+    if not glob.glob(os.path.join(region_dir, 'r.*.*.mcr')):
+        n = mcrgen.generate(args[0], 1, 1.0, 2, opts.terrain)
+        print "Generated %u chunks in '%s'" % (n, region_dir)
+
+    bench(region_dir, opts.window, opts.repeat, opts.methods or METHODS)
@@ -63,6 +63,9 @@ class PyGameController(mvc.Controller):
 
         # Install a new map
         map = model.map.Map()
+        map.compact = opts.compact
+        map.greedy = opts.greedy
+        map.mesh_threads = opts.mesh_threads
         map_proxy = model.MapProxy(map)
         self.map_proxy = map_proxy
         self.facade.add_proxy(map_proxy)
@@ -88,6 +91,12 @@ class PyGameController(mvc.Controller):
         if opts.root is not None and os.path.isdir(opts.root):
             map.set_root(opts.root)
 
+        if opts.snapshot and os.path.isfile(opts.snapshot):
+            try:
+                map.load_snapshot(opts.snapshot)
+            except IOError as e:
+                print "snapshot not restored:", e
+
         # Signal that initialization is done
         self.init_signal.emit()
 
@@ -106,6 +115,9 @@ class PyGameController(mvc.Controller):
         # Run the event loop now
         display_mediator.run()
 
+        if opts.snapshot:
+            map.save_snapshot(opts.snapshot, True)
+
     def handler_input_events(self):
         # PyGame event parsing and dispatching (using Event signals)
         for event in pygame.event.get():
@@ -25,6 +25,14 @@ if __name__ == "__main__":
     parser.add_option("--height", type="int", dest="height", default=480)
     parser.add_option("--test", action="store", type="string", dest="test")
     parser.add_option("--nodeid", type="int", dest="nodeid", default=1)
+    parser.add_option("--compact", action="store_true", dest="compact", default=False,
+                      help="store map blocks in palette form, for larger view distances")
+    parser.add_option("--greedy", action="store_true", dest="greedy", default=False,
+                      help="merge coplanar faces of cubes, to render less faces")
+    parser.add_option("--mesh-threads", type="int", dest="mesh_threads", default=0,
+                      help="threads meshing map cells besides the main one")
+    parser.add_option("--snapshot", action="store", type="string", dest="snapshot",
+                      help="restore the map from this file if it exists, save it on exit")
     parser.add_option("--be", "--backend", action="store", dest="ctrl", default="pygame")
 
     args = parser.parse_args()
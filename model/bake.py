@@ -0,0 +1,249 @@
+# This file is part of NoCurve.
+#
+#    NoCurve is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    NoCurve is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with NoCurve.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Baked chunks cache.
+
+Chunks already uncompressed and extracted from their NBT data are stored
+in sidecar files, one per region (r.x.z.bake), and read back through mmap.
+Each baked chunk remembers the stamp of the chunk it comes from: region
+timestamp, location and compressed length (see RegionFile.chunk_stamp).
+A chunk is considered outdated as soon as its stamp differs.
+
+File format (little endian):
+
+  header: 'NCBK', version (uint32), then 1024 entries of
+          (timestamp, location, length, record offset) uint32 tuples.
+          A null offset means no record.
+  record: xPos, zPos (int32), then raw arrays as found in chunk NBT:
+          Blocks (32768), Data, SkyLight, BlockLight (16384 each), HeightMap (256).
+
+Records are appended, an outdated chunk gets a new record. The file is
+grown by doubling its size, so it's remapped only a few times, and it's
+compacted when opened if outdated records take most of it.
+"""
+
+import os
+import mmap
+
+from struct import Struct, pack
+from threading import Lock
+from collections import OrderedDict
+
+from nbtscan import Level, Tag
+
+__all__ = ['BakedRegion', 'BakeCache']
+
+MAGIC = 'NCBK'
+VERSION = 2
+CHUNKS_PER_REGION = 1024
+
+_HEADER = Struct('<4sI')
+_ENTRY = Struct('<IIII')
+_POSITION = Struct('<ii')
+HEADER_SIZE = _HEADER.size + CHUNKS_PER_REGION * _ENTRY.size
+
+# (tag name, size) of arrays in a record, in file order
+ARRAYS = (('Blocks', 32768),
+          ('Data', 16384),
+          ('SkyLight', 16384),
+          ('BlockLight', 16384),
+          ('HeightMap', 256))
+
+RECORD_SIZE = _POSITION.size + sum(n for _, n in ARRAYS)
+
+# outdated records are dropped when they take more than half of the file,
+# and at least this count of records
+COMPACT_RECORDS = 64
+
+
+class BakedRegion(object):
+    "Sidecar file of baked chunks for one region"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._map = None
+
+        if not os.path.isfile(filename):
+            self._create(filename)
+
+        self._fd = open(filename, 'r+b')
+        self._read_header()
+        if self.stamps is None:
+            # Unknown or old format, start from scratch
+            self._fd.close()
+            self._create(filename)
+            self._fd = open(filename, 'r+b')
+            self._read_header()
+
+        # data end, the file may be larger
+        self._end = max([x + RECORD_SIZE for x in self.offsets if x] or [HEADER_SIZE])
+        live = len(self.offsets) - self.offsets.count(0)
+        if self._end - HEADER_SIZE > max(2 * live, COMPACT_RECORDS) * RECORD_SIZE:
+            self._compact()
+
+        self._fd.seek(0, os.SEEK_END)
+        self._size = self._fd.tell()
+        self._remap()
+
+    @staticmethod
+    def _create(filename):
+        with open(filename, 'wb') as fd:
+            fd.write(_HEADER.pack(MAGIC, VERSION))
+            fd.write('\0' * (HEADER_SIZE - _HEADER.size))
+
+    def _read_header(self):
+        fd = self._fd
+        fd.seek(0)
+        data = fd.read(HEADER_SIZE)
+        self.stamps = self.offsets = None
+        if len(data) < HEADER_SIZE:
+            return
+
+        magic, version = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            return
+
+        entries = Struct('<%uI' % (CHUNKS_PER_REGION * 4)).unpack_from(data, _HEADER.size)
+        self.stamps = zip(entries[0::4], entries[1::4], entries[2::4])
+        self.offsets = list(entries[3::4])
+
+    def _compact(self):
+        "Rewrite the file with up to date records only"
+
+        tmpname = self.filename + '.tmp'
+        offsets = [0] * CHUNKS_PER_REGION
+        fd = self._fd
+        with open(tmpname, 'wb') as out:
+            out.write('\0' * HEADER_SIZE)
+            offset = HEADER_SIZE
+            for idx, old in enumerate(self.offsets):
+                if old:
+                    fd.seek(old)
+                    out.write(fd.read(RECORD_SIZE))
+                    offsets[idx] = offset
+                    offset += RECORD_SIZE
+            out.seek(0)
+            out.write(_HEADER.pack(MAGIC, VERSION))
+            for stamp, offset in zip(self.stamps, offsets):
+                out.write(_ENTRY.pack(*(stamp + (offset,))))
+
+        # Mappings of the old file stay valid for levels still using them
+        try:
+            os.rename(tmpname, self.filename)
+        except OSError:
+            os.remove(tmpname)
+            return
+
+        fd.close()
+        self._fd = open(self.filename, 'r+b')
+        self.offsets = offsets
+        self._end = max([x + RECORD_SIZE for x in offsets if x] or [HEADER_SIZE])
+
+    def _remap(self):
+        # Previous mapping is not closed: levels given by get() may still use it,
+        # it's released with its last buffer.
+        self._map = mmap.mmap(self._fd.fileno(), self._size, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self._map = None
+        self._fd.close()
+
+    def get(self, idx, stamp):
+        """Return the baked Level of a chunk (header index) or None.
+
+        None is also returned if the baked chunk stamp differs from stamp.
+        Arrays are buffer objects on the file mapping.
+        """
+
+        offset = self.offsets[idx]
+        if not offset or self.stamps[idx] != tuple(stamp):
+            return
+
+        if offset + RECORD_SIZE > len(self._map):
+            self._remap()
+
+        m = self._map
+        x, z = _POSITION.unpack_from(m, offset)
+        level = Level(xPos=Tag(x), zPos=Tag(z))
+        offset += _POSITION.size
+        for name, size in ARRAYS:
+            level[name] = Tag(buffer(m, offset, size))
+            offset += size
+        return level
+
+    def put(self, idx, stamp, level):
+        "Bake a chunk Level (as given by nbtscan.scan_level)"
+
+        data = [_POSITION.pack(level['xPos'].value, level['zPos'].value)]
+        for name, size in ARRAYS:
+            tag = level.get(name)
+            value = str(tag.value)[:size] if tag is not None else ''
+            data.append(value + '\0' * (size - len(value)))
+
+        fd = self._fd
+        offset = self._end
+        if offset + RECORD_SIZE > self._size:
+            self._size = max(offset + RECORD_SIZE, 2 * self._size)
+            fd.truncate(self._size)
+        fd.seek(offset)
+        fd.write(''.join(data))
+        fd.seek(_HEADER.size + idx * _ENTRY.size)
+        fd.write(_ENTRY.pack(*(tuple(stamp) + (offset,))))
+        fd.flush()
+
+        self.stamps[idx] = tuple(stamp)
+        self.offsets[idx] = offset
+        self._end = offset + RECORD_SIZE
+
+
+class BakeCache(object):
+    """Thread-safe access to baked region files in a directory.
+
+    At most max_regions files are kept opened.
+    """
+
+    def __init__(self, root, max_regions=4):
+        self._root = root
+        self.max_regions = max_regions
+        self._regions = OrderedDict()
+        self._lock = Lock()
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def _get_region(self, rx, rz):
+        pos = rx, rz
+        region = self._regions.pop(pos, None)
+        if region is None:
+            region = BakedRegion(os.path.join(self._root, "r.%d.%d.bake" % pos))
+            while len(self._regions) >= self.max_regions:
+                _, old = self._regions.popitem(last=False)
+                old.close()
+        self._regions[pos] = region
+        return region
+
+    def get(self, cx, cz, stamp):
+        "Return the baked Level of a chunk if it has the same stamp, else None"
+        with self._lock:
+            return self._get_region(cx >> 5, cz >> 5).get((cx & 31) + (cz & 31) * 32, stamp)
+
+    def put(self, cx, cz, stamp, level):
+        with self._lock:
+            self._get_region(cx >> 5, cz >> 5).put((cx & 31) + (cz & 31) * 32, stamp, level)
+
+    def clear(self):
+        with self._lock:
+            for region in self._regions.itervalues():
+                region.close()
+            self._regions.clear()
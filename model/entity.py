@@ -19,7 +19,7 @@ import OpenGL.GL as GL
 from OpenGL import constants
 
 import lowlevel
-from texture import GLTexture
+from texture import GLTexture, load_tile_textures
 from mesh import *
 
 ## BlocksID data obtained from minecraft blender add-ons.
@@ -361,6 +361,7 @@ class Mesh(lowlevel.Mesh):
     __slots__ = ['_texture']
 
     _texture = None
+    _tiles = None
 
     def __new__(cls, mesh_type, texfaces,
                 alpha=0, translucent=0, tinted=None, level=0):
@@ -386,6 +387,18 @@ class Mesh(lowlevel.Mesh):
         mesh.level = level
         return mesh
 
+    @staticmethod
+    def get_tile_textures():
+        """Return (columns, rows, texids) of the terrain atlas tiles textures,
+        as needed by Map.set_tile_textures(). Must be called in the OpenGL context.
+        """
+
+        if Mesh._tiles is None:
+            Mesh._tiles = load_tile_textures('data/terrain.png', 16, mipmap=1)
+
+        columns, rows, textures = Mesh._tiles
+        return columns, rows, [ t.texid for t in textures ]
+
 class MeshCube(Mesh):
     __slots__ = []
 
@@ -26,6 +26,11 @@ from math import hypot
 from itertools import izip
 
 import mcr
+import prefetch
+import worldindex
+import stream
+
+from player import MainPlayer
 
 
 class Map(lowlevel.Map):
@@ -36,6 +41,12 @@ class Map(lowlevel.Map):
     missings = set()
 
     die_level = -64
+    mcr = None
+    prefetcher = None
+    streamer = None
+    world_index = None
+    _prefetch_pos = None
+    rebuild_budget = 8 # cells meshed per update and meshing thread
 
     main_player_spawn_pose = [(0, 80, 0), (0, 0, 1)]
 
@@ -68,10 +79,30 @@ class Map(lowlevel.Map):
 
         return Map.DEFAULT
 
+    def load_snapshot(self, filename):
+        """Restore clusters saved by save_snapshot().
+
+        Mesh objects are not part of snapshots, they're created for found
+        block ids. Faces are restored if saved, else rebuilt as dirty cells.
+        """
+
+        ids = super(Map, self).load_snapshot(filename)
+        for idx in ids:
+            self.new_mesh(idx)
+        return ids
+
     def set_root(self, root):
         self.leveldat = mcr.LevelDat(os.path.join(root, "level.dat"))
-        self.mcr = mcr.MCR(os.path.join(root, "region"))
+        self.mcr = mcr.MCR(os.path.join(root, "region"),
+                           bake_root=os.path.join(root, "baked"))
         self.get_cluster_level = self.mcr.get_cluster_level
+        self.world_index = worldindex.WorldIndex.open(root)
+        self.mcr.index = self.world_index
+
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        self.prefetcher = prefetch.ChunkPrefetcher(self.mcr, index=self.world_index)
+        self.prefetcher.start()
 
     #####################
     ## Players handling
@@ -95,6 +126,66 @@ class Map(lowlevel.Map):
     def update(self):
         for player in self.players:
             player.update()
+            if isinstance(player, MainPlayer):
+                if self.mcr is not None:
+                    self.follow(player)
+                if self.prefetcher is not None:
+                    self.update_prefetch(player)
+
+        self.lock()
+        try:
+            if self.streamer is not None:
+                self.streamer.step()
+            # blocks edits
+            if self.dirty_cells:
+                self.rebuild_dirty(self.rebuild_budget * (self.mesh_threads + 1))
+        finally:
+            self.release()
+
+    def stream_around(self, x, z):
+        """Recenter the map window on a position (in blocks) and start
+        to import missing chunks, nearest first.
+
+        Chunks are imported by Map.update(), by steps bounded in time.
+        Clusters going out of the window are released.
+        """
+
+        missings = self.recenter(int(x) >> 4, int(z) >> 4)
+        if self.world_index is not None:
+            missings = [pos for pos in missings if pos in self.world_index]
+
+        if self.streamer is None:
+            self.streamer = stream.WorldStreamer(self, self.get_cluster_level, missings)
+        else:
+            self.streamer.retarget(missings)
+
+    def follow(self, player):
+        "Slide the map window when the player enters a new chunk"
+
+        x, _, z = player.position
+        if (int(x) >> 4, int(z) >> 4) != (self.center_cx, self.center_cz):
+            self.lock()
+            try:
+                self.stream_around(x, z)
+            finally:
+                self.release()
+
+    def update_prefetch(self, player):
+        """Drive chunk prefetching from the player position and motion.
+
+        Must be called from the thread owning the map (see Map.update).
+        """
+
+        x, _, z = player.position
+        if self._prefetch_pos is None:
+            dx = dz = 0.
+        else:
+            dx = x - self._prefetch_pos[0]
+            dz = z - self._prefetch_pos[1]
+        self._prefetch_pos = x, z
+
+        self.prefetcher.update(x, z, dx, dz)
+        self.prefetcher.poll()
 
     def toggle_fog(self):
         self.lock()
@@ -113,26 +204,17 @@ class Map(lowlevel.Map):
     def test_alpha(self):
         self.new_mesh(9)
         # general alpha rendering
-        for x in range(3):
-            for z in range(3):
-                for y in range(3):
-                    self.set_blockid(9,x,70+y, z)
+        self.fill(9, 0, 70, 0, 3, 73, 3)
 
     def test_alpha2(self):
         self.new_mesh(8)
         self.new_mesh(9)
         self.new_mesh(2)
         # general alpha rendering
-        for x in range(3):
-            for z in range(3):
-                for y in range(3):
-                    self.set_blockid(9,x,70+y, z)
+        self.fill(9, 0, 70, 0, 3, 73, 3)
         # test alpha between 2 clusters limits
-        for x in range(8):
-            for z in range(8):
-                self.set_blockid(2,12+x,64, 12+z)
-                for y in range(8):
-                    self.set_blockid(8,12+x,65+y, 12+z)
+        self.fill(2, 12, 64, 12, 20, 65, 20)
+        self.fill(8, 12, 65, 12, 20, 73, 20)
 
     def test_occlusion(self):
         self.new_mesh(89)
@@ -150,25 +232,10 @@ class Map(lowlevel.Map):
         self.set_blockid(1, 2, 72, 3)
         self.set_blockid(1, 2, 71, 2)
         self.set_blockid(1, 2, 73, 2)
-        for x in range(3):
-            for z in range(3):
-                self.set_blockid(1,x+12,72,z+10)
+        self.fill(1, 12, 72, 10, 15, 73, 13)
 
     def test_map(self):
         print "\n*** Testing tesselator"
 
-        rx = 0
-        rz = 0
-
-        for cx in xrange(0,6):
-            for cz in xrange(0,6):
-                try:
-                    level = self.get_cluster_level((rx << 9) + cx*16 - 128,
-                                                   (rz << 9) + cz*16 - 128)
-                except KeyError:
-                    pass
-                else:
-                    blocks = level['Blocks'].value
-                    for i, c in enumerate(blocks):
-                        self.new_mesh(c)
-                    self.add_blocks(blocks, cx, cz)
+        (x, _, z), _ = self.get_player_spawn_data()
+        self.stream_around(x, z)
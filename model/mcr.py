@@ -19,34 +19,434 @@ import sys
 import os
 import gzip
 import zlib
+import mmap
 
-from struct import unpack_from, unpack
+from struct import unpack_from, unpack, pack
+from time import time
+from collections import OrderedDict
 from pprint import pprint
 from cStringIO import StringIO
 from nbt.nbt import NBTFile
+from nbtscan import scan_level
+from bake import BakeCache, RECORD_SIZE
+
+SECTOR_SIZE = 4096
+CHUNKS_PER_REGION = 1024
+
+class RegionFile(object):
+    """Memory-mapped region file (r.x.z.mcr) reader and writer.
+
+    The 8KiB header (locations + timestamps tables) is decoded in one pass
+    at open time. Compressed chunk payloads are given as buffer objects
+    sharing the file mapping, so nothing is copied before zlib.
+
+    A writable region file is created if it doesn't exist yet (or is empty),
+    an empty read-only one has no chunks.
+    Written chunks reuse their sectors when the new payload fits, else take
+    the first free sectors run (or the end of the file). Header changes are
+    kept in memory and written in one batch by flush() (or close()).
+    Sectors left by written chunks are only reused after flush(), the header
+    on disk still pointing at them until then.
+    """
+
+    MAX_SECTORS = 255 # sectors count is stored on 8 bits
+
+    def __init__(self, filename, writable=False):
+        self.filename = filename
+        self.writable = writable
+        self._map = None
+        self._sectors = None # sectors usage map, built on first write
+        self._dirty = set() # header entries to write back
+        self._freed = [] # (offset, count) sectors runs to release on flush
+
+        if writable:
+            if not os.path.isfile(filename) or not os.path.getsize(filename):
+                with open(filename, 'wb') as fd:
+                    fd.write('\0' * (2*SECTOR_SIZE))
+            self._fd = open(filename, 'r+b')
+        else:
+            self._fd = open(filename, 'rb')
+            if not os.fstat(self._fd.fileno()).st_size:
+                # empty files can't be mapped
+                self.locations = [0] * CHUNKS_PER_REGION
+                self.timestamps = [0] * CHUNKS_PER_REGION
+                return
+
+        try:
+            self._remap()
+        except:
+            self._fd.close()
+            raise
+
+        if len(self._map) < 2*SECTOR_SIZE:
+            self.close()
+            raise IOError("truncated region file '%s'" % filename)
+
+        self.locations = list(unpack_from(">%uI" % CHUNKS_PER_REGION, self._map, 0))
+        self.timestamps = list(unpack_from(">%uI" % CHUNKS_PER_REGION, self._map, SECTOR_SIZE))
+
+    def _remap(self):
+        self._map = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._dirty:
+            self.flush()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._fd.close()
+
+    @staticmethod
+    def chunk_index(cx, cz):
+        "Return the header index of a chunk given in chunk coordinates"
+        return (cx & 31) + (cz & 31) * 32
+
+    def iter_chunks(self):
+        "Yield header index of all chunks present in the region"
+        for idx, value in enumerate(self.locations):
+            if value:
+                yield idx
+
+    def chunk_stamp(self, idx):
+        """Return (timestamp, location, compressed length) of a chunk.
+
+        The stamp changes each time the chunk is stored again, even in the
+        same second.
+        """
+
+        value = self.locations[idx]
+        offset = (value >> 8) * SECTOR_SIZE
+        length = 0
+        if offset >= 2*SECTOR_SIZE and offset + 4 <= len(self._map):
+            length = unpack_from(">I", self._map, offset)[0]
+        return self.timestamps[idx], value, length
+
+    def get_payload(self, idx):
+        """Return (compression, buffer) of a chunk or None if the chunk is absent.
+
+        The buffer is a zero-copy view on the file mapping.
+        """
+
+        value = self.locations[idx]
+        chunk_offset = value >> 8
+        count = value & 0xff
+
+        # empty chunk
+        if chunk_offset == 0 and count == 0:
+            return
+
+        offset = chunk_offset * SECTOR_SIZE
+        if chunk_offset < 2 or count == 0 or offset + 5 > len(self._map):
+            print UserWarning("Invalid cluster location data: offset=%u, count=%u" % (chunk_offset, count))
+            return
+
+        length, compression = unpack_from(">IB", self._map, offset)
+
+        if length == 0:
+            print UserWarning("Chunk has a zero data length!")
+            return
+
+        if compression not in [1, 2]:
+            print UserWarning("Chunk has unknown compression method (%u)!" % (compression))
+            return
+
+        # max should be 1MB
+        n = min(length - 1, count * SECTOR_SIZE - 5)
+        return compression, buffer(self._map, offset + 5, n)
+
+    def read_chunk(self, idx):
+        "Return uncompressed NBT data of a chunk or None if the chunk is absent"
+        payload = self.get_payload(idx)
+        if payload is None:
+            return
+
+        compression, rawdata = payload
+        if compression == 1:
+            # gzip stream
+            return zlib.decompress(rawdata, 16 + zlib.MAX_WBITS)
+        return zlib.decompress(rawdata)
+
+    def _build_sectors(self):
+        # One byte per file sector, non-zero if used (header included)
+        sectors = bytearray(len(self._map) // SECTOR_SIZE)
+        sectors[0:2] = '\1\1'
+        for value in self.locations:
+            offset = value >> 8
+            count = value & 0xff
+            if offset >= 2 and count:
+                sectors[offset:offset+count] = '\1' * count
+        self._sectors = sectors
+
+    def _allocate(self, count):
+        "Return the first sector of a free run of count sectors, grow the file if needed"
+        sectors = self._sectors
+        offset = sectors.find('\0' * count, 2)
+        if offset < 0:
+            # use free sectors at the end of the file and append the others
+            offset = len(sectors)
+            while offset > 2 and not sectors[offset-1]:
+                offset -= 1
+            sectors.extend('\0' * (offset + count - len(sectors)))
+        sectors[offset:offset+count] = '\1' * count
+        return offset
+
+    def write_chunk(self, idx, data, timestamp=None, compression=2):
+        """Store uncompressed NBT data of a chunk (given by header index).
+
+        compression is 2 for zlib (default) or 1 for gzip.
+        The header entry is updated in memory only, call flush() to write it.
+        """
+
+        if not self.writable:
+            raise IOError("region file '%s' is not writable" % self.filename)
+
+        if compression == 1:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as fd:
+                fd.write(data)
+            payload = buf.getvalue()
+        elif compression == 2:
+            payload = zlib.compress(data)
+        else:
+            raise ValueError("unknown compression method (%u)" % compression)
+        payload = pack(">IB", len(payload) + 1, compression) + payload
+        count = (len(payload) + SECTOR_SIZE - 1) // SECTOR_SIZE
+        if count > self.MAX_SECTORS:
+            raise ValueError("chunk data too big (%u bytes compressed)" % len(payload))
+
+        if self._sectors is None:
+            self._build_sectors()
+
+        value = self.locations[idx]
+        offset = value >> 8
+        old_count = value & 0xff
+
+        if offset >= 2 and count <= old_count:
+            # rewrite in place, release unused sectors
+            if count < old_count:
+                self._freed.append((offset + count, old_count - count))
+        else:
+            if offset >= 2 and old_count:
+                self._freed.append((offset, old_count))
+            offset = self._allocate(count)
+
+        fd = self._fd
+        fd.seek(offset * SECTOR_SIZE)
+        fd.write(payload)
+        fd.write('\0' * (count * SECTOR_SIZE - len(payload)))
+        fd.flush()
+
+        # Map new sectors
+        if (offset + count) * SECTOR_SIZE > len(self._map):
+            self._map.close()
+            self._remap()
+
+        self.locations[idx] = (offset << 8) | count
+        self.timestamps[idx] = int(time() if timestamp is None else timestamp)
+        self._dirty.add(idx)
+
+    def flush(self):
+        "Write changed header entries"
+
+        if not self._dirty:
+            return
+
+        fd = self._fd
+        for idx in sorted(self._dirty):
+            fd.seek(idx * 4)
+            fd.write(pack(">I", self.locations[idx]))
+            fd.seek(SECTOR_SIZE + idx * 4)
+            fd.write(pack(">I", self.timestamps[idx]))
+        self._dirty.clear()
+        fd.flush()
+
+        # old sectors are no longer referenced on disk
+        for offset, count in self._freed:
+            self._sectors[offset:offset+count] = '\0' * count
+        del self._freed[:]
+
+
+class ChunkCache(object):
+    """LRU cache of decoded chunks bounded by a byte budget.
+
+    Each entry is accounted with the size given at insertion (the uncompressed
+    chunk data length for MCR). Touching and evicting an entry are O(1).
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict() # pos -> (level, size), oldest first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, pos):
+        "Return the cached level at pos (or None) and mark it as most recently used"
+        try:
+            entry = self._entries.pop(pos)
+        except KeyError:
+            self.misses += 1
+            return
+        self._entries[pos] = entry
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, pos):
+        "Like get() but without touching the entry nor counting"
+        entry = self._entries.get(pos)
+        if entry is not None:
+            return entry[0]
+
+    def put(self, pos, level, size):
+        old = self._entries.pop(pos, None)
+        if old is not None:
+            self.size -= old[1]
+        self._entries[pos] = level, size
+        self.size += size
+
+        # Evict least recently used chunks, but always keep the new one
+        while self.size > self.max_size and len(self._entries) > 1:
+            _, (_, n) = self._entries.popitem(last=False)
+            self.size -= n
+            self.evictions += 1
+
+    def discard(self, pos):
+        entry = self._entries.pop(pos, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    size=self.size, count=len(self._entries))
+
+    def __contains__(self, pos):
+        return pos in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RegionPool(object):
+    """Pool of opened RegionFile, keyed by region coordinates.
+
+    At most max_regions files are kept mapped, the least recently used one
+    is closed when a new region is needed. Missing region files are
+    remembered too, so they are not looked up again.
+    """
+
+    def __init__(self, root, max_regions=4, writable=False):
+        self._root = root
+        self.max_regions = max_regions
+        self.writable = writable
+        self._regions = OrderedDict() # (rx, rz) -> RegionFile, oldest first
+        self._missings = set()
+
+    def filename(self, rx, rz):
+        return os.path.join(self._root, "r.%d.%d.mcr" % (rx, rz))
+
+    def get(self, rx, rz, create=False):
+        """Return the RegionFile at given region coordinates.
+
+        Raise KeyError if no region file exists at this position,
+        unless create is set (writable pool only).
+        """
+
+        pos = rx, rz
+        region = self._regions.pop(pos, None)
+        if region is None:
+            if pos in self._missings and not create:
+                raise KeyError(pos)
+
+            filename = self.filename(rx, rz)
+            if not (create and self.writable) and not os.path.isfile(filename):
+                self._missings.add(pos)
+                raise KeyError(pos)
+
+            print "Loading file '%s'" % filename
+            region = RegionFile(filename, self.writable)
+            self._missings.discard(pos)
+
+            while len(self._regions) >= self.max_regions:
+                _, old = self._regions.popitem(last=False)
+                old.close()
+
+        self._regions[pos] = region
+        return region
+
+    def flush(self):
+        for region in self._regions.itervalues():
+            region.flush()
+
+    def clear(self):
+        for region in self._regions.itervalues():
+            region.close()
+        self._regions.clear()
+        self._missings.clear()
+
+    def __contains__(self, pos):
+        return pos in self._regions
+
 
 class MCR(object):
     """MCR cache class.
 
     MCR instance try to find region file that contains a position and cache data.
     This class handles data uncompressing and cluster data fetching.
+
+    In lazy mode (default) only the region header is parsed when a region
+    is entered, chunks are uncompressed and decoded one at a time when asked.
+    Otherwise the whole region is decoded at once.
+
+    Several regions are kept opened at the same time (see RegionPool),
+    so moving around region borders doesn't reload them.
+
+    By default chunk are not decoded as a full NBT tree: only the Level tags
+    used by the engine are extracted (see nbtscan), with byte arrays given
+    as buffer objects. Set full_nbt to get NBTFile objects.
+
+    If bake_root is given, extracted chunks are also stored there
+    (see bake module) and reused while their region stamp is unchanged.
+    This is not available with full_nbt.
+
+    A writable MCR can store chunks back (save_chunk), region files being
+    created as needed. Region headers are updated by commit(). Saved chunks
+    are also set in the WorldIndex given as index attribute, if any.
     """
 
-    MAX_CLUSTERS = 1024 # Choose to fully load one region
+    MAX_CACHE_SIZE = 64 << 20 # bytes of uncompressed chunk data, ~800 chunks
+    MAX_REGIONS = 4 # enough for a player standing at a region corner
 
-    def __init__(self, pathname):
+    def __init__(self, pathname, lazy=True, cache_size=MAX_CACHE_SIZE,
+                 max_regions=MAX_REGIONS, full_nbt=False, bake_root=None,
+                 writable=False):
         self._root = pathname
-        self._level_cache = {}
-        self.flush()
+        self._level_cache = ChunkCache(cache_size)
+        self._regions = RegionPool(pathname, max_regions, writable)
+        self.lazy = lazy
+        self.full_nbt = full_nbt
+        self.index = None # WorldIndex updated by save_chunk()
+        if bake_root is not None and not full_nbt:
+            self._baked = BakeCache(bake_root, max_regions)
+        else:
+            self._baked = None
 
     def flush(self):
-        self._region_rx = None
-        self._region_rz = None
-        self._region_locations = None
-        self._region_timestamps = None
-        self._region_filename = None
+        self._regions.clear()
         self._level_cache.clear()
-        self._pos_order = []
+        if self._baked is not None:
+            self._baked.clear()
 
     def get_cluster_level(self, x, z):
         """Return an NBT object with cluster data for the given position.
@@ -58,87 +458,127 @@ class MCR(object):
         pos = x >> 4, z >> 4
 
         # Check already loaded cluster cache first
-        level = self._level_cache.get(pos, None)
+        level = self._level_cache.get(pos)
         if level is None:
             # load suitable region (and cache), raise error if not found
             # Todo: create a new region file if nothing found
             self.use_region(x >> 9, z >> 9)
-            level = self._level_cache[pos]
+            level = self._level_cache.peek(pos)
+            if level is None:
+                level = self.load_level(*pos)
 
-        try:
-            self._pos_order.remove(pos)
-        except:
-            pass
-        self._pos_order.append(pos)
         return level
 
+    def load_level(self, cx, cz):
+        """Decode and cache one chunk, given in chunk coordinates.
+
+        Raise KeyError if the chunk doesn't exist.
+        """
+
+        level, size = self.read_level(self._regions.get(cx >> 5, cz >> 5), cx, cz)
+        self._level_cache.put((cx, cz), level, size)
+        return level
+
+    def read_level(self, region, cx, cz):
+        """Decode one chunk of the given region without caching it.
+
+        Return a (level, size) tuple, size being the uncompressed data length.
+        Doesn't touch MCR cache, so it can be called from any thread with
+        its own RegionFile.
+        Raise KeyError if the chunk doesn't exist.
+        """
+
+        idx = RegionFile.chunk_index(cx, cz)
+        stamp = None
+        if self._baked is not None and region.locations[idx]:
+            stamp = region.chunk_stamp(idx)
+            level = self._baked.get(cx, cz, stamp)
+            if level is not None:
+                return level, RECORD_SIZE
+
+        data = region.read_chunk(idx)
+        if data is None:
+            raise KeyError((cx, cz))
+        level = self.unpack_level(data)
+
+        if stamp is not None:
+            self._baked.put(cx, cz, stamp, level)
+
+        return level, len(data)
+
+    def save_chunk(self, cx, cz, data):
+        """Store uncompressed NBT data of a chunk, given in chunk coordinates.
+
+        The cached level of this chunk is dropped.
+        """
+
+        region = self._regions.get(cx >> 5, cz >> 5, create=True)
+        idx = RegionFile.chunk_index(cx, cz)
+        region.write_chunk(idx, data)
+        self._level_cache.discard((cx, cz))
+
+        if self.index is not None:
+            timestamp, _, size = region.chunk_stamp(idx)
+            self.index.set_chunk(cx, cz, size, timestamp)
+
+    def save_nbt(self, cx, cz, nbt):
+        "Store a chunk given as an NBTFile object"
+        buf = StringIO()
+        nbt.write_file(buffer=buf)
+        self.save_chunk(cx, cz, buf.getvalue())
+
+    def commit(self):
+        "Write region headers changed by save_chunk() calls"
+        self._regions.flush()
+
+    def put_level(self, pos, level, size):
+        "Insert in cache a level decoded elsewhere (see read_level)"
+        self._level_cache.put(pos, level, size)
+
+    @property
+    def root(self):
+        return self._root
+
+    @property
+    def cache_stats(self):
+        "Dictionary of chunk cache counters (hits, misses, evictions, size, count)"
+        return self._level_cache.stats
+
     def use_region(self, rx, rz):
-        if rx != self._region_rx or rz != self._region_rz:
-            self._region_filename = os.path.join(self._root, "r.%d.%d.mcr" % (rx, rz))
-            print "Loading file '%s'" % self._region_filename
-
-            with open(self._region_filename, 'rb') as fd:
-                # read 8kib header
-                locations = fd.read(4096)
-                timestamps = fd.read(4096)
-
-                # decode clusters data positions and offsets
-                for offset in xrange(0, 4096, 4):
-                    value = unpack_from(">I", locations, offset)[0]
-                    chunk_offset = value >> 8
-                    count = value & 0xff
-                    # UNUSED: ts = unpack_from(">I", timestamps, offset)[0]
-
-                    # empty chunk
-                    if chunk_offset == 0 and count == 0:
-                        continue
-
-                    if chunk_offset < 2 or count == 0:
-                        print UserWarning("Invalid cluster location data: offset=%u, count=%u" % (chunk_offset, count))
-                        continue
-
-                    # Unpack chunk data
-                    fd.seek(4096*chunk_offset)
-                    level = self.unpack_level(fd)
-
-                    # Cache level
-                    pos = level['xPos'].value, level['zPos'].value
-                    self._level_cache[pos] = level
-                    try:
-                        self._pos_order.remove(pos)
-                    except:
-                        pass
-                    self._pos_order.append(pos)
-                    if len(self._pos_order) > MCR.MAX_CLUSTERS:
-                        self._pos_order.pop(0)
-                    #print "\rLoaded level %4u" % (offset/4),
-                    #sys.stdout.flush()
-            print "Done"
-
-    def unpack_level(self, fd):
-        length, compression = unpack(">IB", fd.read(5))
+        """Make sure the region is opened and return it.
 
-        if length == 0:
-            print UserWarning("Chunk has a zero data length!")
-            return
+        In non-lazy mode, all chunks of a newly opened region are decoded.
+        """
 
-        if compression not in [1, 2]:
-            print UserWarning("Chunk has unknown compression method (%u)!" % (compression))
-            return
+        opened = (rx, rz) in self._regions
+        region = self._regions.get(rx, rz)
+        if opened or self.lazy:
+            return region
 
-        # Read compressed chunk data
-        n = length - 1 # max should be 1MB
-        rawdata = fd.read(n)
+        for idx in region.iter_chunks():
+            data = region.read_chunk(idx)
+            if data is None:
+                continue
 
-        if compression == 1:
-            nbt = NBTFile(fileobj=StringIO(rawdata))
-        else:
-            nbt = NBTFile(buffer=StringIO(zlib.decompress(rawdata)))
+            # Unpack chunk data
+            level = self.unpack_level(data)
+
+            # Cache level
+            pos = level['xPos'].value, level['zPos'].value
+            self._level_cache.put(pos, level, len(data))
+            #print "\rLoaded level %4u" % (offset/4),
+            #sys.stdout.flush()
+        print "Done"
+        return region
 
-        return nbt['Level']
+    def unpack_level(self, data):
+        "Return the Level tag from uncompressed chunk data"
+        if self.full_nbt:
+            return NBTFile(buffer=StringIO(data))['Level']
+        return scan_level(data)
 
     def __contains__(self, pos):
-        return pos in self._pos_order
+        return pos in self._level_cache
 
 
 class LevelDat(object):
@@ -0,0 +1,165 @@
+# This file is part of NoCurve.
+#
+#    NoCurve is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    NoCurve is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with NoCurve.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Streaming extraction of chunk NBT tags.
+
+Building a complete NBT tree for each chunk is the main loading cost,
+whereas the engine only needs few tags of the Level compound.
+scan_level() walks the uncompressed chunk data once, returns the wanted tags
+and skips all others (Entities, TileEntities, ...) without building objects.
+Byte arrays are returned as buffer objects on the given data (no copy).
+"""
+
+from struct import unpack_from
+
+__all__ = ['LEVEL_TAGS', 'Tag', 'Level', 'scan_level']
+
+TAG_END = 0
+TAG_BYTE = 1
+TAG_SHORT = 2
+TAG_INT = 3
+TAG_LONG = 4
+TAG_FLOAT = 5
+TAG_DOUBLE = 6
+TAG_BYTE_ARRAY = 7
+TAG_STRING = 8
+TAG_LIST = 9
+TAG_COMPOUND = 10
+TAG_INT_ARRAY = 11
+
+# Fixed payload size per tag type
+_SCALARS = {
+    TAG_BYTE: (1, '>b'),
+    TAG_SHORT: (2, '>h'),
+    TAG_INT: (4, '>i'),
+    TAG_LONG: (8, '>q'),
+    TAG_FLOAT: (4, '>f'),
+    TAG_DOUBLE: (8, '>d'),
+}
+
+LEVEL_TAGS = frozenset(['xPos', 'zPos', 'Blocks', 'Data', 'HeightMap',
+                        'SkyLight', 'BlockLight', 'LastUpdate', 'TerrainPopulated'])
+
+
+class Tag(object):
+    "Scanned tag, mimics NBT objects by its value attribute"
+
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return "Tag(%r)" % (self.value,)
+
+
+class Level(dict):
+    "Dictionary of scanned Level tags (name -> Tag)"
+    pass
+
+
+def _read_name(data, off):
+    n = unpack_from('>H', data, off)[0]
+    off += 2
+    return data[off:off+n], off + n
+
+def _skip(data, off, tagtype):
+    "Return the offset after a payload of given type starting at off"
+
+    if tagtype in _SCALARS:
+        return off + _SCALARS[tagtype][0]
+
+    if tagtype == TAG_BYTE_ARRAY:
+        return off + 4 + unpack_from('>i', data, off)[0]
+
+    if tagtype == TAG_STRING:
+        return off + 2 + unpack_from('>H', data, off)[0]
+
+    if tagtype == TAG_INT_ARRAY:
+        return off + 4 + 4 * unpack_from('>i', data, off)[0]
+
+    if tagtype == TAG_LIST:
+        subtype, count = unpack_from('>bi', data, off)
+        off += 5
+        if subtype in _SCALARS:
+            return off + count * _SCALARS[subtype][0]
+        for _ in xrange(count):
+            off = _skip(data, off, subtype)
+        return off
+
+    if tagtype == TAG_COMPOUND:
+        while True:
+            subtype = ord(data[off])
+            off += 1
+            if subtype == TAG_END:
+                return off
+            off = _skip(data, off + 2 + unpack_from('>H', data, off)[0], subtype)
+
+    raise ValueError("unknown NBT tag type %u" % tagtype)
+
+def _read_payload(data, off, tagtype):
+    "Return (value, next offset) of a scalar, string or byte array payload"
+
+    if tagtype in _SCALARS:
+        size, fmt = _SCALARS[tagtype]
+        return unpack_from(fmt, data, off)[0], off + size
+
+    if tagtype == TAG_BYTE_ARRAY:
+        n = unpack_from('>i', data, off)[0]
+        off += 4
+        return buffer(data, off, n), off + n
+
+    if tagtype == TAG_STRING:
+        return _read_name(data, off)
+
+    return None, _skip(data, off, tagtype)
+
+def scan_level(data, tags=LEVEL_TAGS):
+    """Return a Level dictionary with the wanted tags of a chunk.
+
+    data is the uncompressed chunk NBT data (string or buffer).
+    Compound and list tags are never decoded, only skipped.
+    Raise ValueError if the data doesn't contain a Level compound.
+    """
+
+    # Root compound
+    if ord(data[0]) != TAG_COMPOUND:
+        raise ValueError("chunk data doesn't start with a compound tag")
+    _, off = _read_name(data, 1)
+
+    # Search the Level compound
+    while True:
+        tagtype = ord(data[off])
+        off += 1
+        if tagtype == TAG_END:
+            raise ValueError("no Level tag found in chunk data")
+        name, off = _read_name(data, off)
+        if tagtype == TAG_COMPOUND and name == 'Level':
+            break
+        off = _skip(data, off, tagtype)
+
+    # Scan Level content
+    level = Level()
+    while True:
+        tagtype = ord(data[off])
+        off += 1
+        if tagtype == TAG_END:
+            return level
+        name, off = _read_name(data, off)
+        if name in tags:
+            value, off = _read_payload(data, off, tagtype)
+            level[name] = Tag(value)
+        else:
+            off = _skip(data, off, tagtype)
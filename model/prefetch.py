@@ -0,0 +1,166 @@
+# This file is part of NoCurve.
+#
+#    NoCurve is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    NoCurve is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with NoCurve.  If not, see <http://www.gnu.org/licenses/>.
+
+from threading import Thread, Condition
+from Queue import Queue, Empty
+from math import hypot
+
+import mcr
+
+
+class ChunkPrefetcher(object):
+    """Read chunks ahead around a position using background threads.
+
+    Worker threads uncompress and decode chunks with their own region files,
+    the owner thread gets finished chunks back by calling poll(), which
+    inserts them into the MCR cache.
+
+    Pending chunks are ordered by distance to the position given to update(),
+    chunks in the motion direction coming first.
+    If a WorldIndex is given, chunks absent from it are never requested.
+    Chunks that couldn't be read are requested again once the center moves.
+    """
+
+    RADIUS = 6 # in chunks
+    AHEAD_FACTOR = 0.5 # 0: only distance matters, 1: chunks behind are delayed up to twice the distance
+
+    def __init__(self, mcr_cache, radius=RADIUS, workers=1, index=None):
+        self._mcr = mcr_cache
+        self._index = index
+        self.radius = radius
+        self._workers = workers
+        self._threads = []
+        self._cond = Condition()
+        self._pending = [] # positions, most urgent at the end
+        self._running = set() # positions being decoded
+        self._missings = set() # positions without chunk
+        self._done = Queue() # (pos, level, size), level is None for missings, size too for errors
+        self._center = None
+        self._alive = False
+
+    def start(self):
+        self._alive = True
+        for i in xrange(self._workers):
+            t = Thread(target=self._worker, name="ChunkPrefetcher-%u" % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        with self._cond:
+            self._alive = False
+            del self._pending[:]
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        del self._threads[:]
+
+    def update(self, x, z, dx=0., dz=0.):
+        """Set the prefetch center (in block coordinates) and motion vector.
+
+        Pending requests are replaced by chunks around the new center
+        that are not cached yet.
+        """
+
+        cx = int(x) >> 4
+        cz = int(z) >> 4
+        d = hypot(dx, dz)
+        if d:
+            dx /= d
+            dz /= d
+
+        # Motion heading rounded to 8 directions, enough to order chunks
+        center = cx, cz, int(round(dx)), int(round(dz))
+        if center == self._center:
+            return
+        self._center = center
+
+        r = self.radius
+        cache = self._mcr
+        index = self._index
+        wanted = []
+        for pz in xrange(cz - r, cz + r + 1):
+            for px in xrange(cx - r, cx + r + 1):
+                pos = px, pz
+                if pos in cache or pos in self._missings:
+                    continue
+                if index is not None and pos not in index:
+                    continue
+                ox = px - cx
+                oz = pz - cz
+                dist = hypot(ox, oz)
+                if dist > r:
+                    continue
+                if dist:
+                    dist *= 1. - self.AHEAD_FACTOR * (ox*dx + oz*dz) / dist
+                wanted.append((dist, pos))
+
+        wanted.sort(reverse=True)
+
+        with self._cond:
+            self._pending[:] = [pos for _, pos in wanted if pos not in self._running]
+            self._cond.notify_all()
+
+    def poll(self, max_count=None):
+        """Insert decoded chunks into the MCR cache.
+
+        Must be called from the thread owning the MCR object.
+        Return the list of inserted chunk positions.
+        """
+
+        loaded = []
+        while max_count is None or len(loaded) < max_count:
+            try:
+                pos, level, size = self._done.get_nowait()
+            except Empty:
+                break
+
+            if level is None:
+                # read errors may be transient, not recorded
+                if size is not None:
+                    self._missings.add(pos)
+            else:
+                self._mcr.put_level(pos, level, size)
+                loaded.append(pos)
+
+        return loaded
+
+    def _worker(self):
+        regions = mcr.RegionPool(self._mcr.root)
+        try:
+            while True:
+                with self._cond:
+                    while self._alive and not self._pending:
+                        self._cond.wait()
+                    if not self._alive:
+                        return
+                    pos = self._pending.pop()
+                    self._running.add(pos)
+
+                try:
+                    region = regions.get(pos[0] >> 5, pos[1] >> 5)
+                    level, size = self._mcr.read_level(region, *pos)
+                except KeyError:
+                    level, size = None, 0
+                except Exception:
+                    # unreadable (corrupted chunk or region, being written...)
+                    level, size = None, None
+                finally:
+                    with self._cond:
+                        self._running.discard(pos)
+
+                self._done.put((pos, level, size))
+        finally:
+            regions.clear()
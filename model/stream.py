@@ -0,0 +1,152 @@
+# This file is part of NoCurve.
+#
+#    NoCurve is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    NoCurve is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with NoCurve.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Streaming import of MCR chunks into a lowlevel.Map.
+
+Chunks go through stages: read -> decode -> add_blocks -> occlusion -> meshing.
+Each chunk is fully processed before the next one, in distance order from
+a center, so nearest terrain is displayed first. Meshing also rebuilds
+neighbour cells whose faces are changed by the new chunk. Work is done by
+steps bounded in time, to be called once per frame.
+"""
+
+from math import hypot
+from time import time
+
+import lowlevel
+
+__all__ = ['chunks_by_distance', 'WorldStreamer']
+
+# per block 4-bit arrays kept by the map, in Map.add_blocks() order
+NIBBLE_ARRAYS = ('Data', 'SkyLight', 'BlockLight')
+
+
+def chunks_by_distance(cx, cz, radius, index=None):
+    """Yield chunk positions in a radius around (cx, cz), nearest first.
+
+    If a WorldIndex is given, only existing chunks are yielded.
+    """
+
+    positions = []
+    for pz in xrange(cz - radius, cz + radius + 1):
+        for px in xrange(cx - radius, cx + radius + 1):
+            d = hypot(px - cx, pz - cz)
+            if d <= radius:
+                positions.append((d, (px, pz)))
+    positions.sort()
+
+    for _, pos in positions:
+        if index is None or pos in index:
+            yield pos
+
+
+class WorldStreamer(object):
+    """Feed a map with chunks given by a positions iterator.
+
+    Positions are in world chunk coordinates. Chunks out of the map window
+    are ignored, see retarget() to follow a recentered window.
+    """
+
+    STEP_BUDGET = 0.008 # seconds of work per step
+    MESH_CELLS = 8 # cells meshed per stage and meshing thread
+
+    def __init__(self, map, get_level, positions):
+        self._map = map
+        self._get_level = get_level
+        self._positions = iter(positions)
+        self._pipeline = self._stages()
+        self.loaded = 0
+        self.done = False
+
+    def retarget(self, positions):
+        """Replace chunks still to import.
+
+        The chunk in progress is finished if it's still in the map window.
+        """
+
+        self._positions = iter(positions)
+        if self.done:
+            self._pipeline = self._stages()
+            self.done = False
+
+    def _read(self, cx, cz):
+        # read and decode stages (both done by MCR)
+        try:
+            return self._get_level(cx << 4, cz << 4)
+        except KeyError:
+            return
+
+    def _stages(self):
+        map = self._map
+
+        while True:
+            try:
+                cx, cz = self._positions.next()
+            except StopIteration:
+                return
+
+            if not map.in_window(cx, cz) or map.has_cluster(cx, cz):
+                continue
+
+            level = self._read(cx, cz)
+            if level is None:
+                continue
+            yield
+
+            # the window may have moved between stages
+            if not map.in_window(cx, cz):
+                continue
+
+            nibbles = [level[name].value if name in level else None
+                       for name in NIBBLE_ARRAYS]
+            for idx in map.add_blocks(level['Blocks'].value, cx, cz, *nibbles):
+                map.new_mesh(idx)
+            yield
+
+            if not map.has_cluster(cx, cz):
+                continue
+
+            map.do_occlusion()
+            yield
+
+            while map.rebuild_dirty(self.MESH_CELLS * (map.mesh_threads + 1))[0]:
+                yield
+
+            if map.has_cluster(cx, cz):
+                self.loaded += 1
+
+    def step(self, budget=STEP_BUDGET):
+        """Run pipeline stages until budget seconds are elapsed.
+
+        At least one stage is run. Return False when all chunks are done.
+        """
+
+        if self.done:
+            return False
+
+        end = time() + budget
+        try:
+            self._pipeline.next()
+            while time() < end:
+                self._pipeline.next()
+        except StopIteration:
+            self.done = True
+        return not self.done
+
+    def run(self):
+        "Process all chunks at once"
+        for _ in self._pipeline:
+            pass
+        self.done = True
@@ -0,0 +1,260 @@
+# This file is part of NoCurve.
+#
+#    NoCurve is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    NoCurve is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with NoCurve.  If not, see <http://www.gnu.org/licenses/>.
+
+"""World-wide chunks index.
+
+All region files of a world are scanned once (in parallel), recording for
+each chunk its compressed size and timestamp. The result is saved in a
+compact index file, then world bounds, chunks lists and chunk existence
+are known without opening any region.
+
+Index file format (little endian, arrays are swapped on big endian hosts):
+
+  header : 'NCWI', version, regions count (uint32)
+  region : rx, rz (int32), then 1024 compressed sizes and 1024 timestamps (uint32).
+           A null size means no chunk.
+
+Usage as a tool: python worldindex.py <world directory>
+"""
+
+import os
+import re
+import sys
+import glob
+
+from array import array
+from struct import Struct, unpack_from, error as StructError
+
+import mcr
+
+__all__ = ['scan_region', 'WorldIndex']
+
+MAGIC = 'NCWI'
+VERSION = 1
+INDEX_FILENAME = 'nocurve.idx'
+
+_HEADER = Struct('<4sII')
+_REGION = Struct('<ii')
+_REGION_RE = re.compile(r'r\.(-?\d+)\.(-?\d+)\.mcr$')
+_SWAP = sys.byteorder == 'big'
+
+
+def scan_region(filename):
+    """Return (rx, rz, sizes, timestamps) of a region file.
+
+    sizes and timestamps are arrays of 1024 items indexed like the region header,
+    sizes are compressed chunk lengths (0 if the chunk doesn't exist).
+    Only the header and chunks length fields are read. Unreadable, empty
+    or truncated regions have no chunks.
+    """
+
+    m = _REGION_RE.search(filename)
+    rx, rz = int(m.group(1)), int(m.group(2))
+    sizes = array('I', [0] * mcr.CHUNKS_PER_REGION)
+    timestamps = array('I', [0] * mcr.CHUNKS_PER_REGION)
+
+    try:
+        region = mcr.RegionFile(filename)
+    except (EnvironmentError, ValueError):
+        return rx, rz, sizes, timestamps
+
+    with region:
+        for idx in region.iter_chunks():
+            value = region.locations[idx]
+            offset = (value >> 8) * mcr.SECTOR_SIZE
+            if offset < 2*mcr.SECTOR_SIZE or offset + 4 > len(region._map):
+                continue
+            sizes[idx] = unpack_from(">I", region._map, offset)[0]
+            timestamps[idx] = region.timestamps[idx]
+
+    return rx, rz, sizes, timestamps
+
+
+class WorldIndex(object):
+    """Chunks presence, size and timestamp for a whole world.
+
+    Chunks positions are given in chunk coordinates.
+    """
+
+    def __init__(self):
+        self._regions = {} # (rx, rz) -> (sizes, timestamps)
+        self.bounds = None # (min_cx, min_cz, max_cx, max_cz) or None if empty
+
+    @classmethod
+    def build(cls, region_dir, processes=None):
+        """Scan all region files of a directory.
+
+        Files are scanned by a pool of processes (one per CPU by default),
+        set processes to 1 to scan them in the current process.
+        """
+
+        filenames = glob.glob(os.path.join(region_dir, 'r.*.*.mcr'))
+        if processes == 1 or len(filenames) < 2:
+            results = map(scan_region, filenames)
+        else:
+            from multiprocessing import Pool
+            pool = Pool(processes)
+            try:
+                results = pool.map(scan_region, filenames)
+            finally:
+                pool.close()
+                pool.join()
+
+        index = cls()
+        for rx, rz, sizes, timestamps in results:
+            index._regions[rx, rz] = sizes, timestamps
+        index._update_bounds()
+        return index
+
+    @classmethod
+    def load(cls, filename):
+        index = cls()
+        with open(filename, 'rb') as fd:
+            magic, version, count = _HEADER.unpack(fd.read(_HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise IOError("'%s' is not a supported index file" % filename)
+            for _ in xrange(count):
+                rx, rz = _REGION.unpack(fd.read(_REGION.size))
+                sizes = array('I')
+                sizes.fromfile(fd, mcr.CHUNKS_PER_REGION)
+                timestamps = array('I')
+                timestamps.fromfile(fd, mcr.CHUNKS_PER_REGION)
+                if _SWAP:
+                    sizes.byteswap()
+                    timestamps.byteswap()
+                index._regions[rx, rz] = sizes, timestamps
+        index._update_bounds()
+        return index
+
+    @classmethod
+    def open(cls, root, processes=None):
+        """Return the index of a world directory.
+
+        The saved index is used if it's newer than all region files,
+        else it's rebuilt and saved.
+        """
+
+        filename = os.path.join(root, INDEX_FILENAME)
+        region_dir = os.path.join(root, 'region')
+
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            mtime = None
+
+        if mtime is not None:
+            regions = glob.glob(os.path.join(region_dir, 'r.*.*.mcr'))
+            if all(os.path.getmtime(x) <= mtime for x in regions):
+                try:
+                    return cls.load(filename)
+                except (IOError, EOFError, StructError):
+                    pass
+
+        index = cls.build(region_dir, processes)
+        index.save(filename)
+        return index
+
+    def save(self, filename):
+        with open(filename, 'wb') as fd:
+            fd.write(_HEADER.pack(MAGIC, VERSION, len(self._regions)))
+            for (rx, rz), (sizes, timestamps) in sorted(self._regions.iteritems()):
+                fd.write(_REGION.pack(rx, rz))
+                for values in (sizes, timestamps):
+                    if _SWAP:
+                        values = array('I', values)
+                        values.byteswap()
+                    values.tofile(fd)
+
+    def _update_bounds(self):
+        xs = []
+        zs = []
+        for (rx, rz), (sizes, _) in self._regions.iteritems():
+            for idx, size in enumerate(sizes):
+                if size:
+                    xs.append((rx << 5) + (idx & 31))
+                    zs.append((rz << 5) + (idx >> 5))
+        if xs:
+            self.bounds = min(xs), min(zs), max(xs), max(zs)
+        else:
+            self.bounds = None
+
+    def chunk_info(self, cx, cz):
+        "Return (compressed size, timestamp) of a chunk, or None if it doesn't exist"
+        entry = self._regions.get((cx >> 5, cz >> 5))
+        if entry is not None:
+            idx = (cx & 31) + (cz & 31) * 32
+            size = entry[0][idx]
+            if size:
+                return size, entry[1][idx]
+
+    def set_chunk(self, cx, cz, size, timestamp):
+        "Record a chunk stored after the index was built (see MCR.save_chunk)"
+        entry = self._regions.get((cx >> 5, cz >> 5))
+        if entry is None:
+            entry = (array('I', [0] * mcr.CHUNKS_PER_REGION),
+                     array('I', [0] * mcr.CHUNKS_PER_REGION))
+            self._regions[cx >> 5, cz >> 5] = entry
+        idx = (cx & 31) + (cz & 31) * 32
+        entry[0][idx] = size
+        entry[1][idx] = timestamp
+
+        if size:
+            if self.bounds is None:
+                self.bounds = cx, cz, cx, cz
+            else:
+                x0, z0, x1, z1 = self.bounds
+                self.bounds = min(x0, cx), min(z0, cz), max(x1, cx), max(z1, cz)
+
+    def __contains__(self, pos):
+        return self.chunk_info(*pos) is not None
+
+    def __len__(self):
+        return sum(len(sizes) - sizes.count(0) for sizes, _ in self._regions.itervalues())
+
+    def regions(self):
+        return sorted(self._regions)
+
+    def chunks(self):
+        "Yield positions of all existing chunks"
+        for (rx, rz), (sizes, _) in self._regions.iteritems():
+            for idx, size in enumerate(sizes):
+                if size:
+                    yield (rx << 5) + (idx & 31), (rz << 5) + (idx >> 5)
+
+    def chunks_around(self, cx, cz, radius):
+        "Return existing chunks positions in a radius, nearest first"
+        from stream import chunks_by_distance # needs lowlevel, not the index tool
+        return list(chunks_by_distance(cx, cz, radius, self))
+
+
+if __name__ == "__main__":
+    import sys
+    from optparse import OptionParser
+    from time import time
+
+    parser = OptionParser(usage="%prog [options] <world directory>")
+    parser.add_option("-j", "--processes", type="int", dest="processes", default=None)
+    parser.add_option("-o", "--output", action="store", type="string", dest="output")
+
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("world directory required")
+
+    root = args[0]
+    t = time()
+    index = WorldIndex.build(os.path.join(root, 'region'), opts.processes)
+    index.save(opts.output or os.path.join(root, INDEX_FILENAME))
+    print "%u regions, %u chunks, bounds=%s (%.2fs)" % (len(index.regions()), len(index),
+                                                          index.bounds, time() - t)
@@ -8,7 +8,7 @@ if os.name == 'morphos':
     link_opt = ['GL', 'GLU', 'GLUT', 'm', 'syscall', 'debug' ]
 elif os.name == 'posix':
     defines = []
-    link_opt = ['GL', 'GLU']
+    link_opt = ['GL', 'GLU', 'pthread']
 
 link_opt = ['-l'+x for x in link_opt]
 
@@ -45,6 +45,13 @@
 
 #include <stdint.h>
 
+#ifndef __MORPHOS__
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <pthread.h>
+#endif
+
 #include "cluster.h"
 #include "meshes.h"
 
@@ -127,18 +134,17 @@
 
 #define MAX_RENDERED_FACES 20000 //INT_MAX /* unlimited */
 
-#define MAP_CELL(cells, x, y, z)							\
-	((cells) [(x)>>WORLD_CLUSTER_X_SHIFT]					\
-	 [(z)>>WORLD_CLUSTER_Z_SHIFT]							\
-	 [(y)/BLOCK_PER_CELL_Y])
-#define MAP_BLOCK_INFO(cells, x, y, z)						\
-	(MAP_CELL(cells, x, y, z).blocks_info					\
-	 [(x) & CLUSTER_SIZE_X_MASK]							\
-	 [(z) & CLUSTER_SIZE_Z_MASK]							\
-	 [(y) & (BLOCK_PER_CELL_Y-1)])
-#define MAP_BLOCK_ID(cells, x, y, z) MAP_BLOCK_INFO(cells, x, y, z).id
-#define MAP_BLOCK_OCCLUSION(cells, x, y, z)	(MAP_BLOCK_INFO(cells, x, y, z).occlusion)
-#define MAP_BLOCK_SET_OCCLUSION(cells, x, y, z, f) (MAP_BLOCK_OCCLUSION(cells, x, y, z) |= (1<<(f)))
+/* The map keeps a window of WORLD_CLUSTER_X*WORLD_CLUSTER_Z clusters around
+ * a center cluster. Columns of loaded clusters are allocated on demand
+ * and found through a hash table keyed by cluster coordinates.
+ */
+#define MAP_MIN_BUCKETS 64
+#define MAP_HASH(cx, cz) (((uint32_t)(cx) * 73856093u) ^ ((uint32_t)(cz) * 19349663u))
+#define CELL_BLOCKS (CLUSTER_SIZE_X*CLUSTER_SIZE_Z*BLOCK_PER_CELL_Y)
+#define CELL_IS_UNIFORM(c) (!(c)->data && !(c)->packed)
+#define OPPOSITE_FACE(f) ((f) ^ 1)
+#define FULL_OCCLUSION 0x3f
+#define MAX_MESH_THREADS 16
 
 /*==== New types and definitions =============================================*/
 
@@ -154,6 +160,16 @@ enum {
     FACE_REAR,
 };
 
+/* Neighbour block offset per face */
+static const int face_offsets[6][3] = {
+	[FACE_BOTTOM] = { 0, -1,  0},
+	[FACE_TOP]    = { 0,  1,  0},
+	[FACE_RIGHT]  = {-1,  0,  0},
+	[FACE_LEFT]   = { 1,  0,  0},
+	[FACE_FRONT]  = { 0,  0,  1},
+	[FACE_REAR]   = { 0,  0, -1},
+};
+
 typedef GLfloat VertexColors[4];
 
 typedef enum MeshType {
@@ -227,14 +243,101 @@ typedef struct RenderCell {
 	unsigned allocated_faces;
 } RenderCell;
 
+/* Per block data layers of a cell */
+enum {
+	LAYER_IDS=0,
+	LAYER_DATA,							/* block metadata */
+	LAYER_SKYLIGHT,
+	LAYER_BLOCKLIGHT,
+};
+
+#define NIBBLE_LAYERS 3
+#define NIBBLE_INDEX(layer) ((layer) - LAYER_DATA)
+
+/* Blocks storage of a cell, in X.Z.Y order.
+ * Nibble layers are packed as in chunk NBT: 2 blocks per byte, even Y in low bits.
+ * Shared between the cell and its buffer views (refcounted).
+ */
+typedef struct CellData {
+	unsigned int refcount;
+	uint8_t ids[CLUSTER_SIZE_X][CLUSTER_SIZE_Z][BLOCK_PER_CELL_Y];
+	uint8_t nibbles[NIBBLE_LAYERS][CLUSTER_SIZE_X][CLUSTER_SIZE_Z][BLOCK_PER_CELL_Y/2];
+	uint8_t occlusion[CLUSTER_SIZE_X][CLUSTER_SIZE_Z][BLOCK_PER_CELL_Y];
+} CellData;
+
+/* Palette storage of a cell (compact mode).
+ * Blocks are indices in a palette of ids, packed on bits per block
+ * (1, 2, 4 or 8) in X.Z.Y order. Nibble layers are NULL when uniform,
+ * values given by MapCell.uniform_nibbles. Occlusion is not stored.
+ */
+typedef struct PackedCell {
+	uint8_t bits;
+	uint16_t count;						/* palette entries */
+	uint8_t *palette;
+	uint8_t *indices;
+	uint8_t *nibbles[NIBBLE_LAYERS];
+} PackedCell;
+
+#define CELL_INDEX(x, y, z) \
+	((((x) & CLUSTER_SIZE_X_MASK) * CLUSTER_SIZE_Z + ((z) & CLUSTER_SIZE_Z_MASK)) * BLOCK_PER_CELL_Y + \
+	 ((y) & (BLOCK_PER_CELL_Y-1)))
+
+/* Axis aligned box of blocks, max bounds excluded */
+typedef struct BlockBox {
+	int x0, y0, z0;
+	int x1, y1, z1;
+} BlockBox;
+
+/* Consecutive faces of MapCell.greedy_faces using the same tile texture */
+typedef struct TileRun {
+	uint16_t tile;
+	uint16_t count;
+} TileRun;
+
+/* Faces of a cell, built apart then set by _set_cell_faces() */
+typedef struct CellFaces {
+	RenderCell static_faces;
+	RenderCell blend_faces;
+	RenderCell greedy_faces;
+	TileRun *tile_runs;
+	unsigned int run_count;
+	unsigned int merged;
+	int nomem;							/* some faces are missing */
+} CellFaces;
+
+/* MapCell.dirty flags */
+#define DIRTY_OCCLUSION (1 << 0)			/* stored occlusion of dirty_box blocks is outdated */
+#define DIRTY_FACES (1 << 1)				/* render cells are outdated */
+
+/* Cells filled by only one block id (air, stone, ...) with uniform metadata
+ * and light are uniform: data and packed are NULL and values are given by
+ * uniform_id and uniform_nibbles. Storage is allocated on first edit by a
+ * different id. A cell never has both data and packed storages.
+ */
 typedef struct MapCell {
 	RenderCell static_faces;
 	RenderCell blend_faces;
-	BlockInfo blocks_info[CLUSTER_SIZE_X][CLUSTER_SIZE_Z][BLOCK_PER_CELL_Y];
+	RenderCell greedy_faces;			/* merged faces, sorted by tile */
+	TileRun *tile_runs;
+	unsigned int run_count;
+	unsigned int merged;				/* block faces replaced by greedy_faces */
+	CellData *data;
+	PackedCell *packed;
 	BSphere bsphere;
+	uint8_t uniform_id;
+	uint8_t uniform_nibbles[NIBBLE_LAYERS];
 	uint8_t render;
+	uint8_t dirty;						/* DIRTY_xxx flags */
+	BlockBox dirty_box;					/* changed blocks since last occlusion update, cell coordinates */
 } MapCell;
 
+typedef struct MapColumn {
+	struct MapColumn *next, *previous;	/* loaded columns list */
+	struct MapColumn *hash_next;		/* next column in the same hash bucket */
+	int cx, cz;							/* cluster position in the world */
+	MapCell cells[MAX_RENDER_CELLS];
+} MapColumn;
+
 static GLfloat fog_planes[32*4*3];
 
 #ifdef __MORPHOS__
@@ -277,9 +380,26 @@ typedef struct PyMapObject_STRUCT
 {
 	PyObject_HEAD
 	PyMeshObject *meshes[256];
-	MapCell cells[WORLD_CLUSTER_X][WORLD_CLUSTER_Z][MAX_RENDER_CELLS];
+	MapColumn *columns;					/* loaded columns list */
+	MapColumn **buckets;				/* columns hash table */
+	unsigned int bucket_mask;			/* hash table size - 1 */
+	unsigned int column_count;
+	unsigned int dirty_count;			/* number of dirty cells */
+	unsigned long face_count;			/* faces in all render cells */
+	unsigned long greedy_count;			/* merged faces in all render cells */
+	unsigned long merged_count;			/* block faces replaced by merged ones */
+	GLuint *tile_texids;				/* per tile textures of the greedy mesher */
+	int tile_columns, tile_rows;
+	int center_cx, center_cz;			/* window center, in clusters */
     RenderingStats stats;
 	char fog_enabled;
+	uint8_t compact;					/* store loaded cells in palette form */
+	uint8_t greedy;						/* merge coplanar faces of opaque cubes */
+	uint8_t occlusion_masks;			/* update whole columns occlusion with bitmasks */
+	uint8_t mesh_threads;				/* meshing threads besides the main one */
+#ifndef __MORPHOS__
+	struct MeshPool *mesh_pool;			/* running meshing threads */
+#endif
 } PyMapObject;
 
 /* Camera object */
@@ -304,9 +424,20 @@ typedef struct PyCameraObject_STRUCT
 	int dirty:1;
 } PyCameraObject;
 
+/* Buffer view on a data layer of a map's cell */
+typedef struct PyCellBufferObject_STRUCT
+{
+	PyObject_HEAD
+	CellData *data;
+	uint8_t *buf;
+	Py_ssize_t len;
+	int cx, cy, cz, layer;
+} PyCellBufferObject;
+
 static PyTypeObject PyMeshObject_Type;
 static PyTypeObject PyMapObject_Type;
 static PyTypeObject PyCameraObject_Type;
+static PyTypeObject PyCellBufferObject_Type;
 
 /*==== Internal routines =====================================================*/
 
@@ -655,35 +786,43 @@ static void _camera_update(PyCameraObject *camera)
 	camera->dirty = 1;
 }
 
-static int _add_face(RenderCell *cell, PyMeshObject *mesh, int face_id,
-					 unsigned x, unsigned y, unsigned z)
+/* Return a new face at the end of a render cell, NULL if no memory.
+ * No Python exception is set: called by meshing threads.
+ */
+static RenderFaceData * _alloc_face(RenderCell *cell)
 {
-    int i;
-
     /* allocations are done by bunch of 16 faces */
     if (cell->count == cell->allocated_faces) {
+        RenderFaceData *faces = realloc(cell->faces, (cell->allocated_faces + 16) * sizeof(*cell->faces));
+        if (!faces)
+            return NULL;
+        cell->faces = faces;
         cell->allocated_faces += 16;
-        cell->faces = realloc(cell->faces, cell->allocated_faces * sizeof(*cell->faces));
-        if (!cell->faces) {
-            PyErr_NoMemory();
-            return -1;
-        }
     }
 
-    RenderFaceData *face = &cell->faces[cell->count++];
+    return &cell->faces[cell->count++];
+}
+
+/* Per face lighting */
+static float _get_face_light(PyMeshObject *mesh, int face_id)
+{
+    if ((mesh->type == MESH_CUBE) && (face_id == FACE_LEFT || face_id == FACE_RIGHT))
+        return 0.5;
+    return 0.8;
+}
+
+static int _add_face(RenderCell *cell, PyMeshObject *mesh, int face_id,
+					 int x, int y, int z)
+{
+    int i;
+    RenderFaceData *face = _alloc_face(cell);
     FaceData *mesh_face = &mesh->faces[face_id];
     float base_light;
 
-    /* Per face lighting */
-    if (mesh->type == MESH_CUBE)
-    {
-        if (face_id == FACE_LEFT || face_id == FACE_RIGHT)
-            base_light = 0.5;
-        else
-            base_light = 0.8;
-    }
-    else
-        base_light = 0.8;
+    if (!face)
+        return -1;
+
+    base_light = _get_face_light(mesh, face_id);
 
     /* Duplicate base faces data from mesh and adjust position and light */
     for (i=0; i < 4; i++)
@@ -701,504 +840,3768 @@ static int _add_face(RenderCell *cell, PyMeshObject *mesh, int face_id,
     return 0;
 }
 
-static void _faces_occlusion(PyMapObject *map, int fid, int fid_other,
-							 BlockInfo *bi, BlockInfo *bi_other)
+static int _in_window(PyMapObject *map, int cx, int cz)
 {
-	PyMeshObject *mesh = map->meshes[bi->id];
-	if (!mesh)
-		return;
-	PyMeshObject *mesh_other = map->meshes[bi_other->id];
-	if (!mesh_other)
-		return;
-	if ((!mesh->flags.alpha && (mesh->occlusion & (1 << fid))) ||
-		(mesh->flags.alpha && mesh_other->flags.alpha))
+	return (cx >= map->center_cx - WORLD_CLUSTER_X/2) &&
+		(cx < map->center_cx + WORLD_CLUSTER_X/2) &&
+		(cz >= map->center_cz - WORLD_CLUSTER_Z/2) &&
+		(cz < map->center_cz + WORLD_CLUSTER_Z/2);
+}
+
+/* Return the column of a loaded cluster, NULL if not loaded */
+static MapColumn * _get_column(PyMapObject *map, int cx, int cz)
+{
+	MapColumn *col = map->buckets[MAP_HASH(cx, cz) & map->bucket_mask];
+
+	for (; col; col = col->hash_next)
 	{
-		bi_other->occlusion |= 1 << fid_other;
+		if ((col->cx == cx) && (col->cz == cz))
+			return col;
 	}
+	return NULL;
 }
 
-static void _do_block_occlusion(PyMapObject *map, BlockInfo *bi,
-								unsigned x, unsigned y, unsigned z)
+/* Double the hash table size */
+static int _grow_buckets(PyMapObject *map)
 {
-	/* World's end occlusion */
-	if (y == 0)
-		bi->occlusion |= 1 << FACE_BOTTOM;
+	unsigned int mask = (map->bucket_mask << 1) | 1;
+	MapColumn **buckets, *col;
 
-	if (y == BLOCK_COUNT_Y-1)
-		bi->occlusion |= 1 << FACE_TOP;
+	buckets = calloc(mask + 1, sizeof(*buckets));
+	if (!buckets)
+	{
+		PyErr_NoMemory();
+		return -1;
+	}
 
-	if (z == 0)
-		bi->occlusion |= 1 << FACE_REAR;
+	for (col = map->columns; col; col = col->next)
+	{
+		MapColumn **bucket = &buckets[MAP_HASH(col->cx, col->cz) & mask];
+		col->hash_next = *bucket;
+		*bucket = col;
+	}
 
-	if (z == BLOCK_COUNT_Z-1)
-		bi->occlusion |= 1 << FACE_FRONT;
+	free(map->buckets);
+	map->buckets = buckets;
+	map->bucket_mask = mask;
+	return 0;
+}
 
-	if (x == 0)
-		bi->occlusion |= 1 << FACE_RIGHT;
+static inline uint8_t _packed_index(const PackedCell *packed, int i)
+{
+	const int bit = i * packed->bits;
+	return (packed->indices[bit >> 3] >> (bit & 7)) & ((1 << packed->bits) - 1);
+}
 
-	if (x == BLOCK_COUNT_X-1)
-		bi->occlusion |= 1 << FACE_LEFT;
+static inline uint8_t _cell_block_id(MapCell *cell, int x, int y, int z)
+{
+	if (cell->data)
+		return cell->data->ids[x & CLUSTER_SIZE_X_MASK][z & CLUSTER_SIZE_Z_MASK]
+			[y & (BLOCK_PER_CELL_Y-1)];
+	if (cell->packed)
+		return cell->packed->palette[_packed_index(cell->packed, CELL_INDEX(x, y, z))];
+	return cell->uniform_id;
+}
 
-	/* Per face occlusion */
-	if (y > 0)
-		_faces_occlusion(map, FACE_BOTTOM, FACE_TOP, bi,
-						 &MAP_BLOCK_INFO(map->cells,x, y-1, z));
+static inline uint8_t _cell_nibble(MapCell *cell, int layer, int x, int y, int z)
+{
+	const uint8_t *nibbles;
+	uint8_t v;
 
-	if (y < (BLOCK_COUNT_Y-1))
-		_faces_occlusion(map, FACE_TOP, FACE_BOTTOM, bi,
-						 &MAP_BLOCK_INFO(map->cells, x, y+1, z));
+	if (cell->data)
+		nibbles = &cell->data->nibbles[NIBBLE_INDEX(layer)][0][0][0];
+	else if (cell->packed && cell->packed->nibbles[NIBBLE_INDEX(layer)])
+		nibbles = cell->packed->nibbles[NIBBLE_INDEX(layer)];
+	else
+		return cell->uniform_nibbles[NIBBLE_INDEX(layer)];
 
-	if (z > 0)
-		_faces_occlusion(map, FACE_REAR, FACE_FRONT, bi,
-						 &MAP_BLOCK_INFO(map->cells, x, y, z-1));
+	v = nibbles[CELL_INDEX(x, y, z) >> 1];
+	return (y & 1) ? (v >> 4) : (v & 0xf);
+}
 
-	if (z < (BLOCK_COUNT_Z-1))
-		_faces_occlusion(map, FACE_FRONT, FACE_REAR, bi,
-						 &MAP_BLOCK_INFO(map->cells, x, y, z+1));
+/* Return the block id at world position (x, y, z), -1 if not loaded */
+static int _get_block_id(PyMapObject *map, MapColumn *col, int x, int y, int z)
+{
+	const int cx = x >> WORLD_CLUSTER_X_SHIFT;
+	const int cz = z >> WORLD_CLUSTER_Z_SHIFT;
 
-	if (x > 0)
-		_faces_occlusion(map, FACE_RIGHT, FACE_LEFT, bi,
-						 &MAP_BLOCK_INFO(map->cells, x-1, y, z));
+	/* neighbours are often in the same column */
+	if (!col || (col->cx != cx) || (col->cz != cz))
+	{
+		col = _get_column(map, cx, cz);
+		if (!col)
+			return -1;
+	}
 
-	if (x < (BLOCK_COUNT_X-1))
-		_faces_occlusion(map, FACE_LEFT, FACE_RIGHT, bi,
-						 &MAP_BLOCK_INFO(map->cells, x+1, y, z));
+	return _cell_block_id(&col->cells[y/BLOCK_PER_CELL_Y], x, y, z);
 }
 
-static void _set_block_id(PyMapObject *map, uint8_t id,
-						  unsigned x, unsigned y, unsigned z)
+static void _cell_data_decref(CellData *data)
 {
-	BlockInfo *bi = &MAP_BLOCK_INFO(map->cells, x, y, z);
-	bi->id = id;
+	if (data && !--data->refcount)
+		free(data);
 }
 
-static size_t _render_cell(RenderCell *rc, PyCameraObject *camera,
-						size_t rendered_faces)
+static void _free_packed(PackedCell *packed)
 {
-	size_t to_render = 0;
+	int i;
 
-	/* stop further rendering if max faces is reach */
-	if (rendered_faces > MAX_RENDERED_FACES)
-		return 0;
+	if (!packed)
+		return;
+	for (i = 0; i < NIBBLE_LAYERS; i++)
+		free(packed->nibbles[i]);
+	free(packed);
+}
 
-	to_render = MIN(rc->count, MAX_RENDERED_FACES - rendered_faces);
-	render_faces_array(rc->faces, to_render, 0);
+#define PACKED_INDICES_SIZE(bits) (CELL_BLOCKS * (bits) / 8)
 
-	return to_render;
-}
+/* Allocate a packed storage, palette and indices are not initialized */
+static PackedCell * _new_packed(int bits, int count)
+{
+	PackedCell *packed = malloc(sizeof(*packed) + (1 << bits) + PACKED_INDICES_SIZE(bits));
 
-/*============================================================================*/
-/*==== PyMeshObject ==========================================================*/
-/*----------------------------------------------------------------------------*/
+	if (!packed)
+		return NULL;
 
-static PyMeshObject * mesh_new(PyTypeObject *type, PyObject *args)
+	packed->bits = bits;
+	packed->count = count;
+	packed->palette = (uint8_t *)(packed + 1);
+	packed->indices = packed->palette + (1 << bits);
+	bzero(packed->nibbles, sizeof(packed->nibbles));
+	return packed;
+}
+
+/* Decode all palette indices of a packed cell as ids, in cell order */
+static void _unpack_ids(const PackedCell *packed, uint8_t *ids)
 {
-    PyMeshObject *self;
-    MeshType mesh_type;
-    Py_ssize_t texels_size, tint_rgb_size;
-    GLfloat *texels, *tint_rgb=NULL;
-    FaceData *faces;
-    int i, j, count, texid;
-    NodeFunc occ_light = NULL;
+	const int bits = packed->bits;
+	const uint8_t mask = (1 << bits) - 1;
+	int i, j;
 
-    if (!PyArg_ParseTuple(args, "Iis#|s#", &mesh_type, &texid, &texels,
-						  &texels_size, &tint_rgb, &tint_rgb_size)) /* BR */
-        return NULL;
+	if (bits == 8)
+	{
+		for (i = 0; i < CELL_BLOCKS; i++)
+			ids[i] = packed->palette[packed->indices[i]];
+		return;
+	}
 
-#define MAKE_FACES(array) \
-    count = sizeof(array) / (4*3*sizeof(typeof(array[0]))); \
-    faces = _create_faces(count, array, tint_rgb, texels, texels_size); \
+	for (i = 0; i < PACKED_INDICES_SIZE(bits); i++)
+	{
+		uint8_t v = packed->indices[i];
+		for (j = 0; j < 8; j += bits, v >>= bits)
+			*ids++ = packed->palette[v & mask];
+	}
+}
 
-#define MAKE_FACES_X(array, f) MAKE_FACES(array); occ_light = f;
+/* Give a full storage to an uniform or packed cell */
+static int _expand_cell(MapCell *cell)
+{
+	CellData *data;
+	int i;
 
-    switch (mesh_type) {
-	case MESH_EMPTY     : count=0; faces = NULL; break;
-	case MESH_CUBE      : MAKE_FACES(cube_vertices); break;
-	case MESH_CUBE2     : MAKE_FACES(cube2_vertices); break;
-	case MESH_STICKY    : MAKE_FACES(sticky_vertices); break;
-	case MESH_SLAB      : MAKE_FACES(slab_vertices); break;
-	case MESH_PLANE     : MAKE_FACES(plane_vertices); break;
-	case MESH_XPLANE    : MAKE_FACES(xplane_vertices); break;
-	case MESH_CROSS     : MAKE_FACES(cross_vertices); break;
-	case MESH_TORCH     : MAKE_FACES(torch_vertices); break;
-	case MESH_STAIRS    : MAKE_FACES(stairs_vertices); break;
-	case MESH_LEVER     : MAKE_FACES(lever_vertices); break;
-	case MESH_PANE: // like a cube but scaled in one axis
-		MAKE_FACES(cube_vertices);
-		// FIXME: scaling is wrong
-		/* rescale all faces */
-		for (i=0; i < count; i++) {
-			/* Loop on vertices */
-			for (j=0; j < 4; j++) {
-				faces[i].points[j].vertices[2] *= 2*TEXEL_OFF;
-			}
-		}
-		break;
-	default:
-		return (void *)PyErr_Format(PyExc_ValueError,
-									"unknown mesh type %u",
-									mesh_type);
-    }
+	data = malloc(sizeof(*data));
+	if (!data)
+	{
+		PyErr_NoMemory();
+		return -1;
+	}
 
-    if ((mesh_type != MESH_EMPTY) && !faces)
-        return NULL;
+	data->refcount = 1;
+	if (cell->packed)
+		_unpack_ids(cell->packed, &data->ids[0][0][0]);
+	else
+		memset(data->ids, cell->uniform_id, sizeof(data->ids));
+	for (i = 0; i < NIBBLE_LAYERS; i++)
+	{
+		if (cell->packed && cell->packed->nibbles[i])
+			memcpy(data->nibbles[i], cell->packed->nibbles[i], sizeof(data->nibbles[i]));
+		else
+			memset(data->nibbles[i], cell->uniform_nibbles[i] * 0x11, sizeof(data->nibbles[i]));
+	}
+	bzero(data->occlusion, sizeof(data->occlusion));
 
-    self = (PyMeshObject *)type->tp_alloc(type, 0); /* NR */
-    if (NULL != self)
-    {
-        self->faces = faces;
-        self->type = mesh_type;
-        self->count = count;
-        self->flags.translucent = 0;
-        self->flags.alpha = 0;
-        self->flags.ao = 1;
-        self->flags.level = 0;
-        self->texid = texid;
-        self->occlusion_and_lighting = occ_light;
-		self->occlusion = 0;
-    }
+	_free_packed(cell->packed);
+	cell->packed = NULL;
+	cell->data = data;
+	return 0;
+}
 
-    return self;
+/* Drop the storage of a cell, filled by the given id and nibble values */
+static void _set_cell_uniform(MapCell *cell, uint8_t id, const uint8_t *nibbles)
+{
+	_cell_data_decref(cell->data);
+	_free_packed(cell->packed);
+	cell->data = NULL;
+	cell->packed = NULL;
+	cell->uniform_id = id;
+	memcpy(cell->uniform_nibbles, nibbles, sizeof(cell->uniform_nibbles));
 }
 
-static void mesh_dealloc(PyMeshObject *self)
+/* Return true if a cell nibble layer has only one value, set in value */
+static int _is_nibble_layer_uniform(const uint8_t *nibbles, uint8_t *value)
 {
-    if (self->faces)
-        PyMem_Free(self->faces);
+	const uint8_t v = nibbles[0];
+	int i;
 
-    ((PyObject *)self)->ob_type->tp_free((PyObject *)self);
+	if ((v >> 4) != (v & 0xf))
+		return 0;
+	for (i = 1; i < CELL_BLOCKS/2; i++)
+	{
+		if (nibbles[i] != v)
+			return 0;
+	}
+
+	*value = v & 0xf;
+	return 1;
 }
 
-static PyObject * mesh_get_flags(PyMeshObject *self, void *enclosure)
+/* Return true if all cell nibble layers are uniform, values are set in nibbles */
+static int _get_uniform_nibbles(MapCell *cell, uint8_t *nibbles)
 {
-    unsigned int shift = (Py_uintptr_t)enclosure;
+	int i;
 
-    if (*((unsigned int *)&self->flags) & (1 << shift))
-        Py_RETURN_TRUE;
-    Py_RETURN_FALSE;
+	if (!cell->data)
+	{
+		for (i = 0; i < NIBBLE_LAYERS; i++)
+		{
+			if (cell->packed && cell->packed->nibbles[i])
+				return 0;
+		}
+		memcpy(nibbles, cell->uniform_nibbles, NIBBLE_LAYERS);
+		return 1;
+	}
+
+	for (i = 0; i < NIBBLE_LAYERS; i++)
+	{
+		if (!_is_nibble_layer_uniform(&cell->data->nibbles[i][0][0][0], &nibbles[i]))
+			return 0;
+	}
+
+	return 1;
 }
 
-static int mesh_set_flags(PyMeshObject *self, PyObject *value, void *enclosure)
+/* Store a cell in palette form, from ids and nibble layers (NULL for zeros)
+ * given in cell order. Cell is made uniform when possible.
+ */
+static int _pack_cell(MapCell *cell, const uint8_t *ids, const uint8_t **nibbles)
 {
-    unsigned int shift = (Py_uintptr_t)enclosure;
-    int res;
+	int16_t slots[256];
+	uint8_t palette[256], values[NIBBLE_LAYERS];
+	uint8_t *layers[NIBBLE_LAYERS] = {NULL};
+	PackedCell *packed;
+	int i, count = 0, bits;
+
+	memset(slots, 0xff, sizeof(slots));
+	for (i = 0; i < CELL_BLOCKS; i++)
+	{
+		if (slots[ids[i]] < 0)
+		{
+			slots[ids[i]] = count;
+			palette[count++] = ids[i];
+		}
+	}
 
-    res = PyObject_IsTrue(value);
-    if (res < 0)
-        return -1;
+	for (i = 0; i < NIBBLE_LAYERS; i++)
+	{
+		values[i] = 0;
+		if (!nibbles[i] || _is_nibble_layer_uniform(nibbles[i], &values[i]))
+			continue;
 
-    if (res)
-        *((unsigned int *)&self->flags) |= 1 << shift;
-    else
-        *((unsigned int *)&self->flags) &= ~(1 << shift);
+		layers[i] = malloc(CELL_BLOCKS/2);
+		if (!layers[i])
+			goto nomem;
+		memcpy(layers[i], nibbles[i], CELL_BLOCKS/2);
+	}
 
-    return 0;
+	if ((count == 1) && !layers[0] && !layers[1] && !layers[2])
+	{
+		_set_cell_uniform(cell, palette[0], values);
+		return 0;
+	}
+
+	bits = count <= 2 ? 1 : count <= 4 ? 2 : count <= 16 ? 4 : 8;
+	packed = _new_packed(bits, count);
+	if (!packed)
+		goto nomem;
+
+	memcpy(packed->palette, palette, count);
+	bzero(packed->indices, PACKED_INDICES_SIZE(bits));
+	for (i = 0; i < CELL_BLOCKS; i++)
+	{
+		const int bit = i * bits;
+		packed->indices[bit >> 3] |= slots[ids[i]] << (bit & 7);
+	}
+	memcpy(packed->nibbles, layers, sizeof(layers));
+
+	/* ids and nibbles may be the cell storage: dropped last */
+	_set_cell_uniform(cell, 0, values);
+	cell->packed = packed;
+	return 0;
+
+nomem:
+	for (i = 0; i < NIBBLE_LAYERS; i++)
+		free(layers[i]);
+	PyErr_NoMemory();
+	return -1;
 }
 
-static struct PyMethodDef mesh_methods[] = {
-    {NULL} /* sentinel */
-};
+/* Return the column of cluster (cx, cz), allocated if not loaded yet.
+ * Cluster must be in the window.
+ */
+static MapColumn * _use_column(PyMapObject *map, int cx, int cz)
+{
+	MapColumn *col, **bucket;
+	int cy;
 
-static PyMemberDef mesh_members[] = {
-    {"texid", T_INT, offsetof(PyMeshObject, texid), 0, NULL},
-    {"count", T_UINT, offsetof(PyMeshObject, count), RO, NULL},
-	{"occlusion", T_UBYTE, offsetof(PyMeshObject, occlusion), 0, NULL},
-	{"type", T_UINT, offsetof(PyMeshObject, type), RO, NULL},
-    {NULL} /* sentinel */
-};
+	if (!_in_window(map, cx, cz))
+	{
+		PyErr_Format(PyExc_ValueError, "cluster (%d, %d) out of map window", cx, cz);
+		return NULL;
+	}
 
-static PyGetSetDef mesh_getseters[] = {
-    {"alpha", (getter)mesh_get_flags, (setter)mesh_set_flags, "True if texture uses alpha", (void*)0},
-    {"ao", (getter)mesh_get_flags, (setter)mesh_set_flags, "True if AO pass used", (void*)1},
-    {"translucent", (getter)mesh_get_flags, (setter)mesh_set_flags, "True if mesh's texture has translucent alpha values", (void*)2},
-    {"level", (getter)mesh_get_flags, (setter)mesh_set_flags, "True if node level value is used", (void*)3},
-    {NULL} /* sentinel */
-};
+	col = _get_column(map, cx, cz);
+	if (col)
+		return col;
 
-static PyTypeObject PyMeshObject_Type = {
-    PyObject_HEAD_INIT(NULL)
+	if ((map->column_count > map->bucket_mask) && _grow_buckets(map))
+		return NULL;
 
-    tp_name         : "lowlevel.Mesh",
-    tp_basicsize    : sizeof(PyMeshObject),
-    tp_flags        : Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
-    tp_doc          : "Mesh Objects",
+	col = calloc(1, sizeof(*col));
+	if (!col)
+	{
+		PyErr_NoMemory();
+		return NULL;
+	}
 
-    tp_new          : (newfunc)mesh_new,
-    tp_dealloc      : (destructor)mesh_dealloc,
-    tp_methods      : mesh_methods,
-    tp_members      : mesh_members,
-    tp_getset       : mesh_getseters,
-};
+	col->cx = cx;
+	col->cz = cz;
+	for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+	{
+		MapCell *mc = &col->cells[cy];
+		mc->bsphere.x = (cx << WORLD_CLUSTER_X_SHIFT) + CLUSTER_SIZE_X / 2;
+		mc->bsphere.y = cy * BLOCK_PER_CELL_Y + BLOCK_PER_CELL_Y / 2;
+		mc->bsphere.z = (cz << WORLD_CLUSTER_Z_SHIFT) + CLUSTER_SIZE_Z / 2;
+		mc->bsphere.d = 27.72; /* sqrt(3) * 16 */
+		mc->render = 1;
+	}
 
-/*==== PyMapObject ===========================================================*/
+	bucket = &map->buckets[MAP_HASH(cx, cz) & map->bucket_mask];
+	col->hash_next = *bucket;
+	*bucket = col;
 
-static PyMapObject * map_new(PyTypeObject *type)
+	col->next = map->columns;
+	if (col->next)
+		col->next->previous = col;
+	map->columns = col;
+	map->column_count++;
+
+	return col;
+}
+
+/* Unlink a column from the map and free it */
+static void _release_column(PyMapObject *map, MapColumn *col)
 {
-    PyMapObject *self;
+	MapColumn **bucket = &map->buckets[MAP_HASH(col->cx, col->cz) & map->bucket_mask];
+	int cy;
 
-    self = (PyMapObject *)type->tp_alloc(type, 0);
-    if (self)
-    {
-        bzero(self->meshes, sizeof(self->meshes));
-		//bzero(self->cells, sizeof(self->cells));
-		
-		int cx, cy, cz;
-		for (cx = 0; cx < WORLD_CLUSTER_X; cx++)
-		{
-			for (cz = 0; cz < WORLD_CLUSTER_Z; cz++)
-			{
-				for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
-				{
-					MapCell *mc = &self->cells[cx][cz][cy];
-					bzero(mc, sizeof(mc));
-					mc->bsphere.x = (cx << WORLD_CLUSTER_X_SHIFT) + CLUSTER_SIZE_X / 2;
-					mc->bsphere.y = cy * BLOCK_PER_CELL_Y + BLOCK_PER_CELL_Y / 2;
-					mc->bsphere.z = (cz << WORLD_CLUSTER_Z_SHIFT) + CLUSTER_SIZE_Z / 2;
-					mc->bsphere.d = 27.72; /* sqrt(3) * 16 */
-				}
-			}
+	while (*bucket != col)
+		bucket = &(*bucket)->hash_next;
+	*bucket = col->hash_next;
+
+	if (col->previous)
+		col->previous->next = col->next;
+	else
+		map->columns = col->next;
+	if (col->next)
+		col->next->previous = col->previous;
+	map->column_count--;
+
+	for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+	{
+		MapCell *mc = &col->cells[cy];
+		if (mc->dirty)
+			map->dirty_count--;
+		map->face_count -= mc->static_faces.count + mc->blend_faces.count + mc->greedy_faces.count;
+		map->greedy_count -= mc->greedy_faces.count;
+		map->merged_count -= mc->merged;
+		free(mc->static_faces.faces);
+		free(mc->blend_faces.faces);
+		free(mc->greedy_faces.faces);
+		free(mc->tile_runs);
+		_cell_data_decref(mc->data);
+		_free_packed(mc->packed);
+	}
+	free(col);
+}
+
+/* Return true if the face fid of a block using mesh is hidden by its neighbour.
+ * Clusters not loaded yet don't occlude.
+ */
+static inline int _is_occluded_by(PyMapObject *map, PyMeshObject *mesh, int fid, int id)
+{
+	PyMeshObject *other;
+
+	if (id <= BID_AIR)
+		return 0;
+
+	other = map->meshes[id];
+	if (!other)
+		return 0;
+
+	return (!other->flags.alpha && (other->occlusion & (1 << OPPOSITE_FACE(fid)))) ||
+		(other->flags.alpha && mesh->flags.alpha);
+}
+
+static int _is_face_occluded(PyMapObject *map, MapColumn *col, PyMeshObject *mesh,
+							 int fid, int x, int y, int z)
+{
+	x += face_offsets[fid][0];
+	y += face_offsets[fid][1];
+	z += face_offsets[fid][2];
+
+	/* World's end occlusion */
+	if ((y < 0) || (y >= BLOCK_COUNT_Y))
+		return 1;
+
+	return _is_occluded_by(map, mesh, fid, _get_block_id(map, col, x, y, z));
+}
+
+/* Return the occlusion mask of a block from its neighbours */
+static uint8_t _compute_block_occlusion(PyMapObject *map, MapColumn *col,
+										PyMeshObject *mesh, int x, int y, int z)
+{
+	uint8_t occlusion = 0;
+	int i;
+
+	for (i = 0; i < 6; i++)
+	{
+		if (_is_face_occluded(map, col, mesh, i, x, y, z))
+			occlusion |= 1 << i;
+	}
+
+	return occlusion;
+}
+
+/* True if faces between two blocks of this mesh are hidden */
+static inline int _is_self_occluding(PyMeshObject *mesh)
+{
+	return mesh->flags.alpha || (mesh->occlusion == FULL_OCCLUSION);
+}
+
+/* Return 1 if the block has been changed, 0 if it had already this id, -1 on error */
+static int _set_block_id(MapColumn *col, uint8_t id,
+						 unsigned x, unsigned y, unsigned z)
+{
+	MapCell *cell = &col->cells[y/BLOCK_PER_CELL_Y];
+
+	if (_cell_block_id(cell, x, y, z) == id)
+		return 0;
+
+	if (!cell->data && _expand_cell(cell))
+		return -1;
+
+	cell->data->ids[x & CLUSTER_SIZE_X_MASK][z & CLUSTER_SIZE_Z_MASK]
+		[y & (BLOCK_PER_CELL_Y-1)] = id;
+	return 1;
+}
+
+static void _set_dirty(PyMapObject *map, MapCell *cell, uint8_t flags)
+{
+	if (!cell->dirty && flags)
+		map->dirty_count++;
+	cell->dirty |= flags;
+}
+
+static void _clear_dirty(PyMapObject *map, MapCell *cell, uint8_t flags)
+{
+	if (cell->dirty && !(cell->dirty &= ~flags))
+		map->dirty_count--;
+}
+
+/* Flag blocks of a cell local box as changed: their occlusion, the one of
+ * their neighbours and the cell faces have to be updated.
+ */
+static void _mark_blocks_dirty(PyMapObject *map, MapCell *cell, const BlockBox *box)
+{
+	BlockBox *dirty = &cell->dirty_box;
+
+	if (cell->dirty & DIRTY_OCCLUSION)
+	{
+		dirty->x0 = MIN(dirty->x0, box->x0);
+		dirty->y0 = MIN(dirty->y0, box->y0);
+		dirty->z0 = MIN(dirty->z0, box->z0);
+		dirty->x1 = MAX(dirty->x1, box->x1);
+		dirty->y1 = MAX(dirty->y1, box->y1);
+		dirty->z1 = MAX(dirty->z1, box->z1);
+	}
+	else
+		*dirty = *box;
+
+	_set_dirty(map, cell, DIRTY_OCCLUSION | DIRTY_FACES);
+}
+
+static void _mark_cell_dirty(PyMapObject *map, MapCell *cell)
+{
+	const BlockBox box = {0, 0, 0, CLUSTER_SIZE_X, BLOCK_PER_CELL_Y, CLUSTER_SIZE_Z};
+	_mark_blocks_dirty(map, cell, &box);
+}
+
+/* Gather chunk rows of a cell in cell order, then pack them */
+static int _pack_cell_blocks(MapCell *cell, const uint8_t *blocks,
+							 const uint8_t **nibbles, uint8_t *seen)
+{
+	uint8_t ids[CLUSTER_SIZE_X][CLUSTER_SIZE_Z][BLOCK_PER_CELL_Y];
+	uint8_t layers[NIBBLE_LAYERS][CLUSTER_SIZE_X][CLUSTER_SIZE_Z][BLOCK_PER_CELL_Y/2];
+	const uint8_t *rows[NIBBLE_LAYERS];
+	int i, x, y, z;
+
+	for (x = 0; x < CLUSTER_SIZE_X; x++)
+	{
+		for (z = 0; z < CLUSTER_SIZE_Z; z++)
+		{
+			const uint8_t *p = &blocks[OFFSET_FROM_POSITION(x, 0, z)];
+			memcpy(ids[x][z], p, BLOCK_PER_CELL_Y);
+			for (y = 0; y < BLOCK_PER_CELL_Y; y++)
+				seen[p[y]] = 1;
+
+			for (i = 0; i < NIBBLE_LAYERS; i++)
+			{
+				if (nibbles[i])
+					memcpy(layers[i][x][z], &nibbles[i][OFFSET_FROM_POSITION(x, 0, z) / 2],
+						   BLOCK_PER_CELL_Y/2);
+			}
 		}
-        self->fog_enabled = 0;
+	}
+
+	for (i = 0; i < NIBBLE_LAYERS; i++)
+		rows[i] = nibbles[i] ? &layers[i][0][0][0] : NULL;
+
+	return _pack_cell(cell, &ids[0][0][0], rows);
+}
+
+/* Set cell blocks from chunk arrays (X.Z.Y order, CLUSTER_SIZE_Y high),
+ * blocks ids and NIBBLE_LAYERS nibble arrays (NULL if not available).
+ * Arrays are given from the cell bottom. Cell is kept uniform when possible,
+ * else packed in compact mode. Found ids are flagged in seen.
+ */
+static int _set_cell_blocks(MapCell *cell, const uint8_t *blocks,
+							const uint8_t **nibbles, uint8_t *seen, int compact)
+{
+	const uint8_t id = blocks[0];
+	uint8_t row[BLOCK_PER_CELL_Y], values[NIBBLE_LAYERS];
+	int i, x, y, z;
+
+	memset(row, id, sizeof(row));
+	for (x = 0; x < CLUSTER_SIZE_X; x++)
+	{
+		for (z = 0; z < CLUSTER_SIZE_Z; z++)
+		{
+			if (memcmp(&blocks[OFFSET_FROM_POSITION(x, 0, z)], row, sizeof(row)))
+				goto mixed;
+		}
+	}
+
+	for (i = 0; i < NIBBLE_LAYERS; i++)
+	{
+		if (!nibbles[i])
+		{
+			values[i] = 0;
+			continue;
+		}
+
+		values[i] = nibbles[i][0] & 0xf;
+		memset(row, values[i] * 0x11, BLOCK_PER_CELL_Y/2);
+		for (x = 0; x < CLUSTER_SIZE_X; x++)
+		{
+			for (z = 0; z < CLUSTER_SIZE_Z; z++)
+			{
+				if (memcmp(&nibbles[i][OFFSET_FROM_POSITION(x, 0, z) / 2], row, BLOCK_PER_CELL_Y/2))
+					goto mixed;
+			}
+		}
+	}
+
+	_set_cell_uniform(cell, id, values);
+	seen[id] = 1;
+	return 0;
+
+mixed:
+	if (compact)
+		return _pack_cell_blocks(cell, blocks, nibbles, seen);
+
+	if (!cell->data && _expand_cell(cell))
+		return -1;
+
+	/* Cell rows are contiguous in chunk data */
+	for (x = 0; x < CLUSTER_SIZE_X; x++)
+	{
+		for (z = 0; z < CLUSTER_SIZE_Z; z++)
+		{
+			const uint8_t *p = &blocks[OFFSET_FROM_POSITION(x, 0, z)];
+			memcpy(cell->data->ids[x][z], p, BLOCK_PER_CELL_Y);
+			for (y = 0; y < BLOCK_PER_CELL_Y; y++)
+				seen[p[y]] = 1;
+
+			for (i = 0; i < NIBBLE_LAYERS; i++)
+			{
+				if (nibbles[i])
+					memcpy(cell->data->nibbles[i][x][z],
+						   &nibbles[i][OFFSET_FROM_POSITION(x, 0, z) / 2], BLOCK_PER_CELL_Y/2);
+				else
+					bzero(cell->data->nibbles[i][x][z], BLOCK_PER_CELL_Y/2);
+			}
+		}
+	}
+	bzero(cell->data->occlusion, sizeof(cell->data->occlusion));
+
+	return 0;
+}
+
+static size_t _render_cell(RenderCell *rc, PyCameraObject *camera,
+						size_t rendered_faces)
+{
+	size_t to_render = 0;
+
+	/* stop further rendering if max faces is reach */
+	if (rendered_faces > MAX_RENDERED_FACES)
+		return 0;
+
+	to_render = MIN(rc->count, MAX_RENDERED_FACES - rendered_faces);
+	render_faces_array(rc->faces, to_render, 0);
+
+	return to_render;
+}
+
+/*============================================================================*/
+/*==== PyMeshObject ==========================================================*/
+/*----------------------------------------------------------------------------*/
+
+static PyMeshObject * mesh_new(PyTypeObject *type, PyObject *args)
+{
+    PyMeshObject *self;
+    MeshType mesh_type;
+    Py_ssize_t texels_size, tint_rgb_size;
+    GLfloat *texels, *tint_rgb=NULL;
+    FaceData *faces;
+    int i, j, count, texid;
+    NodeFunc occ_light = NULL;
+
+    if (!PyArg_ParseTuple(args, "Iis#|s#", &mesh_type, &texid, &texels,
+						  &texels_size, &tint_rgb, &tint_rgb_size)) /* BR */
+        return NULL;
+
+#define MAKE_FACES(array) \
+    count = sizeof(array) / (4*3*sizeof(typeof(array[0]))); \
+    faces = _create_faces(count, array, tint_rgb, texels, texels_size); \
+
+#define MAKE_FACES_X(array, f) MAKE_FACES(array); occ_light = f;
+
+    switch (mesh_type) {
+	case MESH_EMPTY     : count=0; faces = NULL; break;
+	case MESH_CUBE      : MAKE_FACES(cube_vertices); break;
+	case MESH_CUBE2     : MAKE_FACES(cube2_vertices); break;
+	case MESH_STICKY    : MAKE_FACES(sticky_vertices); break;
+	case MESH_SLAB      : MAKE_FACES(slab_vertices); break;
+	case MESH_PLANE     : MAKE_FACES(plane_vertices); break;
+	case MESH_XPLANE    : MAKE_FACES(xplane_vertices); break;
+	case MESH_CROSS     : MAKE_FACES(cross_vertices); break;
+	case MESH_TORCH     : MAKE_FACES(torch_vertices); break;
+	case MESH_STAIRS    : MAKE_FACES(stairs_vertices); break;
+	case MESH_LEVER     : MAKE_FACES(lever_vertices); break;
+	case MESH_PANE: // like a cube but scaled in one axis
+		MAKE_FACES(cube_vertices);
+		// FIXME: scaling is wrong
+		/* rescale all faces */
+		for (i=0; i < count; i++) {
+			/* Loop on vertices */
+			for (j=0; j < 4; j++) {
+				faces[i].points[j].vertices[2] *= 2*TEXEL_OFF;
+			}
+		}
+		break;
+	default:
+		return (void *)PyErr_Format(PyExc_ValueError,
+									"unknown mesh type %u",
+									mesh_type);
+    }
+
+    if ((mesh_type != MESH_EMPTY) && !faces)
+        return NULL;
+
+    self = (PyMeshObject *)type->tp_alloc(type, 0); /* NR */
+    if (NULL != self)
+    {
+        self->faces = faces;
+        self->type = mesh_type;
+        self->count = count;
+        self->flags.translucent = 0;
+        self->flags.alpha = 0;
+        self->flags.ao = 1;
+        self->flags.level = 0;
+        self->texid = texid;
+        self->occlusion_and_lighting = occ_light;
+		self->occlusion = 0;
     }
 
     return self;
 }
 
-static int map_traverse(PyMapObject *self, visitproc visit, void *arg)
+static void mesh_dealloc(PyMeshObject *self)
 {
-    int i;
-    for (i=0; i < 256; i++)
-        Py_VISIT(self->meshes[i]);
-    return 0;
+    if (self->faces)
+        PyMem_Free(self->faces);
+
+    ((PyObject *)self)->ob_type->tp_free((PyObject *)self);
 }
 
-static int map_clear(PyMapObject *self)
+static PyObject * mesh_get_flags(PyMeshObject *self, void *enclosure)
 {
-    int i;
-    for (i=0; i < 256; i++)
-        Py_CLEAR(self->meshes[i]);
+    unsigned int shift = (Py_uintptr_t)enclosure;
+
+    if (*((unsigned int *)&self->flags) & (1 << shift))
+        Py_RETURN_TRUE;
+    Py_RETURN_FALSE;
+}
+
+static int mesh_set_flags(PyMeshObject *self, PyObject *value, void *enclosure)
+{
+    unsigned int shift = (Py_uintptr_t)enclosure;
+    int res;
+
+    res = PyObject_IsTrue(value);
+    if (res < 0)
+        return -1;
+
+    if (res)
+        *((unsigned int *)&self->flags) |= 1 << shift;
+    else
+        *((unsigned int *)&self->flags) &= ~(1 << shift);
+
     return 0;
 }
 
-static void map_dealloc(PyMapObject *self)
+static struct PyMethodDef mesh_methods[] = {
+    {NULL} /* sentinel */
+};
+
+static PyMemberDef mesh_members[] = {
+    {"texid", T_INT, offsetof(PyMeshObject, texid), 0, NULL},
+    {"count", T_UINT, offsetof(PyMeshObject, count), RO, NULL},
+	{"occlusion", T_UBYTE, offsetof(PyMeshObject, occlusion), 0, NULL},
+	{"type", T_UINT, offsetof(PyMeshObject, type), RO, NULL},
+    {NULL} /* sentinel */
+};
+
+static PyGetSetDef mesh_getseters[] = {
+    {"alpha", (getter)mesh_get_flags, (setter)mesh_set_flags, "True if texture uses alpha", (void*)0},
+    {"ao", (getter)mesh_get_flags, (setter)mesh_set_flags, "True if AO pass used", (void*)1},
+    {"translucent", (getter)mesh_get_flags, (setter)mesh_set_flags, "True if mesh's texture has translucent alpha values", (void*)2},
+    {"level", (getter)mesh_get_flags, (setter)mesh_set_flags, "True if node level value is used", (void*)3},
+    {NULL} /* sentinel */
+};
+
+static PyTypeObject PyMeshObject_Type = {
+    PyObject_HEAD_INIT(NULL)
+
+    tp_name         : "lowlevel.Mesh",
+    tp_basicsize    : sizeof(PyMeshObject),
+    tp_flags        : Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
+    tp_doc          : "Mesh Objects",
+
+    tp_new          : (newfunc)mesh_new,
+    tp_dealloc      : (destructor)mesh_dealloc,
+    tp_methods      : mesh_methods,
+    tp_members      : mesh_members,
+    tp_getset       : mesh_getseters,
+};
+
+/*==== PyMapObject ===========================================================*/
+
+static PyMapObject * map_new(PyTypeObject *type)
+{
+    PyMapObject *self;
+
+    self = (PyMapObject *)type->tp_alloc(type, 0);
+    if (self)
+    {
+        bzero(self->meshes, sizeof(self->meshes));
+
+		self->columns = NULL;
+		self->column_count = 0;
+		self->bucket_mask = MAP_MIN_BUCKETS - 1;
+		self->buckets = calloc(MAP_MIN_BUCKETS, sizeof(*self->buckets));
+		if (!self->buckets)
+		{
+			Py_DECREF(self);
+			return (PyMapObject *)PyErr_NoMemory();
+		}
+
+		/* default window covers clusters (0, 0) to (WORLD_CLUSTER_X-1, WORLD_CLUSTER_Z-1) */
+		self->center_cx = WORLD_CLUSTER_X / 2;
+		self->center_cz = WORLD_CLUSTER_Z / 2;
+		self->dirty_count = 0;
+		self->face_count = 0;
+		self->greedy_count = 0;
+		self->merged_count = 0;
+		self->tile_texids = NULL;
+		self->tile_columns = self->tile_rows = 0;
+        self->fog_enabled = 0;
+		self->compact = 0;
+		self->greedy = 0;
+		self->occlusion_masks = 1;
+    }
+
+    return self;
+}
+
+static int map_traverse(PyMapObject *self, visitproc visit, void *arg)
+{
+    int i;
+    for (i=0; i < 256; i++)
+        Py_VISIT(self->meshes[i]);
+    return 0;
+}
+
+static int map_clear(PyMapObject *self)
+{
+    int i;
+    for (i=0; i < 256; i++)
+        Py_CLEAR(self->meshes[i]);
+    return 0;
+}
+
+#ifndef __MORPHOS__
+static void _stop_mesh_pool(PyMapObject *map);
+#endif
+
+static void map_dealloc(PyMapObject *self)
+{
+	PyObject_GC_UnTrack(self);
+#ifndef __MORPHOS__
+	_stop_mesh_pool(self);
+#endif
+    map_clear(self);
+	if (self->buckets)
+	{
+		while (self->columns)
+			_release_column(self, self->columns);
+		free(self->buckets);
+	}
+	free(self->tile_texids);
+    ((PyObject *)self)->ob_type->tp_free((PyObject *)self);
+}
+
+static PyObject * map_clip_vector(PyMapObject *self, PyObject *args)
+{
+    float x, y, z; /* real vector, not block position */
+    //short bx, by, bz;
+
+    if (!PyArg_ParseTuple(args, "fff", &x, &y, &z))
+        return NULL;
+
+    //bx = (int)(x + .5);
+    //by = (int)(y + .5);
+    //bz = (int)(z + .5);
+
+    return Py_BuildValue("fff", x, y, z);
+}
+
+static PyObject * map_has_mesh(PyMapObject *self, PyObject *args)
+{
+    uint8_t idx;
+    PyMeshObject *mesh;
+
+    if (!PyArg_ParseTuple(args, "B", &idx))
+        return NULL;
+
+    mesh = self->meshes[idx];
+    if (mesh)
+        Py_RETURN_TRUE;
+    Py_RETURN_FALSE;
+}
+
+static PyObject * map_get_mesh(PyMapObject *self, PyObject *args)
+{
+    uint8_t idx;
+    PyMeshObject *mesh;
+
+    if (!PyArg_ParseTuple(args, "B", &idx))
+        return NULL;
+
+    mesh = self->meshes[idx];
+    if (mesh)
+    {
+        Py_INCREF(mesh);
+        return (PyObject *)mesh;
+    }
+
+    Py_RETURN_NONE;
+}
+
+static PyObject * map_set_mesh(PyMapObject *self, PyObject *args)
+{
+    uint8_t idx;
+    PyMeshObject *mesh;
+
+    if (!PyArg_ParseTuple(args, "BO!", &idx, &PyMeshObject_Type, &mesh))
+        return NULL;
+
+    Py_XDECREF(self->meshes[idx]);
+    self->meshes[idx] = mesh;
+    Py_INCREF(mesh);
+
+    Py_RETURN_NONE;
+}
+
+static PyObject * map_get_blockid(PyMapObject *self, PyObject *args)
+{
+    int x, y, z, id;
+
+    if (!PyArg_ParseTuple(args, "iii", &x, &y, &z))
+        return NULL;
+
+	if (y < 0 || y >= BLOCK_COUNT_Y ||
+		!_in_window(self, x >> WORLD_CLUSTER_X_SHIFT, z >> WORLD_CLUSTER_Z_SHIFT))
+        return PyErr_Format(PyExc_ValueError, "coordinates out of map window");
+
+	id = _get_block_id(self, NULL, x, y, z);
+    return Py_BuildValue("B", id < 0 ? BID_AIR : id);
+}
+
+static PyObject * map_set_blockid(PyMapObject *self, PyObject *args)
+{
+	unsigned char id;
+	int x, y, z, full, changed;
+	MapColumn *col;
+	MapCell *cell;
+
+    if (!PyArg_ParseTuple(args, "Biii", &id, &x, &y, &z))
+        return NULL;
+
+	if (y < 0 || y >= BLOCK_COUNT_Y)
+        return PyErr_Format(PyExc_ValueError, "coordinates out of world range");
+
+	col = _use_column(self, x >> WORLD_CLUSTER_X_SHIFT, z >> WORLD_CLUSTER_Z_SHIFT);
+	if (!col)
+		return NULL;
+
+	cell = &col->cells[y/BLOCK_PER_CELL_Y];
+	full = cell->data != NULL;
+
+	changed = _set_block_id(col, id, x, y, z);
+	if (changed < 0)
+		return NULL;
+
+	/* newly expanded cells have no stored occlusion yet */
+	if (changed && !full)
+		_mark_cell_dirty(self, cell);
+	else if (changed)
+	{
+		const BlockBox box = {
+			x & CLUSTER_SIZE_X_MASK, y & (BLOCK_PER_CELL_Y-1), z & CLUSTER_SIZE_Z_MASK,
+			(x & CLUSTER_SIZE_X_MASK) + 1, (y & (BLOCK_PER_CELL_Y-1)) + 1, (z & CLUSTER_SIZE_Z_MASK) + 1,
+		};
+		_mark_blocks_dirty(self, cell, &box);
+	}
+
+	Py_RETURN_NONE;
+}
+
+static PyObject * map_add_face(PyMapObject *self, PyObject *args)
+{
+    PyMeshObject *mesh;
+    unsigned char face_id;
+	int x, y, z;
+
+    if (!PyArg_ParseTuple(args, "O!Biii", &PyMeshObject_Type, &mesh, &face_id,
+                          &x, &y, &z))
+        return NULL;
+
+	if (y < 0 || y >= BLOCK_COUNT_Y ||
+		!_in_window(self, x >> WORLD_CLUSTER_X_SHIFT, z >> WORLD_CLUSTER_Z_SHIFT))
+        return PyErr_Format(PyExc_ValueError, "coordinates out of map window");
+
+    //if (_add_face(self, mesh, face_id, x, y, z))
+	//	return NULL;
+
+	Py_RETURN_NONE;
+}
+
+/* add_blocks(blocks, cx, cz, data=None, skylight=None, blocklight=None):
+ * set blocks of cluster (cx, cz) from any buffer objects holding chunk arrays
+ * (X.Z.Y order, nibble arrays packed as in NBT). Buffers are not kept.
+ * Missing nibble arrays are read as 0.
+ * Returns the list of found block ids.
+ */
+static PyObject * map_add_blocks(PyMapObject *self, PyObject *args)
+{
+    Py_buffer buffer, nibbles[NIBBLE_LAYERS];
+    const uint8_t *nibbles_data[NIBBLE_LAYERS];
+    PyObject *ids = NULL;
+    uint8_t seen[256];
+    int cx, cz, cy, i;
+	MapColumn *col;
+
+	bzero(nibbles, sizeof(nibbles));
+    if (!PyArg_ParseTuple(args, "s*ii|z*z*z*", &buffer, &cx, &cz,
+						  &nibbles[0], &nibbles[1], &nibbles[2]))
+        return NULL;
+
+    if (buffer.len < BLOCKS_PER_CLUSTER)
+    {
+		PyErr_Format(PyExc_ValueError, "blocks buffer too small");
+		goto end;
+    }
+
+	for (i=0; i < NIBBLE_LAYERS; i++)
+	{
+		if (nibbles[i].buf && (nibbles[i].len < BLOCKS_PER_CLUSTER/2))
+		{
+			PyErr_Format(PyExc_ValueError, "nibbles buffer too small");
+			goto end;
+		}
+	}
+
+	col = _use_column(self, cx, cz);
+	if (!col)
+		goto end;
+
+	bzero(seen, sizeof(seen));
+	for (cy=0; cy < MAX_RENDER_CELLS; cy++)
+	{
+		for (i=0; i < NIBBLE_LAYERS; i++)
+			nibbles_data[i] = nibbles[i].buf ? (uint8_t *)nibbles[i].buf + cy * BLOCK_PER_CELL_Y/2 : NULL;
+
+		if (_set_cell_blocks(&col->cells[cy], (uint8_t *)buffer.buf + cy * BLOCK_PER_CELL_Y,
+							 nibbles_data, seen, self->compact))
+			goto end;
+		_mark_cell_dirty(self, &col->cells[cy]);
+	}
+
+	ids = PyList_New(0);
+	for (i=0; ids && (i < 256); i++)
+	{
+		if (seen[i])
+		{
+			PyObject *id = PyInt_FromLong(i);
+			if (!id || PyList_Append(ids, id))
+				Py_CLEAR(ids);
+			Py_XDECREF(id);
+		}
+	}
+
+end:
+	PyBuffer_Release(&buffer);
+	for (i=0; i < NIBBLE_LAYERS; i++)
+	{
+		if (nibbles[i].buf)
+			PyBuffer_Release(&nibbles[i]);
+	}
+    return ids;
+}
+
+/* get_blockdata(x, y, z): return (data, skylight, blocklight) of a block */
+static PyObject * map_get_blockdata(PyMapObject *self, PyObject *args)
+{
+	int x, y, z;
+	MapColumn *col;
+	MapCell *cell;
+
+	if (!PyArg_ParseTuple(args, "iii", &x, &y, &z))
+		return NULL;
+
+	if (y < 0 || y >= BLOCK_COUNT_Y ||
+		!_in_window(self, x >> WORLD_CLUSTER_X_SHIFT, z >> WORLD_CLUSTER_Z_SHIFT))
+		return PyErr_Format(PyExc_ValueError, "coordinates out of map window");
+
+	col = _get_column(self, x >> WORLD_CLUSTER_X_SHIFT, z >> WORLD_CLUSTER_Z_SHIFT);
+	if (!col)
+		return Py_BuildValue("BBB", 0, 0, 0);
+
+	cell = &col->cells[y/BLOCK_PER_CELL_Y];
+	return Py_BuildValue("BBB",
+						 _cell_nibble(cell, LAYER_DATA, x, y, z),
+						 _cell_nibble(cell, LAYER_SKYLIGHT, x, y, z),
+						 _cell_nibble(cell, LAYER_BLOCKLIGHT, x, y, z));
+}
+
+/* Return a buffer view on a data layer of cell (cx, cy, cz), in X.Z.Y order.
+ * Layer is LAYER_IDS (default) or a nibble layer (LAYER_DATA, LAYER_SKYLIGHT,
+ * LAYER_BLOCKLIGHT), packed as in chunk NBT.
+ * Cell is created (filled by air) if needed and loses its uniform state.
+ * Writes are not followed by occlusion and faces updates.
+ */
+static PyObject * map_get_cell_buffer(PyMapObject *self, PyObject *args)
+{
+	PyCellBufferObject *view;
+	MapColumn *col;
+	MapCell *cell;
+	int cx, cy, cz, layer=LAYER_IDS;
+
+	if (!PyArg_ParseTuple(args, "iii|i", &cx, &cy, &cz, &layer))
+		return NULL;
+
+	if (cy < 0 || cy >= MAX_RENDER_CELLS)
+		return PyErr_Format(PyExc_ValueError, "cell coordinates out of world range");
+
+	if (layer < LAYER_IDS || layer > LAYER_BLOCKLIGHT)
+		return PyErr_Format(PyExc_ValueError, "invalid layer %d", layer);
+
+	col = _use_column(self, cx, cz);
+	if (!col)
+		return NULL;
+
+	cell = &col->cells[cy];
+	if (!cell->data)
+	{
+		if (_expand_cell(cell))
+			return NULL;
+		/* stored occlusion has to be computed */
+		_mark_cell_dirty(self, cell);
+	}
+
+	view = PyObject_New(PyCellBufferObject, &PyCellBufferObject_Type);
+	if (!view)
+		return NULL;
+
+	view->data = cell->data;
+	view->data->refcount++;
+	if (layer == LAYER_IDS)
+	{
+		view->buf = &cell->data->ids[0][0][0];
+		view->len = sizeof(cell->data->ids);
+	}
+	else
+	{
+		view->buf = &cell->data->nibbles[NIBBLE_INDEX(layer)][0][0][0];
+		view->len = sizeof(cell->data->nibbles[0]);
+	}
+	view->cx = cx;
+	view->cy = cy;
+	view->cz = cz;
+	view->layer = layer;
+
+	return (PyObject *)view;
+}
+
+/*--- Bulk edition ---*/
+
+/* Per cell callback of _foreach_box_cell().
+ * box is the part of the edited box inside the cell, in cell coordinates,
+ * (x0, y0, z0) is the cell origin in the world.
+ * Returns the number of modified blocks or -1 on error.
+ */
+typedef int (*BoxCellFunc)(MapCell *cell, const BlockBox *box,
+						   int x0, int y0, int z0, void *ctx);
+
+/* Check and fix a box given by the user. If in_window is set,
+ * the box must be inside the map window.
+ */
+static int _check_box(PyMapObject *map, BlockBox *box, int in_window)
+{
+	if ((box->y0 < 0) || (box->y1 > BLOCK_COUNT_Y))
+	{
+		PyErr_Format(PyExc_ValueError, "coordinates out of world range");
+		return -1;
+	}
+
+	/* empty box */
+	if ((box->x0 >= box->x1) || (box->y0 >= box->y1) || (box->z0 >= box->z1))
+	{
+		box->x1 = box->x0;
+		return 0;
+	}
+
+	if (in_window &&
+		(!_in_window(map, box->x0 >> WORLD_CLUSTER_X_SHIFT, box->z0 >> WORLD_CLUSTER_Z_SHIFT) ||
+		 !_in_window(map, (box->x1-1) >> WORLD_CLUSTER_X_SHIFT, (box->z1-1) >> WORLD_CLUSTER_Z_SHIFT)))
+	{
+		PyErr_Format(PyExc_ValueError, "coordinates out of map window");
+		return -1;
+	}
+
+	return 0;
+}
+
+/* Call func on each cell intersecting box. Missing clusters are created if
+ * create is set, skipped otherwise. Modified cells are marked dirty.
+ * Returns the number of modified blocks or -1 on error.
+ */
+static long _foreach_box_cell(PyMapObject *map, const BlockBox *box, int create,
+							  BoxCellFunc func, void *ctx)
+{
+	long total = 0;
+	int cx, cy, cz;
+
+	if (box->x0 >= box->x1)
+		return 0;
+
+	for (cx = box->x0 >> WORLD_CLUSTER_X_SHIFT; cx <= (box->x1-1) >> WORLD_CLUSTER_X_SHIFT; cx++)
+	{
+		for (cz = box->z0 >> WORLD_CLUSTER_Z_SHIFT; cz <= (box->z1-1) >> WORLD_CLUSTER_Z_SHIFT; cz++)
+		{
+			MapColumn *col = create ? _use_column(map, cx, cz) : _get_column(map, cx, cz);
+
+			if (!col)
+			{
+				if (create)
+					return -1;
+				continue;
+			}
+
+			for (cy = box->y0 / BLOCK_PER_CELL_Y; cy <= (box->y1-1) / BLOCK_PER_CELL_Y; cy++)
+			{
+				MapCell *cell = &col->cells[cy];
+				const int x0 = cx * CLUSTER_SIZE_X;
+				const int y0 = cy * BLOCK_PER_CELL_Y;
+				const int z0 = cz * CLUSTER_SIZE_Z;
+				const int full = cell->data != NULL;
+				BlockBox local;
+				int count;
+
+				local.x0 = MAX(box->x0 - x0, 0);
+				local.y0 = MAX(box->y0 - y0, 0);
+				local.z0 = MAX(box->z0 - z0, 0);
+				local.x1 = MIN(box->x1 - x0, CLUSTER_SIZE_X);
+				local.y1 = MIN(box->y1 - y0, BLOCK_PER_CELL_Y);
+				local.z1 = MIN(box->z1 - z0, CLUSTER_SIZE_Z);
+
+				count = func(cell, &local, x0, y0, z0, ctx);
+				if (count < 0)
+					return -1;
+
+				/* newly expanded cells have no stored occlusion yet */
+				if (!full && cell->data)
+					_mark_cell_dirty(map, cell);
+				else if (count)
+					_mark_blocks_dirty(map, cell, &local);
+				total += count;
+			}
+		}
+	}
+
+	return total;
+}
+
+#define BOX_VOLUME(b) (((b)->x1-(b)->x0) * ((b)->y1-(b)->y0) * ((b)->z1-(b)->z0))
+
+static int _fill_cell(MapCell *cell, const BlockBox *box,
+					  int x0, int y0, int z0, void *ctx)
+{
+	const uint8_t id = *(uint8_t *)ctx;
+	uint8_t nibbles[NIBBLE_LAYERS];
+	int x, y, z, count = 0;
+
+	if (CELL_IS_UNIFORM(cell))
+	{
+		if (cell->uniform_id == id)
+			return 0;
+		count = BOX_VOLUME(box);
+	}
+	else
+	{
+		/* only changed blocks count, the cell is left as is if none */
+		for (x = box->x0; x < box->x1; x++)
+		{
+			for (z = box->z0; z < box->z1; z++)
+			{
+				for (y = box->y0; y < box->y1; y++)
+					count += _cell_block_id(cell, x, y, z) != id;
+			}
+		}
+		if (!count)
+			return 0;
+	}
+
+	/* metadata and light are kept by id edits */
+	if ((BOX_VOLUME(box) == CELL_BLOCKS) && _get_uniform_nibbles(cell, nibbles))
+	{
+		_set_cell_uniform(cell, id, nibbles);
+		return count;
+	}
+
+	if (!cell->data && _expand_cell(cell))
+		return -1;
+
+	for (x = box->x0; x < box->x1; x++)
+	{
+		for (z = box->z0; z < box->z1; z++)
+			memset(&cell->data->ids[x][z][box->y0], id, box->y1 - box->y0);
+	}
+
+	return count;
+}
+
+static int _replace_cell(MapCell *cell, const BlockBox *box,
+						 int x0, int y0, int z0, void *ctx)
+{
+	const uint8_t old_id = ((uint8_t *)ctx)[0];
+	const uint8_t new_id = ((uint8_t *)ctx)[1];
+	int i, x, y, z, count = 0;
+
+	if (cell->packed)
+	{
+		PackedCell *packed = cell->packed;
+		int slot = -1, merge = 0;
+
+		for (i = 0; i < packed->count; i++)
+		{
+			if (packed->palette[i] == old_id)
+				slot = i;
+			else if (packed->palette[i] == new_id)
+				merge = 1;
+		}
+		if (slot < 0)
+			return 0;
+
+		/* whole cell: only the palette entry changes */
+		if (!merge && (BOX_VOLUME(box) == CELL_BLOCKS))
+		{
+			packed->palette[slot] = new_id;
+			for (i = 0; i < CELL_BLOCKS; i++)
+				count += _packed_index(packed, i) == slot;
+			return count;
+		}
+	}
+	else if (!cell->data)
+	{
+		if (cell->uniform_id != old_id)
+			return 0;
+
+		if (BOX_VOLUME(box) == CELL_BLOCKS)
+		{
+			cell->uniform_id = new_id;
+			return CELL_BLOCKS;
+		}
+	}
+
+	if (!cell->data && _expand_cell(cell))
+		return -1;
+
+	for (x = box->x0; x < box->x1; x++)
+	{
+		for (z = box->z0; z < box->z1; z++)
+		{
+			uint8_t *ids = cell->data->ids[x][z];
+			for (y = box->y0; y < box->y1; y++)
+			{
+				if (ids[y] == old_id)
+				{
+					ids[y] = new_id;
+					count++;
+				}
+			}
+		}
+	}
+
+	return count;
+}
+
+/* Copy and paste volumes are arrays of blocks ids in X.Z.Y order */
+typedef struct VolumeContext {
+	uint8_t *data;
+	const BlockBox *box;				/* whole volume box in the world */
+	int skip_air;						/* paste: air doesn't overwrite blocks */
+} VolumeContext;
+
+#define VOLUME_OFFSET(b, x, y, z)											\
+	((((x) - (b)->x0) * ((b)->z1 - (b)->z0) + ((z) - (b)->z0)) * ((b)->y1 - (b)->y0) + \
+	 ((y) - (b)->y0))
+
+static int _copy_cell(MapCell *cell, const BlockBox *box,
+					  int x0, int y0, int z0, void *ctx)
+{
+	VolumeContext *volume = ctx;
+	const int len = box->y1 - box->y0;
+	int x, y, z;
+
+	for (x = box->x0; x < box->x1; x++)
+	{
+		for (z = box->z0; z < box->z1; z++)
+		{
+			uint8_t *dst = &volume->data[VOLUME_OFFSET(volume->box, x0+x, y0+box->y0, z0+z)];
+			if (cell->data)
+				memcpy(dst, &cell->data->ids[x][z][box->y0], len);
+			else if (cell->packed)
+			{
+				for (y = 0; y < len; y++)
+					dst[y] = cell->packed->palette[_packed_index(cell->packed, CELL_INDEX(x, box->y0 + y, z))];
+			}
+			else
+				memset(dst, cell->uniform_id, len);
+		}
+	}
+
+	return 0;
+}
+
+static int _paste_cell(MapCell *cell, const BlockBox *box,
+					   int x0, int y0, int z0, void *ctx)
+{
+	VolumeContext *volume = ctx;
+	const int len = box->y1 - box->y0;
+	int x, y, z, count = 0;
+
+	for (x = box->x0; x < box->x1; x++)
+	{
+		for (z = box->z0; z < box->z1; z++)
+		{
+			const uint8_t *src = &volume->data[VOLUME_OFFSET(volume->box, x0+x, y0+box->y0, z0+z)];
+			int changed = 0;
+
+			/* only changed blocks count: cells are left as is, not expanded, if none */
+			for (y = 0; y < len; y++)
+			{
+				if ((src[y] != _cell_block_id(cell, x, box->y0 + y, z)) &&
+					!(volume->skip_air && (src[y] == BID_AIR)))
+					changed++;
+			}
+			if (!changed)
+				continue;
+
+			if (!cell->data && _expand_cell(cell))
+				return -1;
+
+			uint8_t *dst = &cell->data->ids[x][z][box->y0];
+			if (volume->skip_air)
+			{
+				for (y = 0; y < len; y++)
+				{
+					if (src[y] != BID_AIR)
+						dst[y] = src[y];
+				}
+			}
+			else
+				memcpy(dst, src, len);
+			count += changed;
+		}
+	}
+
+	return count;
+}
+
+/* fill(id, x0, y0, z0, x1, y1, z1): set all blocks of the box to id.
+ * Box max bounds are excluded. Returns the number of changed blocks.
+ */
+static PyObject * map_fill(PyMapObject *self, PyObject *args)
+{
+	uint8_t id;
+	BlockBox box;
+	long count;
+
+	if (!PyArg_ParseTuple(args, "Biiiiii", &id, &box.x0, &box.y0, &box.z0,
+						  &box.x1, &box.y1, &box.z1))
+		return NULL;
+
+	if (_check_box(self, &box, 1))
+		return NULL;
+
+	count = _foreach_box_cell(self, &box, 1, _fill_cell, &id);
+	if (count < 0)
+		return NULL;
+
+	return PyInt_FromLong(count);
+}
+
+/* replace(old_id, new_id, x0, y0, z0, x1, y1, z1): replace old_id by new_id
+ * in loaded clusters of the box. Returns the number of replaced blocks.
+ */
+static PyObject * map_replace(PyMapObject *self, PyObject *args)
+{
+	uint8_t ids[2];
+	BlockBox box;
+	long count;
+
+	if (!PyArg_ParseTuple(args, "BBiiiiii", &ids[0], &ids[1], &box.x0, &box.y0, &box.z0,
+						  &box.x1, &box.y1, &box.z1))
+		return NULL;
+
+	if (_check_box(self, &box, 0))
+		return NULL;
+
+	if (ids[0] == ids[1])
+		return PyInt_FromLong(0);
+
+	count = _foreach_box_cell(self, &box, 0, _replace_cell, ids);
+	if (count < 0)
+		return NULL;
+
+	return PyInt_FromLong(count);
+}
+
+/* copy(x0, y0, z0, x1, y1, z1): return a bytearray of the box block ids,
+ * in X.Z.Y order. Clusters not loaded are read as air.
+ */
+static PyObject * map_copy(PyMapObject *self, PyObject *args)
+{
+	VolumeContext volume;
+	PyObject *result;
+	BlockBox box;
+
+	if (!PyArg_ParseTuple(args, "iiiiii", &box.x0, &box.y0, &box.z0,
+						  &box.x1, &box.y1, &box.z1))
+		return NULL;
+
+	if (_check_box(self, &box, 0))
+		return NULL;
+
+	result = PyByteArray_FromStringAndSize(NULL, box.x0 < box.x1 ? BOX_VOLUME(&box) : 0);
+	if (!result)
+		return NULL;
+
+	volume.data = (uint8_t *)PyByteArray_AS_STRING(result);
+	volume.box = &box;
+	volume.skip_air = 0;
+	memset(volume.data, BID_AIR, PyByteArray_GET_SIZE(result));
+
+	_foreach_box_cell(self, &box, 0, _copy_cell, &volume);
+	return result;
+}
+
+/* paste(data, x, y, z, dx, dy, dz, skip_air=False): write a volume of
+ * dx*dy*dz block ids in X.Z.Y order (as given by copy) at (x, y, z).
+ * Returns the number of changed blocks.
+ */
+static PyObject * map_paste(PyMapObject *self, PyObject *args)
+{
+	VolumeContext volume;
+	Py_buffer data;
+	BlockBox box;
+	int dx, dy, dz, skip_air=0;
+	long count = -1;
+
+	if (!PyArg_ParseTuple(args, "s*iiiiii|i", &data, &box.x0, &box.y0, &box.z0,
+						  &dx, &dy, &dz, &skip_air))
+		return NULL;
+
+	if ((dx < 0) || (dy < 0) || (dz < 0))
+	{
+		PyErr_Format(PyExc_ValueError, "negative volume size");
+		goto end;
+	}
+
+	if (data.len < (Py_ssize_t)dx*dy*dz)
+	{
+		PyErr_Format(PyExc_ValueError, "volume data too small");
+		goto end;
+	}
+
+	box.x1 = box.x0 + dx;
+	box.y1 = box.y0 + dy;
+	box.z1 = box.z0 + dz;
+	if (_check_box(self, &box, 1))
+		goto end;
+
+	volume.data = data.buf;
+	volume.box = &box;
+	volume.skip_air = skip_air;
+
+	count = _foreach_box_cell(self, &box, 1, _paste_cell, &volume);
+
+end:
+	PyBuffer_Release(&data);
+	if (count < 0)
+		return NULL;
+
+	return PyInt_FromLong(count);
+}
+
+static PyObject * map_has_cluster(PyMapObject *self, PyObject *args)
+{
+	int cx, cz;
+
+	if (!PyArg_ParseTuple(args, "ii", &cx, &cz))
+		return NULL;
+
+	if (_get_column(self, cx, cz))
+		Py_RETURN_TRUE;
+	Py_RETURN_FALSE;
+}
+
+static PyObject * map_in_window(PyMapObject *self, PyObject *args)
+{
+	int cx, cz;
+
+	if (!PyArg_ParseTuple(args, "ii", &cx, &cz))
+		return NULL;
+
+	if (_in_window(self, cx, cz))
+		Py_RETURN_TRUE;
+	Py_RETURN_FALSE;
+}
+
+/* pack_cells(): store loaded full cells in palette form.
+ * Cells shared with a buffer view are kept. Return the number of packed cells.
+ */
+static PyObject * map_pack_cells(PyMapObject *self)
+{
+	MapColumn *col;
+	long count = 0;
+	int cy, i;
+
+	for (col = self->columns; col; col = col->next)
+	{
+		for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+		{
+			MapCell *mc = &col->cells[cy];
+			const uint8_t *nibbles[NIBBLE_LAYERS];
+
+			if (!mc->data || (mc->data->refcount > 1))
+				continue;
+
+			for (i = 0; i < NIBBLE_LAYERS; i++)
+				nibbles[i] = &mc->data->nibbles[i][0][0][0];
+			if (_pack_cell(mc, &mc->data->ids[0][0][0], nibbles))
+				return NULL;
+			count++;
+		}
+	}
+
+	return PyInt_FromLong(count);
+}
+
+/* storage_stats(): return a dict of cell counts per storage kind
+ * and the memory used by cells storage, in bytes.
+ */
+static PyObject * map_storage_stats(PyMapObject *self)
+{
+	MapColumn *col;
+	unsigned int uniform = 0, full = 0, packed = 0;
+	size_t size = 0;
+	int cy, i;
+
+	for (col = self->columns; col; col = col->next)
+	{
+		size += sizeof(*col);
+		for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+		{
+			MapCell *mc = &col->cells[cy];
+
+			if (mc->data)
+			{
+				full++;
+				size += sizeof(*mc->data);
+			}
+			else if (mc->packed)
+			{
+				packed++;
+				size += sizeof(*mc->packed) + (1 << mc->packed->bits) + PACKED_INDICES_SIZE(mc->packed->bits);
+				for (i = 0; i < NIBBLE_LAYERS; i++)
+				{
+					if (mc->packed->nibbles[i])
+						size += CELL_BLOCKS/2;
+				}
+			}
+			else
+				uniform++;
+		}
+	}
+
+	return Py_BuildValue("{s:I,s:I,s:I,s:n}", "uniform", uniform, "full", full,
+						 "packed", packed, "bytes", (Py_ssize_t)size);
+}
+
+/* Map snapshot file, in host byte order:
+ *
+ *   SnapshotHeader, then per column: cx, cz (int32) and MAX_RENDER_CELLS
+ *   SnapshotCell records, each one followed by its storage:
+ *     full: CellData from ids to occlusion,
+ *     packed: palette (count bytes, padded to 4), indices, then stored nibble layers,
+ *   then, with SNAPSHOT_FACES, static and blend RenderFaceData arrays.
+ *
+ * Meshes are not saved: faces are only valid for the meshes used to
+ * generate them.
+ */
+#define SNAPSHOT_MAGIC "NCMS"
+#define SNAPSHOT_VERSION 1
+#define SNAPSHOT_BYTE_ORDER 0x01020304
+#define SNAPSHOT_FACES (1 << 0)
+
+enum {
+	SNAPSHOT_UNIFORM=0,
+	SNAPSHOT_FULL,
+	SNAPSHOT_PACKED,
+};
+
+typedef struct SnapshotHeader {
+	char magic[4];
+	uint32_t version;
+	uint32_t byte_order;
+	uint32_t flags;
+	uint32_t face_size;					/* sizeof(RenderFaceData) */
+	int32_t center_cx, center_cz;
+	uint32_t column_count;
+} SnapshotHeader;
+
+typedef struct SnapshotCell {
+	uint8_t storage;
+	uint8_t uniform_id;
+	uint8_t uniform_nibbles[NIBBLE_LAYERS];
+	uint8_t render;
+	uint8_t dirty;
+	uint8_t bits;						/* packed: bits per index */
+	uint16_t count;						/* packed: palette entries */
+	uint8_t layers;						/* packed: mask of stored nibble layers */
+	uint8_t pad;
+	uint32_t faces[2];					/* static and blend faces count */
+} SnapshotCell;
+
+#define CELL_DATA_SIZE (sizeof(CellData) - offsetof(CellData, ids))
+#define SNAPSHOT_PALETTE_SIZE(count) (((count) + 3) & ~3)
+
+static int _write(FILE *fp, const void *data, size_t size)
+{
+	return !size || (fwrite(data, size, 1, fp) == 1);
+}
+
+static int _write_cell(FILE *fp, MapCell *mc, int faces)
+{
+	SnapshotCell rec;
+	int i;
+
+	bzero(&rec, sizeof(rec));
+	rec.uniform_id = mc->uniform_id;
+	memcpy(rec.uniform_nibbles, mc->uniform_nibbles, sizeof(rec.uniform_nibbles));
+	rec.render = mc->render;
+	rec.dirty = mc->dirty;
+	if (faces && mc->greedy_faces.count)
+		rec.dirty |= DIRTY_FACES; /* merged faces depend on tile textures: rebuilt on load */
+	else if (faces)
+	{
+		rec.faces[0] = mc->static_faces.count;
+		rec.faces[1] = mc->blend_faces.count;
+	}
+
+	if (mc->data)
+		rec.storage = SNAPSHOT_FULL;
+	else if (mc->packed)
+	{
+		rec.storage = SNAPSHOT_PACKED;
+		rec.bits = mc->packed->bits;
+		rec.count = mc->packed->count;
+		for (i = 0; i < NIBBLE_LAYERS; i++)
+		{
+			if (mc->packed->nibbles[i])
+				rec.layers |= 1 << i;
+		}
+	}
+	else
+		rec.storage = SNAPSHOT_UNIFORM;
+
+	if (!_write(fp, &rec, sizeof(rec)))
+		return -1;
+
+	if (mc->data && !_write(fp, mc->data->ids, CELL_DATA_SIZE))
+		return -1;
+
+	if (mc->packed)
+	{
+		const uint8_t padding[4] = {0};
+
+		/* records are kept 4 bytes aligned in the file */
+		if (!_write(fp, mc->packed->palette, mc->packed->count) ||
+			!_write(fp, padding, SNAPSHOT_PALETTE_SIZE(mc->packed->count) - mc->packed->count) ||
+			!_write(fp, mc->packed->indices, PACKED_INDICES_SIZE(mc->packed->bits)))
+			return -1;
+		for (i = 0; i < NIBBLE_LAYERS; i++)
+		{
+			if (mc->packed->nibbles[i] && !_write(fp, mc->packed->nibbles[i], CELL_BLOCKS/2))
+				return -1;
+		}
+	}
+
+	if (faces &&
+		(!_write(fp, mc->static_faces.faces, rec.faces[0] * sizeof(RenderFaceData)) ||
+		 !_write(fp, mc->blend_faces.faces, rec.faces[1] * sizeof(RenderFaceData))))
+		return -1;
+
+	return 0;
+}
+
+/* save_snapshot(filename, faces=False): write blocks storage and occlusion
+ * of all loaded clusters, and their generated faces if requested.
+ * File is replaced only once completely written.
+ */
+static PyObject * map_save_snapshot(PyMapObject *self, PyObject *args)
+{
+	const char *filename;
+	char *tmpname;
+	int faces = 0, cy;
+	SnapshotHeader header;
+	MapColumn *col;
+	FILE *fp;
+
+	if (!PyArg_ParseTuple(args, "s|i", &filename, &faces))
+		return NULL;
+
+	tmpname = malloc(strlen(filename) + 5);
+	if (!tmpname)
+		return PyErr_NoMemory();
+	sprintf(tmpname, "%s.tmp", filename);
+
+	fp = fopen(tmpname, "wb");
+	if (!fp)
+		goto error;
+
+	bzero(&header, sizeof(header));
+	memcpy(header.magic, SNAPSHOT_MAGIC, sizeof(header.magic));
+	header.version = SNAPSHOT_VERSION;
+	header.byte_order = SNAPSHOT_BYTE_ORDER;
+	header.flags = faces ? SNAPSHOT_FACES : 0;
+	header.face_size = sizeof(RenderFaceData);
+	header.center_cx = self->center_cx;
+	header.center_cz = self->center_cz;
+	header.column_count = self->column_count;
+	if (!_write(fp, &header, sizeof(header)))
+		goto error;
+
+	for (col = self->columns; col; col = col->next)
+	{
+		const int32_t pos[2] = {col->cx, col->cz};
+
+		if (!_write(fp, pos, sizeof(pos)))
+			goto error;
+		for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+		{
+			if (_write_cell(fp, &col->cells[cy], faces))
+				goto error;
+		}
+	}
+
+	if (fclose(fp))
+	{
+		fp = NULL;
+		goto error;
+	}
+	fp = NULL;
+
+	if (rename(tmpname, filename))
+		goto error;
+
+	free(tmpname);
+	Py_RETURN_NONE;
+
+error:
+	PyErr_SetFromErrnoWithFilename(PyExc_IOError, (char *)filename);
+	if (fp)
+		fclose(fp);
+	unlink(tmpname);
+	free(tmpname);
+	return NULL;
+}
+
+/* Map a whole file in memory, read-only */
+static uint8_t * _map_file(const char *filename, size_t *size)
+{
+	uint8_t *data;
+#ifdef __MORPHOS__
+	FILE *fp = fopen(filename, "rb");
+	long len;
+
+	if (!fp)
+		goto error;
+
+	if (fseek(fp, 0, SEEK_END) || ((len = ftell(fp)) < 0) || fseek(fp, 0, SEEK_SET))
+	{
+		fclose(fp);
+		goto error;
+	}
+
+	data = malloc(len ? len : 1);
+	if (!data)
+	{
+		fclose(fp);
+		PyErr_NoMemory();
+		return NULL;
+	}
+
+	if (len && (fread(data, len, 1, fp) != 1))
+	{
+		free(data);
+		fclose(fp);
+		goto error;
+	}
+
+	fclose(fp);
+	*size = len;
+	return data;
+#else
+	struct stat st;
+	int fd = open(filename, O_RDONLY);
+
+	if (fd < 0)
+		goto error;
+
+	if (fstat(fd, &st))
+	{
+		close(fd);
+		goto error;
+	}
+
+	/* empty files can't be mapped, caught as truncated by the caller */
+	if (!st.st_size)
+	{
+		close(fd);
+		*size = 0;
+		return (uint8_t *)"";
+	}
+
+	data = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+	close(fd);
+	if (data == MAP_FAILED)
+		goto error;
+
+	*size = st.st_size;
+	return data;
+#endif
+
+error:
+	PyErr_SetFromErrnoWithFilename(PyExc_IOError, (char *)filename);
+	return NULL;
+}
+
+static void _unmap_file(uint8_t *data, size_t size)
+{
+#ifdef __MORPHOS__
+	free(data);
+#else
+	if (size)
+		munmap(data, size);
+#endif
+}
+
+/* Return a pointer on the next size bytes of a file mapping, NULL if truncated */
+static const uint8_t * _read(const uint8_t **pos, const uint8_t *end, size_t size)
+{
+	const uint8_t *p = *pos;
+
+	if ((size_t)(end - p) < size)
+		return NULL;
+
+	*pos = p + size;
+	return p;
+}
+
+/* Return 0 on success, 1 if truncated, -1 and MemoryError set if no memory */
+static int _read_faces(PyMapObject *map, RenderCell *rc, const uint8_t **pos, const uint8_t *end,
+					   unsigned count)
+{
+	const uint8_t *p;
+
+	if (!count)
+		return 0;
+
+	p = _read(pos, end, count * sizeof(RenderFaceData));
+	if (!p)
+		return 1;
+
+	rc->faces = malloc(count * sizeof(RenderFaceData));
+	if (!rc->faces)
+	{
+		PyErr_NoMemory();
+		return -1;
+	}
+
+	memcpy(rc->faces, p, count * sizeof(RenderFaceData));
+	rc->count = rc->allocated_faces = count;
+	map->face_count += count;
+	return 0;
+}
+
+/* Restore a cell saved by _write_cell(), faces are rebuilt unless saved.
+ * Return 0 on success, 1 if corrupted, -1 and MemoryError set if no memory.
+ */
+static int _read_cell(PyMapObject *map, MapCell *mc, const uint8_t **pos, const uint8_t *end,
+					  int faces, uint8_t *seen)
+{
+	const SnapshotCell *rec;
+	const uint8_t *p;
+	uint8_t dirty;
+	int i;
+
+	rec = (const SnapshotCell *)_read(pos, end, sizeof(*rec));
+	if (!rec)
+		return 1;
+
+	/* cells meshed when saved have no faces without SNAPSHOT_FACES */
+	dirty = rec->dirty;
+	if (!faces && ((rec->storage != SNAPSHOT_UNIFORM) || rec->uniform_id))
+		dirty |= DIRTY_FACES;
+
+	mc->uniform_id = rec->uniform_id;
+	memcpy(mc->uniform_nibbles, rec->uniform_nibbles, sizeof(mc->uniform_nibbles));
+	mc->render = rec->render;
+	if (dirty & DIRTY_OCCLUSION)
+		_mark_cell_dirty(map, mc);
+	_set_dirty(map, mc, dirty);
+
+	switch (rec->storage)
+	{
+		case SNAPSHOT_UNIFORM:
+			seen[mc->uniform_id] = 1;
+			break;
+
+		case SNAPSHOT_FULL:
+			p = _read(pos, end, CELL_DATA_SIZE);
+			if (!p)
+				return 1;
+
+			mc->data = malloc(sizeof(*mc->data));
+			if (!mc->data)
+			{
+				PyErr_NoMemory();
+				return -1;
+			}
+
+			mc->data->refcount = 1;
+			memcpy(mc->data->ids, p, CELL_DATA_SIZE);
+			for (i = 0; i < CELL_BLOCKS; i++)
+				seen[(&mc->data->ids[0][0][0])[i]] = 1;
+			break;
+
+		case SNAPSHOT_PACKED:
+			if (((rec->bits != 1) && (rec->bits != 2) && (rec->bits != 4) && (rec->bits != 8)) ||
+				!rec->count || (rec->count > (1 << rec->bits)))
+				return 1;
+
+			p = _read(pos, end, SNAPSHOT_PALETTE_SIZE(rec->count) + PACKED_INDICES_SIZE(rec->bits));
+			if (!p)
+				return 1;
+
+			mc->packed = _new_packed(rec->bits, rec->count);
+			if (!mc->packed)
+			{
+				PyErr_NoMemory();
+				return -1;
+			}
+
+			memcpy(mc->packed->palette, p, rec->count);
+			memcpy(mc->packed->indices, p + SNAPSHOT_PALETTE_SIZE(rec->count), PACKED_INDICES_SIZE(rec->bits));
+			for (i = 0; i < rec->count; i++)
+				seen[mc->packed->palette[i]] = 1;
+
+			for (i = 0; i < NIBBLE_LAYERS; i++)
+			{
+				if (!(rec->layers & (1 << i)))
+					continue;
+
+				p = _read(pos, end, CELL_BLOCKS/2);
+				if (!p)
+					return 1;
+
+				mc->packed->nibbles[i] = malloc(CELL_BLOCKS/2);
+				if (!mc->packed->nibbles[i])
+				{
+					PyErr_NoMemory();
+					return -1;
+				}
+				memcpy(mc->packed->nibbles[i], p, CELL_BLOCKS/2);
+			}
+			break;
+
+		default:
+			return 1;
+	}
+
+	if (faces)
+	{
+		i = _read_faces(map, &mc->static_faces, pos, end, rec->faces[0]);
+		if (!i)
+			i = _read_faces(map, &mc->blend_faces, pos, end, rec->faces[1]);
+		return i;
+	}
+
+	return 0;
+}
+
+/* load_snapshot(filename): replace all loaded clusters by the ones of a
+ * snapshot file, restored from a file mapping. Return the list of found
+ * block ids, Mesh objects are not part of snapshots: faces saved with them
+ * are restored, other cells get dirty faces. Map is left empty on error.
+ */
+static PyObject * map_load_snapshot(PyMapObject *self, PyObject *args)
+{
+	const char *filename;
+	const SnapshotHeader *header;
+	const uint8_t *pos, *end;
+	uint8_t *data, seen[256];
+	PyObject *ids = NULL;
+	size_t size;
+	unsigned int i;
+	int cy;
+
+	if (!PyArg_ParseTuple(args, "s", &filename))
+		return NULL;
+
+	data = _map_file(filename, &size);
+	if (!data)
+	{
+		size = 0;
+		goto error;
+	}
+
+	pos = data;
+	end = data + size;
+
+	header = (const SnapshotHeader *)_read(&pos, end, sizeof(*header));
+	if (!header || memcmp(header->magic, SNAPSHOT_MAGIC, sizeof(header->magic)) ||
+		(header->version != SNAPSHOT_VERSION) || (header->byte_order != SNAPSHOT_BYTE_ORDER) ||
+		(header->face_size != sizeof(RenderFaceData)))
+	{
+		PyErr_Format(PyExc_IOError, "'%s' is not a supported map snapshot", filename);
+		goto error;
+	}
+
+	while (self->columns)
+		_release_column(self, self->columns);
+	self->center_cx = header->center_cx;
+	self->center_cz = header->center_cz;
+
+	bzero(seen, sizeof(seen));
+	for (i = 0; i < header->column_count; i++)
+	{
+		const int32_t *xz = (const int32_t *)_read(&pos, end, 2 * sizeof(int32_t));
+		MapColumn *col;
+
+		if (!xz)
+			goto corrupted;
+
+		/* columns are saved once */
+		if (_get_column(self, xz[0], xz[1]))
+			goto corrupted;
+
+		col = _use_column(self, xz[0], xz[1]);
+		if (!col)
+			goto error;
+
+		for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+		{
+			const int res = _read_cell(self, &col->cells[cy], &pos, end, header->flags & SNAPSHOT_FACES, seen);
+
+			if (res > 0)
+				goto corrupted;
+			if (res < 0)
+				goto error;
+		}
+	}
+
+	ids = PyList_New(0);
+	for (i = 0; ids && (i < 256); i++)
+	{
+		PyObject *o;
+
+		if (!seen[i])
+			continue;
+
+		o = PyInt_FromLong(i);
+		if (!o || PyList_Append(ids, o))
+			Py_CLEAR(ids);
+		Py_XDECREF(o);
+	}
+	goto end;
+
+corrupted:
+	PyErr_Format(PyExc_IOError, "map snapshot '%s' is corrupted", filename);
+error:
+	while (self->columns)
+		_release_column(self, self->columns);
+end:
+	if (data)
+		_unmap_file(data, size);
+	return ids;
+}
+
+typedef struct ClusterDistance {
+	int cx, cz;
+	int d2;
+} ClusterDistance;
+
+static int _cmp_cluster_distance(const void *a, const void *b)
+{
+	return ((const ClusterDistance *)a)->d2 - ((const ClusterDistance *)b)->d2;
+}
+
+/* Move the window center to cluster (cx, cz).
+ * Columns of clusters going out of the window are released,
+ * returns the list of clusters (cx, cz) to load, nearest first.
+ */
+static PyObject * map_recenter(PyMapObject *self, PyObject *args)
+{
+	ClusterDistance missing[WORLD_CLUSTER_X*WORLD_CLUSTER_Z];
+	MapColumn *col, *next;
+	PyObject *list;
+	int cx, cz, x, z, i, count=0;
+
+	if (!PyArg_ParseTuple(args, "ii", &cx, &cz))
+		return NULL;
+
+	self->center_cx = cx;
+	self->center_cz = cz;
+
+	for (col = self->columns; col; col = next)
+	{
+		next = col->next;
+		if (!_in_window(self, col->cx, col->cz))
+			_release_column(self, col);
+	}
+
+	for (x = cx - WORLD_CLUSTER_X/2; x < cx + WORLD_CLUSTER_X/2; x++)
+	{
+		for (z = cz - WORLD_CLUSTER_Z/2; z < cz + WORLD_CLUSTER_Z/2; z++)
+		{
+			if (_get_column(self, x, z))
+				continue;
+
+			missing[count].cx = x;
+			missing[count].cz = z;
+			missing[count].d2 = (x-cx)*(x-cx) + (z-cz)*(z-cz);
+			count++;
+		}
+	}
+
+	qsort(missing, count, sizeof(*missing), _cmp_cluster_distance);
+
+	list = PyList_New(count);
+	if (!list)
+		return NULL;
+
+	for (i = 0; i < count; i++)
+	{
+		PyObject *pos = Py_BuildValue("ii", missing[i].cx, missing[i].cz);
+		if (!pos)
+		{
+			Py_DECREF(list);
+			return NULL;
+		}
+		PyList_SET_ITEM(list, i, pos);
+	}
+
+	return list;
+}
+
+/* Parse optional cluster coordinates (cx, cz) and return columns to process,
+ * from first until last (excluded). All loaded columns if no coordinates given.
+ */
+static int _parse_columns(PyMapObject *map, PyObject *args,
+						  MapColumn **first, MapColumn **last)
+{
+	int cx, cz;
+
+	if (PyTuple_GET_SIZE(args) == 0)
+	{
+		*first = map->columns;
+		*last = NULL;
+		return 0;
+	}
+
+	if (!PyArg_ParseTuple(args, "ii", &cx, &cz))
+		return -1;
+
+	*first = _get_column(map, cx, cz);
+	if (!*first)
+	{
+		PyErr_Format(PyExc_ValueError, "cluster (%d, %d) not loaded", cx, cz);
+		return -1;
+	}
+
+	*last = (*first)->next;
+	return 0;
+}
+
+/* Return the cell next to (col, cy) by one of its sides, NULL if not loaded */
+static MapCell * _get_neighbour_cell(PyMapObject *map, MapColumn *col, int cy, int side,
+									 MapColumn **ncol, int *ncy)
+{
+	cy += face_offsets[side][1];
+	if ((cy < 0) || (cy >= MAX_RENDER_CELLS))
+		return NULL;
+
+	if (face_offsets[side][0] || face_offsets[side][2])
+	{
+		col = _get_column(map, col->cx + face_offsets[side][0], col->cz + face_offsets[side][2]);
+		if (!col)
+			return NULL;
+	}
+
+	*ncol = col;
+	*ncy = cy;
+	return &col->cells[cy];
+}
+
+/* Bitmask occlusion (Map.occlusion_masks).
+ * A column of blocks is described by bitmasks along Y, one bit per block,
+ * on Y_MASK_WORDS 64 bits words: blocks with a mesh, alpha ones, and per face
+ * the opaque blocks occluding it. Occlusion of all blocks of a column is
+ * given by masks of its neighbour columns, shifted by one for top and bottom
+ * faces. Used for columns having all cells wholly dirty (loaded or forced).
+ */
+#define Y_MASK_WORDS (CLUSTER_SIZE_Y / 64)
+
+typedef struct YMask {
+	uint64_t w[Y_MASK_WORDS];
+} YMask;
+
+typedef struct BlockColumnMasks {
+	YMask solid;						/* blocks with a mesh */
+	YMask alpha;						/* blocks with an alpha mesh */
+	YMask occluders[6];					/* opaque blocks with occlusion bit FACE_xxx */
+} BlockColumnMasks;
+
+/* Masks bits per block id, from the map meshes */
+typedef struct OcclusionTable {
+	uint8_t solid[256];
+	uint8_t alpha[256];
+	uint8_t occluders[256];
+} OcclusionTable;
+
+/* Largest area of columns of blocks used to update a cluster column */
+#define COLUMN_MASKS_COUNT ((CLUSTER_SIZE_X+2) * (CLUSTER_SIZE_Z+2))
+
+static void _get_occlusion_table(PyMapObject *map, OcclusionTable *table)
+{
+	int id;
+
+	for (id = 0; id < 256; id++)
+	{
+		PyMeshObject *mesh = map->meshes[id];
+
+		if ((id == BID_AIR) || !mesh)
+		{
+			table->solid[id] = table->alpha[id] = table->occluders[id] = 0;
+			continue;
+		}
+
+		table->solid[id] = 1;
+		table->alpha[id] = mesh->flags.alpha;
+		table->occluders[id] = mesh->flags.alpha ? 0 : mesh->occlusion;
+	}
+}
+
+/* Masks of blocks column (x, z) of a cluster column, empty if not loaded */
+static void _get_block_column_masks(const OcclusionTable *table, MapColumn *col, int x, int z,
+									BlockColumnMasks *masks)
+{
+	int cy, y, i;
+
+	bzero(masks, sizeof(*masks));
+	if (!col)
+		return;
+
+	for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+	{
+		MapCell *mc = &col->cells[cy];
+
+		if (CELL_IS_UNIFORM(mc) && !table->solid[mc->uniform_id])
+			continue;
+
+		for (y = 0; y < BLOCK_PER_CELL_Y; y++)
+		{
+			const int by = cy * BLOCK_PER_CELL_Y + y;
+			const uint8_t id = _cell_block_id(mc, x, y, z);
+			const uint64_t bit = (uint64_t)1 << (by & 63);
+			const uint8_t occluders = table->occluders[id];
+
+			if (!table->solid[id])
+				continue;
+
+			masks->solid.w[by >> 6] |= bit;
+			if (table->alpha[id])
+				masks->alpha.w[by >> 6] |= bit;
+			for (i = 0; i < 6; i++)
+			{
+				if (occluders & (1 << i))
+					masks->occluders[i].w[by >> 6] |= bit;
+			}
+		}
+	}
+}
+
+/* out bit y = in bit y+1, the last bit is fill */
+static inline void _ymask_next(const YMask *in, YMask *out, uint64_t fill)
+{
+	int i;
+
+	for (i = 0; i < Y_MASK_WORDS - 1; i++)
+		out->w[i] = (in->w[i] >> 1) | (in->w[i+1] << 63);
+	out->w[i] = (in->w[i] >> 1) | (fill << 63);
+}
+
+/* out bit y = in bit y-1, the first bit is fill */
+static inline void _ymask_previous(const YMask *in, YMask *out, uint64_t fill)
+{
+	int i;
+
+	for (i = Y_MASK_WORDS - 1; i > 0; i--)
+		out->w[i] = (in->w[i] << 1) | (in->w[i-1] >> 63);
+	out->w[0] = (in->w[0] << 1) | fill;
+}
+
+/* Recompute the occlusion of blocks columns [x0, x1[ x [z0, z1[ of a cluster
+ * column, on all its height. masks is a COLUMN_MASKS_COUNT items buffer.
+ * Return a mask of cells whose faces may have changed.
+ */
+static int _update_columns_occlusion(PyMapObject *map, MapColumn *col, const OcclusionTable *table,
+									 BlockColumnMasks *masks, int x0, int z0, int x1, int z1)
+{
+	const int depth = z1 - z0 + 2;
+	int x, z, y, i, cy, changed = 0;
+
+	/* masks of the area and of its border, from neighbour columns if needed */
+	for (x = x0 - 1; x <= x1; x++)
+	{
+		for (z = z0 - 1; z <= z1; z++)
+		{
+			const int dx = (x < 0) ? -1 : (x >= CLUSTER_SIZE_X);
+			const int dz = (z < 0) ? -1 : (z >= CLUSTER_SIZE_Z);
+			MapColumn *ncol = col;
+
+			/* corners aren't used */
+			if (((x < x0) || (x >= x1)) && ((z < z0) || (z >= z1)))
+				continue;
+
+			if (dx || dz)
+				ncol = _get_column(map, col->cx + dx, col->cz + dz);
+			_get_block_column_masks(table, ncol, x & CLUSTER_SIZE_X_MASK, z & CLUSTER_SIZE_Z_MASK,
+									&masks[(x - x0 + 1) * depth + (z - z0 + 1)]);
+		}
+	}
+
+	/* see _update_box_occlusion() */
+	for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+	{
+		MapCell *mc = &col->cells[cy];
+		if (!mc->data && (!CELL_IS_UNIFORM(mc) || (mc->uniform_id != BID_AIR)))
+			changed |= 1 << cy;
+	}
+
+	for (x = x0; x < x1; x++)
+	{
+		for (z = z0; z < z1; z++)
+		{
+			const BlockColumnMasks *self = &masks[(x - x0 + 1) * depth + (z - z0 + 1)];
+			YMask occluded[6], next_alpha, previous_alpha;
+
+			/* a face is occluded by an opaque neighbour occluding it,
+			 * or by an alpha one if the block is alpha too.
+			 * World's end occludes.
+			 */
+			_ymask_previous(&self->occluders[FACE_TOP], &occluded[FACE_BOTTOM], 1);
+			_ymask_next(&self->occluders[FACE_BOTTOM], &occluded[FACE_TOP], 1);
+			_ymask_previous(&self->alpha, &previous_alpha, 0);
+			_ymask_next(&self->alpha, &next_alpha, 0);
+			for (i = 0; i < Y_MASK_WORDS; i++)
+			{
+				occluded[FACE_BOTTOM].w[i] |= self->alpha.w[i] & previous_alpha.w[i];
+				occluded[FACE_TOP].w[i] |= self->alpha.w[i] & next_alpha.w[i];
+			}
+
+			for (i = FACE_RIGHT; i < 6; i++)
+			{
+				const BlockColumnMasks *neighbour = self + face_offsets[i][0] * depth + face_offsets[i][2];
+				const YMask *occluders = &neighbour->occluders[OPPOSITE_FACE(i)];
+				int j;
+
+				for (j = 0; j < Y_MASK_WORDS; j++)
+					occluded[i].w[j] = occluders->w[j] | (self->alpha.w[j] & neighbour->alpha.w[j]);
+			}
+
+			for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+			{
+				MapCell *mc = &col->cells[cy];
+
+				if (!mc->data)
+					continue;
+
+				for (y = 0; y < BLOCK_PER_CELL_Y; y++)
+				{
+					const int by = cy * BLOCK_PER_CELL_Y + y;
+					const int w = by >> 6, b = by & 63;
+					uint8_t occlusion = 0;
+
+					if (!((self->solid.w[w] >> b) & 1))
+						continue;
+
+					for (i = 0; i < 6; i++)
+						occlusion |= ((occluded[i].w[w] >> b) & 1) << i;
+
+					if (occlusion != mc->data->occlusion[x][z][y])
+					{
+						mc->data->occlusion[x][z][y] = occlusion;
+						changed |= 1 << cy;
+					}
+				}
+			}
+		}
+	}
+
+	return changed;
+}
+
+/* True if all blocks of the cell have to be updated */
+static int _is_cell_wholly_dirty(MapCell *mc)
+{
+	const BlockBox *box = &mc->dirty_box;
+
+	return (mc->dirty & DIRTY_OCCLUSION) &&
+		!box->x0 && !box->y0 && !box->z0 &&
+		(box->x1 == CLUSTER_SIZE_X) && (box->y1 == BLOCK_PER_CELL_Y) && (box->z1 == CLUSTER_SIZE_Z);
+}
+
+/* Update with bitmasks the occlusion of all blocks of a column,
+ * then of the blocks facing them in loaded neighbour columns.
+ * Return -1 if not done (no memory).
+ */
+static int _update_column_occlusion(PyMapObject *map, MapColumn *col)
+{
+	BlockColumnMasks *masks;
+	OcclusionTable table;
+	int side, cy;
+
+	masks = malloc(COLUMN_MASKS_COUNT * sizeof(*masks));
+	if (!masks)
+		return -1;
+
+	_get_occlusion_table(map, &table);
+	_update_columns_occlusion(map, col, &table, masks, 0, 0, CLUSTER_SIZE_X, CLUSTER_SIZE_Z);
+
+	for (side = FACE_RIGHT; side < 6; side++)
+	{
+		MapColumn *ncol = _get_column(map, col->cx + face_offsets[side][0], col->cz + face_offsets[side][2]);
+		int x0 = 0, z0 = 0, x1 = CLUSTER_SIZE_X, z1 = CLUSTER_SIZE_Z, changed;
+
+		if (!ncol)
+			continue;
+
+		/* neighbour blocks facing the column */
+		switch (side)
+		{
+			case FACE_RIGHT: x0 = CLUSTER_SIZE_X-1; break;
+			case FACE_LEFT: x1 = 1; break;
+			case FACE_FRONT: z1 = 1; break;
+			default: z0 = CLUSTER_SIZE_Z-1; break;
+		}
+
+		changed = _update_columns_occlusion(map, ncol, &table, masks, x0, z0, x1, z1);
+		for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+		{
+			if (changed & (1 << cy))
+				_set_dirty(map, &ncol->cells[cy], DIRTY_FACES);
+		}
+	}
+
+	free(masks);
+
+	for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+		_clear_dirty(map, &col->cells[cy], DIRTY_OCCLUSION);
+	return 0;
+}
+
+/* Recompute the occlusion of blocks in a local box of a cell.
+ * Return true if the cell faces may have changed.
+ */
+static int _update_box_occlusion(PyMapObject *map, MapColumn *col, int cy, const BlockBox *box)
+{
+	MapCell *mc = &col->cells[cy];
+	const int x0 = col->cx * CLUSTER_SIZE_X;
+	const int y0 = cy * BLOCK_PER_CELL_Y;
+	const int z0 = col->cz * CLUSTER_SIZE_Z;
+	int x, y, z, changed = 0;
+
+	/* uniform and packed cells have no stored occlusion,
+	 * see _generate_uniform_cell_faces() and _generate_packed_cell_faces()
+	 */
+	if (!mc->data)
+		return !CELL_IS_UNIFORM(mc) || (mc->uniform_id != BID_AIR);
+
+	for (x = box->x0; x < box->x1; x++)
+	{
+		for (z = box->z0; z < box->z1; z++)
+		{
+			for (y = box->y0; y < box->y1; y++)
+			{
+				const uint8_t id = mc->data->ids[x][z][y];
+				PyMeshObject *mesh = map->meshes[id];
+				uint8_t occlusion;
+
+				if ((id == BID_AIR) || !mesh)
+					continue;
+
+				occlusion = _compute_block_occlusion(map, col, mesh, x0+x, y0+y, z0+z);
+				if (occlusion != mc->data->occlusion[x][z][y])
+				{
+					mc->data->occlusion[x][z][y] = occlusion;
+					changed = 1;
+				}
+			}
+		}
+	}
+
+	return changed;
+}
+
+/* Update the occlusion of changed blocks of a cell and of their neighbours,
+ * neighbour cells having a modified occlusion get dirty faces.
+ */
+static void _update_cell_occlusion(PyMapObject *map, MapColumn *col, int cy)
+{
+	MapCell *mc = &col->cells[cy];
+	const BlockBox *dirty = &mc->dirty_box;
+	BlockBox box;
+	int side;
+
+	/* changed blocks and their neighbours in the cell */
+	box.x0 = MAX(dirty->x0 - 1, 0);
+	box.y0 = MAX(dirty->y0 - 1, 0);
+	box.z0 = MAX(dirty->z0 - 1, 0);
+	box.x1 = MIN(dirty->x1 + 1, CLUSTER_SIZE_X);
+	box.y1 = MIN(dirty->y1 + 1, BLOCK_PER_CELL_Y);
+	box.z1 = MIN(dirty->z1 + 1, CLUSTER_SIZE_Z);
+	_update_box_occlusion(map, col, cy, &box);
+
+	/* blocks facing them in the neighbour cells */
+	for (side = 0; side < 6; side++)
+	{
+		MapColumn *ncol;
+		MapCell *neighbour;
+		int ncy;
+
+		box = *dirty;
+		switch (side)
+		{
+			case FACE_BOTTOM:
+				if (box.y0 > 0) continue;
+				box.y0 = BLOCK_PER_CELL_Y-1; box.y1 = BLOCK_PER_CELL_Y; break;
+			case FACE_TOP:
+				if (box.y1 < BLOCK_PER_CELL_Y) continue;
+				box.y0 = 0; box.y1 = 1; break;
+			case FACE_RIGHT:
+				if (box.x0 > 0) continue;
+				box.x0 = CLUSTER_SIZE_X-1; box.x1 = CLUSTER_SIZE_X; break;
+			case FACE_LEFT:
+				if (box.x1 < CLUSTER_SIZE_X) continue;
+				box.x0 = 0; box.x1 = 1; break;
+			case FACE_FRONT:
+				if (box.z1 < CLUSTER_SIZE_Z) continue;
+				box.z0 = 0; box.z1 = 1; break;
+			default:
+				if (box.z0 > 0) continue;
+				box.z0 = CLUSTER_SIZE_Z-1; box.z1 = CLUSTER_SIZE_Z; break;
+		}
+
+		neighbour = _get_neighbour_cell(map, col, cy, side, &ncol, &ncy);
+		if (neighbour && _update_box_occlusion(map, ncol, ncy, &box))
+			_set_dirty(map, neighbour, DIRTY_FACES);
+	}
+
+	_clear_dirty(map, mc, DIRTY_OCCLUSION);
+}
+
+/* Update the occlusion of dirty cells of a column.
+ * Return the number of updated cells.
+ */
+static int _update_dirty_occlusion(PyMapObject *map, MapColumn *col)
+{
+	int cy, count = 0;
+
+	if (map->occlusion_masks)
+	{
+		for (cy = 0; (cy < MAX_RENDER_CELLS) && _is_cell_wholly_dirty(&col->cells[cy]); cy++);
+		if ((cy == MAX_RENDER_CELLS) && !_update_column_occlusion(map, col))
+			return MAX_RENDER_CELLS;
+	}
+
+	for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+	{
+		if (col->cells[cy].dirty & DIRTY_OCCLUSION)
+		{
+			_update_cell_occlusion(map, col, cy);
+			count++;
+		}
+	}
+
+	return count;
+}
+
+/* do_occlusion([cx, cz]): update the occlusion of changed blocks and of
+ * their neighbours, or of all blocks of a given cluster.
+ * Return the number of updated cells.
+ */
+static PyObject * map_do_occlusion(PyMapObject *self, PyObject *args)
+{
+	const int forced = PyTuple_GET_SIZE(args) > 0;
+	MapColumn *col, *first, *last;
+	long count = 0;
+	int cy;
+
+	if (_parse_columns(self, args, &first, &last))
+		return NULL;
+
+	/* only dirty cells, or a whole column */
+	if (!forced && !self->dirty_count)
+		return PyInt_FromLong(0);
+
+	for (col = first; col != last; col = col->next)
+	{
+		if (forced)
+		{
+			for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+				_mark_cell_dirty(self, &col->cells[cy]);
+		}
+
+		count += _update_dirty_occlusion(self, col);
+	}
+
+	return PyInt_FromLong(count);
+}
+
+static void _add_block_faces(CellFaces *cf, PyMeshObject *mesh, uint8_t occlusion,
+							 int x, int y, int z, unsigned long *t2)
+{
+	RenderCell *rc;
+	int i;
+
+	if (mesh->flags.alpha)
+		rc = &cf->blend_faces;
+	else
+		rc = &cf->static_faces;
+
+	for (i=0; i < 6; i++)
+	{
+		if ((occlusion & (1<<i)) == 0)
+		{
+			if (_add_face(rc, mesh, i, x, y, z))
+				cf->nomem = 1;
+			(*t2)++;
+		}
+	}
+}
+
+/* Uniform cells: occlusion is computed on the fly.
+ * If the mesh hides itself, only the cell outer blocks may have visible faces.
+ */
+static void _generate_uniform_cell_faces(PyMapObject *map, MapColumn *col, MapCell *mc,
+										 CellFaces *cf, int x0, int y0, int z0,
+										 unsigned long *t1, unsigned long *t2)
+{
+	PyMeshObject *mesh = map->meshes[mc->uniform_id];
+	int x, y, z, i;
+
+	if ((mc->uniform_id == BID_AIR) || !mesh || (mesh->type != MESH_CUBE))
+		return;
+
+	*t1 += 6 * CLUSTER_SIZE_X * CLUSTER_SIZE_Z * BLOCK_PER_CELL_Y;
+
+	if (!_is_self_occluding(mesh))
+	{
+		for (x = 0; x < CLUSTER_SIZE_X; x++)
+		{
+			for (z = 0; z < CLUSTER_SIZE_Z; z++)
+			{
+				for (y = 0; y < BLOCK_PER_CELL_Y; y++)
+				{
+					const uint8_t occlusion = _compute_block_occlusion(map, col, mesh, x0+x, y0+y, z0+z);
+					_add_block_faces(cf, mesh, occlusion, x0+x, y0+y, z0+z, t2);
+				}
+			}
+		}
+		return;
+	}
+
+	RenderCell *rc = mesh->flags.alpha ? &cf->blend_faces : &cf->static_faces;
+
+	for (i = 0; i < 6; i++)
+	{
+		/* blocks on the cell side facing the face */
+		int u, v;
+		for (u = 0; u < 16; u++)
+		{
+			for (v = 0; v < 16; v++)
+			{
+				switch (i)
+				{
+					case FACE_BOTTOM: x = u; y = 0; z = v; break;
+					case FACE_TOP: x = u; y = BLOCK_PER_CELL_Y-1; z = v; break;
+					case FACE_RIGHT: x = 0; y = u; z = v; break;
+					case FACE_LEFT: x = CLUSTER_SIZE_X-1; y = u; z = v; break;
+					case FACE_FRONT: x = u; y = v; z = CLUSTER_SIZE_Z-1; break;
+					default: x = u; y = v; z = 0; break;
+				}
+
+				if (!_is_face_occluded(map, col, mesh, i, x0+x, y0+y, z0+z))
+				{
+					if (_add_face(rc, mesh, i, x0+x, y0+y, z0+z))
+						cf->nomem = 1;
+					(*t2)++;
+				}
+			}
+		}
+	}
+}
+
+/* Return the occlusion mask of a block from decoded ids of its cell.
+ * Neighbours inside the cell are read from ids.
+ */
+static uint8_t _compute_cell_block_occlusion(PyMapObject *map, MapColumn *col, PyMeshObject *mesh,
+											 uint8_t ids[CLUSTER_SIZE_X][CLUSTER_SIZE_Z][BLOCK_PER_CELL_Y],
+											 int x, int y, int z, int x0, int y0, int z0)
+{
+	uint8_t occlusion = 0;
+	int i;
+
+	for (i = 0; i < 6; i++)
+	{
+		const unsigned nx = x + face_offsets[i][0];
+		const unsigned ny = y + face_offsets[i][1];
+		const unsigned nz = z + face_offsets[i][2];
+		int occluded;
+
+		if ((nx < CLUSTER_SIZE_X) && (ny < BLOCK_PER_CELL_Y) && (nz < CLUSTER_SIZE_Z))
+			occluded = _is_occluded_by(map, mesh, i, ids[nx][nz][ny]);
+		else
+			occluded = _is_face_occluded(map, col, mesh, i, x0+x, y0+y, z0+z);
+		if (occluded)
+			occlusion |= 1 << i;
+	}
+
+	return occlusion;
+}
+
+/* Packed cells: ids are decoded once, occlusion is computed on the fly.
+ * Cells without any cube mesh in their palette are skipped.
+ */
+static void _generate_packed_cell_faces(PyMapObject *map, MapColumn *col, MapCell *mc,
+										CellFaces *cf, int x0, int y0, int z0,
+										unsigned long *t1, unsigned long *t2)
+{
+	const PackedCell *packed = mc->packed;
+	uint8_t ids[CLUSTER_SIZE_X][CLUSTER_SIZE_Z][BLOCK_PER_CELL_Y];
+	int x, y, z, i;
+
+	for (i = 0; i < packed->count; i++)
+	{
+		PyMeshObject *mesh = map->meshes[packed->palette[i]];
+		if ((packed->palette[i] != BID_AIR) && mesh && (mesh->type == MESH_CUBE))
+			break;
+	}
+	if (i == packed->count)
+		return;
+
+	_unpack_ids(packed, &ids[0][0][0]);
+
+	for (x = 0; x < CLUSTER_SIZE_X; x++)
+	{
+		for (z = 0; z < CLUSTER_SIZE_Z; z++)
+		{
+			for (y = 0; y < BLOCK_PER_CELL_Y; y++)
+			{
+				const uint8_t id = ids[x][z][y];
+				PyMeshObject *mesh = map->meshes[id];
+
+				if ((id == BID_AIR) || !mesh || (mesh->type != MESH_CUBE))
+					continue;
+
+				*t1 += 6;
+				_add_block_faces(cf, mesh, _compute_cell_block_occlusion(map, col, mesh, ids, x, y, z, x0, y0, z0),
+								 x0+x, y0+y, z0+z, t2);
+			}
+		}
+	}
+}
+
+/* Full cells: stored occlusion is used */
+static void _generate_full_cell_faces(PyMapObject *map, MapCell *mc, CellFaces *cf,
+									  int x0, int y0, int z0,
+									  unsigned long *t1, unsigned long *t2)
+{
+	int x, y, z;
+
+	for (x = 0; x < CLUSTER_SIZE_X; x++)
+	{
+		for (z = 0; z < CLUSTER_SIZE_Z; z++)
+		{
+			for (y = 0; y < BLOCK_PER_CELL_Y; y++)
+			{
+				const uint8_t id = mc->data->ids[x][z][y];
+				if (id == BID_AIR)
+					continue;
+
+				PyMeshObject *mesh = map->meshes[id];
+				if (mesh && (mesh->type == MESH_CUBE))
+				{
+					*t1 += 6;
+					_add_block_faces(cf, mesh, mc->data->occlusion[x][z][y], x0+x, y0+y, z0+z, t2);
+				}
+			}
+		}
+	}
+}
+
+/* Greedy meshing (Map.greedy).
+ * Visible faces of opaque cubes are merged per face direction and cell slice
+ * into rectangles of blocks using the same mesh. A tile of the terrain atlas
+ * can't be repeated over a merged face: merged faces use the per tile textures
+ * given to set_tile_textures() and are drawn tile by tile.
+ * Faces not covering exactly one tile aren't merged.
+ */
+
+/* In plane axes of faces, the third one is the face normal */
+static const int face_axes[6][2] = {
+	[FACE_BOTTOM] = {0, 2},
+	[FACE_TOP]    = {0, 2},
+	[FACE_RIGHT]  = {1, 2},
+	[FACE_LEFT]   = {1, 2},
+	[FACE_FRONT]  = {0, 1},
+	[FACE_REAR]   = {0, 1},
+};
+
+/* Cell size per axis, in blocks */
+static const int cell_size[3] = {CLUSTER_SIZE_X, BLOCK_PER_CELL_Y, CLUSTER_SIZE_Z};
+
+#define TILE_EPSILON 1e-3f
+
+/* Return the tile of the terrain atlas used by a face, -1 if none */
+static int _get_face_tile(PyMapObject *map, PyMeshObject *mesh, int fid)
+{
+	const FaceData *face = &mesh->faces[fid];
+	float s0, s1, t0, t1;
+	int i, c, r;
+
+	s0 = s1 = face->points[0].texels[0];
+	t0 = t1 = face->points[0].texels[1];
+	for (i = 1; i < 4; i++)
+	{
+		s0 = MIN(s0, face->points[i].texels[0]);
+		s1 = MAX(s1, face->points[i].texels[0]);
+		t0 = MIN(t0, face->points[i].texels[1]);
+		t1 = MAX(t1, face->points[i].texels[1]);
+	}
+
+	if ((fabsf((s1 - s0) * map->tile_columns - 1) > TILE_EPSILON) ||
+		(fabsf((t1 - t0) * map->tile_rows - 1) > TILE_EPSILON))
+		return -1;
+
+	c = floorf(s0 * map->tile_columns + TILE_EPSILON);
+	r = floorf(t0 * map->tile_rows + TILE_EPSILON);
+	if ((c < 0) || (c >= map->tile_columns) || (r < 0) || (r >= map->tile_rows))
+		return -1;
+
+	return r * map->tile_columns + c;
+}
+
+/* Add the face fid of a rectangle of blocks, from the block at pos and
+ * size[axis] blocks long per axis. Texels are the ones of the tile texture,
+ * repeated once per block.
+ */
+static int _add_merged_face(PyMapObject *map, RenderCell *cell, PyMeshObject *mesh, int fid,
+							int tile, const int pos[3], const int size[3])
+{
+	RenderFaceData *face = _alloc_face(cell);
+	const FaceData *mesh_face = &mesh->faces[fid];
+	const int u = face_axes[fid][0], v = face_axes[fid][1];
+	const float s0 = (float)(tile % map->tile_columns) / map->tile_columns;
+	const float t0 = (float)(tile / map->tile_columns) / map->tile_rows;
+	float base_light;
+	int i, k, edge, s_axis, t_axis;
+
+	if (!face)
+		return -1;
+
+	/* the first quad edge follows one axis: s changes along it or along the other one */
+	edge = (mesh_face->points[0].vertices[u] != mesh_face->points[1].vertices[u]) ? u : v;
+	if (fabsf(mesh_face->points[1].texels[0] - mesh_face->points[0].texels[0]) > TILE_EPSILON / map->tile_columns)
+		s_axis = edge;
+	else
+		s_axis = (edge == u) ? v : u;
+	t_axis = (s_axis == u) ? v : u;
+
+	base_light = _get_face_light(mesh, fid);
+
+	for (i = 0; i < 4; i++)
+	{
+		for (k = 0; k < 3; k++)
+		{
+			const GLfloat vertex = mesh_face->points[i].vertices[k];
+			face->points[i].vertices[k] = pos[k] + vertex + (vertex > 0 ? size[k] - 1 : 0);
+		}
+		face->points[i].texels[0] = (mesh_face->points[i].texels[0] - s0) * map->tile_columns * size[s_axis];
+		face->points[i].texels[1] = (mesh_face->points[i].texels[1] - t0) * map->tile_rows * size[t_axis];
+		face->points[i].colors[0] = base_light;
+		face->points[i].colors[1] = base_light;
+		face->points[i].colors[2] = base_light;
+		face->points[i].colors[3] = 1.;
+	}
+	return 0;
+}
+
+typedef struct TiledFace {
+	uint16_t tile;
+	uint16_t index;
+} TiledFace;
+
+static int _cmp_tiled_face(const void *a, const void *b)
+{
+	const TiledFace *fa = a, *fb = b;
+
+	if (fa->tile != fb->tile)
+		return fa->tile - fb->tile;
+	return fa->index - fb->index;
+}
+
+/* Sort merged faces of a cell by tile and set its tile runs */
+static int _sort_merged_faces(CellFaces *cf, TiledFace *tiled)
+{
+	RenderCell *rc = &cf->greedy_faces;
+	RenderFaceData *faces;
+	unsigned int i;
+
+	free(cf->tile_runs);
+	cf->tile_runs = NULL;
+	cf->run_count = 0;
+
+	if (!rc->count)
+		return 0;
+
+	faces = malloc(rc->count * sizeof(*faces));
+	if (!faces)
+		goto nomem;
+
+	qsort(tiled, rc->count, sizeof(*tiled), _cmp_tiled_face);
+
+	for (i = 0; i < rc->count; i++)
+	{
+		faces[i] = rc->faces[tiled[i].index];
+		if (!i || (tiled[i].tile != tiled[i-1].tile))
+			cf->run_count++;
+	}
+
+	cf->tile_runs = malloc(cf->run_count * sizeof(*cf->tile_runs));
+	if (!cf->tile_runs)
+	{
+		free(faces);
+		goto nomem;
+	}
+
+	cf->run_count = 0;
+	for (i = 0; i < rc->count; i++)
+	{
+		if (!i || (tiled[i].tile != tiled[i-1].tile))
+		{
+			cf->tile_runs[cf->run_count].tile = tiled[i].tile;
+			cf->tile_runs[cf->run_count++].count = 0;
+		}
+		cf->tile_runs[cf->run_count-1].count++;
+	}
+
+	free(rc->faces);
+	rc->faces = faces;
+	rc->allocated_faces = rc->count;
+	return 0;
+
+nomem:
+	/* drop merged faces rather than drawing them with wrong textures */
+	rc->count = 0;
+	cf->run_count = 0;
+	cf->nomem = 1;
+	return -1;
+}
+
+static void _generate_greedy_cell_faces(PyMapObject *map, MapColumn *col, MapCell *mc,
+										CellFaces *cf, int x0, int y0, int z0,
+										unsigned long *t1, unsigned long *t2)
+{
+	uint8_t unpacked[CLUSTER_SIZE_X][CLUSTER_SIZE_Z][BLOCK_PER_CELL_Y] = {{{0}}};
+	uint8_t (*ids)[CLUSTER_SIZE_Z][BLOCK_PER_CELL_Y] = unpacked;
+	uint8_t visible[CLUSTER_SIZE_X][CLUSTER_SIZE_Z][BLOCK_PER_CELL_Y];
+	PyMeshObject *mask[CLUSTER_SIZE_X*CLUSTER_SIZE_Z]; /* largest cell slice */
+	const int cell_origin[3] = {x0, y0, z0};
+	TiledFace *tiled;
+	int pos[3], origin[3], size[3], fid, x, y, z;
+
+	/* full cells ids are used in place */
+	if (mc->data)
+		ids = mc->data->ids;
+	else if (mc->packed)
+		_unpack_ids(mc->packed, &unpacked[0][0][0]);
+	else
+	{
+		PyMeshObject *mesh = map->meshes[mc->uniform_id];
+		if ((mc->uniform_id == BID_AIR) || !mesh || (mesh->type != MESH_CUBE))
+			return;
+		memset(unpacked, mc->uniform_id, sizeof(unpacked));
+	}
+
+	/* visible faces of opaque cubes, others are added as usual */
+	for (x = 0; x < CLUSTER_SIZE_X; x++)
+	{
+		for (z = 0; z < CLUSTER_SIZE_Z; z++)
+		{
+			for (y = 0; y < BLOCK_PER_CELL_Y; y++)
+			{
+				const uint8_t id = ids[x][z][y];
+				PyMeshObject *mesh = map->meshes[id];
+				uint8_t occlusion;
+
+				visible[x][z][y] = 0;
+				if ((id == BID_AIR) || !mesh || (mesh->type != MESH_CUBE))
+					continue;
+
+				if (mc->data)
+					occlusion = mc->data->occlusion[x][z][y];
+				else
+					occlusion = _compute_cell_block_occlusion(map, col, mesh, ids, x, y, z, x0, y0, z0);
+
+				*t1 += 6;
+				if (mesh->flags.alpha)
+					_add_block_faces(cf, mesh, occlusion, x0+x, y0+y, z0+z, t2);
+				else
+					visible[x][z][y] = ~occlusion & FULL_OCCLUSION;
+			}
+		}
+	}
+
+	/* one tile per merged face at most */
+	tiled = malloc(6 * CELL_BLOCKS * sizeof(*tiled));
+	if (!tiled)
+	{
+		cf->nomem = 1;
+		return;
+	}
+
+	for (fid = 0; fid < 6; fid++)
+	{
+		const int u = face_axes[fid][0], v = face_axes[fid][1], n = 3 - u - v;
+		int slice;
+
+		for (slice = 0; slice < cell_size[n]; slice++)
+		{
+			int a, b, w, h;
+
+			/* meshes of visible faces in the slice */
+			pos[n] = slice;
+			for (b = 0; b < cell_size[v]; b++)
+			{
+				pos[v] = b;
+				for (a = 0; a < cell_size[u]; a++)
+				{
+					pos[u] = a;
+					if (visible[pos[0]][pos[2]][pos[1]] & (1 << fid))
+						mask[b*cell_size[u] + a] = map->meshes[ids[pos[0]][pos[2]][pos[1]]];
+					else
+						mask[b*cell_size[u] + a] = NULL;
+				}
+			}
+
+			for (b = 0; b < cell_size[v]; b++)
+			{
+				for (a = 0; a < cell_size[u]; a++)
+				{
+					PyMeshObject *mesh = mask[b*cell_size[u] + a];
+					int tile, i, j;
+
+					if (!mesh)
+						continue;
+
+					/* largest rectangle from (a, b): along u first, then along v */
+					for (w = 1; (a + w < cell_size[u]) && (mask[b*cell_size[u] + a + w] == mesh); w++);
+					for (h = 1; b + h < cell_size[v]; h++)
+					{
+						for (i = 0; (i < w) && (mask[(b+h)*cell_size[u] + a + i] == mesh); i++);
+						if (i < w)
+							break;
+					}
+
+					for (j = 0; j < h; j++)
+					{
+						for (i = 0; i < w; i++)
+							mask[(b+j)*cell_size[u] + a + i] = NULL;
+					}
+
+					tile = _get_face_tile(map, mesh, fid);
+					if (tile < 0)
+					{
+						for (j = 0; j < h; j++)
+						{
+							for (i = 0; i < w; i++)
+							{
+								pos[u] = a + i;
+								pos[v] = b + j;
+								if (_add_face(&cf->static_faces, mesh, fid, x0+pos[0], y0+pos[1], z0+pos[2]))
+									cf->nomem = 1;
+								(*t2)++;
+							}
+						}
+						continue;
+					}
+
+					origin[u] = cell_origin[u] + a;
+					origin[v] = cell_origin[v] + b;
+					origin[n] = cell_origin[n] + slice;
+					size[u] = w;
+					size[v] = h;
+					size[n] = 1;
+					tiled[cf->greedy_faces.count].tile = tile;
+					tiled[cf->greedy_faces.count].index = cf->greedy_faces.count;
+					if (_add_merged_face(map, &cf->greedy_faces, mesh, fid, tile, origin, size))
+						cf->nomem = 1;
+					else
+						cf->merged += w * h;
+					(*t2)++;
+				}
+			}
+		}
+	}
+
+	_sort_merged_faces(cf, tiled);
+	free(tiled);
+}
+
+/* Build the faces of a cell into cf, its occlusion must be up to date.
+ * Python API is not used: called by meshing threads without the GIL.
+ */
+static void _generate_cell_faces(PyMapObject *map, MapColumn *col, int cy, CellFaces *cf,
+								 unsigned long *t1, unsigned long *t2)
+{
+	MapCell *mc = &col->cells[cy];
+	const int x0 = col->cx * CLUSTER_SIZE_X;
+	const int y0 = cy * BLOCK_PER_CELL_Y;
+	const int z0 = col->cz * CLUSTER_SIZE_Z;
+
+	if (map->greedy && map->tile_texids)
+		_generate_greedy_cell_faces(map, col, mc, cf, x0, y0, z0, t1, t2);
+	else if (mc->packed)
+		_generate_packed_cell_faces(map, col, mc, cf, x0, y0, z0, t1, t2);
+	else if (mc->data)
+		_generate_full_cell_faces(map, mc, cf, x0, y0, z0, t1, t2);
+	else
+		_generate_uniform_cell_faces(map, col, mc, cf, x0, y0, z0, t1, t2);
+}
+
+/* Lend the faces arrays of a cell to cf, to be filled again.
+ * Cell faces counts are kept for _set_cell_faces().
+ */
+static void _reuse_cell_faces(MapCell *mc, CellFaces *cf)
+{
+	memset(cf, 0, sizeof(*cf));
+	cf->static_faces = mc->static_faces;
+	cf->blend_faces = mc->blend_faces;
+	cf->greedy_faces = mc->greedy_faces;
+	cf->static_faces.count = 0;
+	cf->blend_faces.count = 0;
+	cf->greedy_faces.count = 0;
+
+	mc->static_faces.faces = NULL;
+	mc->static_faces.allocated_faces = 0;
+	mc->blend_faces.faces = NULL;
+	mc->blend_faces.allocated_faces = 0;
+	mc->greedy_faces.faces = NULL;
+	mc->greedy_faces.allocated_faces = 0;
+	free(mc->tile_runs);
+	mc->tile_runs = NULL;
+	mc->run_count = 0;
+}
+
+/* Replace the faces of a cell by the ones built in cf, freeing the old ones.
+ * Faces stay dirty and MemoryError is set if some of them are missing.
+ * Return the faces count difference.
+ */
+static long _set_cell_faces(PyMapObject *map, MapCell *mc, CellFaces *cf)
+{
+	const long old = mc->static_faces.count + mc->blend_faces.count + mc->greedy_faces.count;
+	long delta;
+
+	map->greedy_count -= mc->greedy_faces.count;
+	map->merged_count -= mc->merged;
+
+	free(mc->static_faces.faces);
+	free(mc->blend_faces.faces);
+	free(mc->greedy_faces.faces);
+	free(mc->tile_runs);
+	mc->static_faces = cf->static_faces;
+	mc->blend_faces = cf->blend_faces;
+	mc->greedy_faces = cf->greedy_faces;
+	mc->tile_runs = cf->tile_runs;
+	mc->run_count = cf->run_count;
+	mc->merged = cf->merged;
+
+	map->greedy_count += mc->greedy_faces.count;
+	map->merged_count += mc->merged;
+
+	if (cf->nomem)
+		PyErr_NoMemory();
+	else
+		_clear_dirty(map, mc, DIRTY_FACES);
+
+	delta = (long)(mc->static_faces.count + mc->blend_faces.count + mc->greedy_faces.count) - old;
+	map->face_count += delta;
+	return delta;
+}
+
+/* Replace the faces of a cell by new ones, after an occlusion update if needed.
+ * Return the faces count difference.
+ */
+static long _rebuild_cell(PyMapObject *map, MapColumn *col, int cy,
+						  unsigned long *t1, unsigned long *t2)
+{
+	MapCell *mc = &col->cells[cy];
+	CellFaces cf;
+
+	if (mc->dirty & DIRTY_OCCLUSION)
+		_update_cell_occlusion(map, col, cy);
+
+	/* faces arrays are kept allocated for the next faces */
+	_reuse_cell_faces(mc, &cf);
+	_generate_cell_faces(map, col, cy, &cf, t1, t2);
+	return _set_cell_faces(map, mc, &cf);
+}
+
+typedef struct DirtyCell {
+	MapColumn *col;
+	int cy;
+	int d2;
+} DirtyCell;
+
+static int _cmp_dirty_cell(const void *a, const void *b)
+{
+	return ((const DirtyCell *)a)->d2 - ((const DirtyCell *)b)->d2;
+}
+
+#ifndef __MORPHOS__
+
+/* Meshing threads.
+ * The main thread releases the GIL and builds a batch of cells with
+ * the pool threads, each cell into new CellFaces arrays. Cells keep their
+ * current faces, still drawable, until the batch is done and the GIL taken
+ * again: rendering never sees a half built cell. Blocks must not be changed
+ * meanwhile, callers keep the Map lock held by other Python threads
+ * (see model/map.py).
+ */
+
+typedef struct MeshJob {
+	MapColumn *col;
+	int cy;
+	CellFaces faces;
+	unsigned long t1, t2;
+} MeshJob;
+
+typedef struct MeshPool {
+	pthread_mutex_t lock;
+	pthread_cond_t work;				/* new batch or exit */
+	pthread_cond_t done;				/* batch done */
+	PyMapObject *map;
+	MeshJob *jobs;
+	unsigned int count;					/* jobs in the batch */
+	unsigned int next;					/* next job to take */
+	unsigned int pending;				/* jobs not done yet */
+	unsigned int batch;					/* batch number */
+	int exit;
+	int requested;						/* Map.mesh_threads when started */
+	int thread_count;					/* started threads, may be less */
+	pthread_t threads[MAX_MESH_THREADS];
+} MeshPool;
+
+/* Build jobs of the current batch until none is left, pool must be locked */
+static void _run_mesh_jobs(MeshPool *pool)
+{
+	while (pool->next < pool->count)
+	{
+		MeshJob *job = &pool->jobs[pool->next++];
+
+		pthread_mutex_unlock(&pool->lock);
+		_generate_cell_faces(pool->map, job->col, job->cy, &job->faces, &job->t1, &job->t2);
+		pthread_mutex_lock(&pool->lock);
+
+		if (!--pool->pending)
+			pthread_cond_signal(&pool->done);
+	}
+}
+
+static void * _mesh_thread(void *arg)
 {
-	PyObject_GC_UnTrack(self);
-    map_clear(self);
-    ((PyObject *)self)->ob_type->tp_free((PyObject *)self);
+	MeshPool *pool = arg;
+	unsigned int batch = 0;
+
+	pthread_mutex_lock(&pool->lock);
+	while (!pool->exit)
+	{
+		if (pool->batch != batch)
+		{
+			batch = pool->batch;
+			_run_mesh_jobs(pool);
+		}
+		else
+			pthread_cond_wait(&pool->work, &pool->lock);
+	}
+	pthread_mutex_unlock(&pool->lock);
+	return NULL;
 }
 
-static PyObject * map_clip_vector(PyMapObject *self, PyObject *args)
+static void _stop_mesh_pool(PyMapObject *map)
 {
-    float x, y, z; /* real vector, not block position */
-    //short bx, by, bz;
-
-    if (!PyArg_ParseTuple(args, "fff", &x, &y, &z))
-        return NULL;
+	MeshPool *pool = map->mesh_pool;
+	int i;
 
-    //bx = (int)(x + .5);
-    //by = (int)(y + .5);
-    //bz = (int)(z + .5);
+	if (!pool)
+		return;
 
-    return Py_BuildValue("fff", x, y, z);
+	pthread_mutex_lock(&pool->lock);
+	pool->exit = 1;
+	pthread_cond_broadcast(&pool->work);
+	pthread_mutex_unlock(&pool->lock);
+
+	Py_BEGIN_ALLOW_THREADS
+	for (i = 0; i < pool->thread_count; i++)
+		pthread_join(pool->threads[i], NULL);
+	Py_END_ALLOW_THREADS
+
+	pthread_cond_destroy(&pool->done);
+	pthread_cond_destroy(&pool->work);
+	pthread_mutex_destroy(&pool->lock);
+	free(pool);
+	map->mesh_pool = NULL;
 }
 
-static PyObject * map_has_mesh(PyMapObject *self, PyObject *args)
+/* Start the pool for Map.mesh_threads if needed.
+ * Return the pool, NULL if meshing is done by the main thread only.
+ */
+static MeshPool * _get_mesh_pool(PyMapObject *map)
 {
-    uint8_t idx;
-    PyMeshObject *mesh;
+	const int count = map->mesh_threads;
+	MeshPool *pool = map->mesh_pool;
 
-    if (!PyArg_ParseTuple(args, "B", &idx))
-        return NULL;
+	/* not restarted when some threads couldn't be created */
+	if (pool && (pool->requested == count))
+		return pool->thread_count ? pool : NULL;
 
-    mesh = self->meshes[idx];
-    if (mesh)
-        Py_RETURN_TRUE;
-    Py_RETURN_FALSE;
-}
+	_stop_mesh_pool(map);
+	if (!count)
+		return NULL;
 
-static PyObject * map_get_mesh(PyMapObject *self, PyObject *args)
-{
-    uint8_t idx;
-    PyMeshObject *mesh;
+	pool = calloc(1, sizeof(*pool));
+	if (!pool)
+		return NULL;
 
-    if (!PyArg_ParseTuple(args, "B", &idx))
-        return NULL;
+	pthread_mutex_init(&pool->lock, NULL);
+	pthread_cond_init(&pool->work, NULL);
+	pthread_cond_init(&pool->done, NULL);
+	pool->map = map;
+	pool->requested = count;
+	map->mesh_pool = pool;
 
-    mesh = self->meshes[idx];
-    if (mesh)
-    {
-        Py_INCREF(mesh);
-        return (PyObject *)mesh;
-    }
+	for (; pool->thread_count < count; pool->thread_count++)
+	{
+		if (pthread_create(&pool->threads[pool->thread_count], NULL, _mesh_thread, pool))
+			break;
+	}
 
-    Py_RETURN_NONE;
+	return pool->thread_count ? pool : NULL;
 }
 
-static PyObject * map_set_mesh(PyMapObject *self, PyObject *args)
+/* Build faces of cells with the pool threads, GIL released.
+ * Return 0 and add the faces count difference to delta, -1 on error.
+ */
+static int _rebuild_cells_threaded(PyMapObject *map, MeshPool *pool, DirtyCell *cells, int count,
+								   unsigned long *t1, unsigned long *t2, long *delta)
 {
-    uint8_t idx;
-    PyMeshObject *mesh;
+	MeshJob *jobs = calloc(count, sizeof(*jobs));
+	int i;
 
-    if (!PyArg_ParseTuple(args, "BO!", &idx, &PyMeshObject_Type, &mesh))
-        return NULL;
+	if (!jobs)
+	{
+		PyErr_NoMemory();
+		return -1;
+	}
 
-    Py_XDECREF(self->meshes[idx]);
-    self->meshes[idx] = mesh;
-    Py_INCREF(mesh);
+	/* jobs have new faces arrays, cells keep theirs until _set_cell_faces() */
+	for (i = 0; i < count; i++)
+	{
+		jobs[i].col = cells[i].col;
+		jobs[i].cy = cells[i].cy;
+	}
 
-    Py_RETURN_NONE;
+	Py_BEGIN_ALLOW_THREADS
+	pthread_mutex_lock(&pool->lock);
+	pool->jobs = jobs;
+	pool->count = pool->pending = count;
+	pool->next = 0;
+	pool->batch++;
+	pthread_cond_broadcast(&pool->work);
+
+	_run_mesh_jobs(pool);
+	while (pool->pending)
+		pthread_cond_wait(&pool->done, &pool->lock);
+
+	pool->jobs = NULL;
+	pool->count = 0;
+	pthread_mutex_unlock(&pool->lock);
+	Py_END_ALLOW_THREADS
+
+	for (i = 0; i < count; i++)
+	{
+		*delta += _set_cell_faces(map, &jobs[i].col->cells[jobs[i].cy], &jobs[i].faces);
+		*t1 += jobs[i].t1;
+		*t2 += jobs[i].t2;
+	}
+
+	free(jobs);
+	return PyErr_Occurred() ? -1 : 0;
 }
 
-static PyObject * map_get_blockid(PyMapObject *self, PyObject *args)
+#endif
+
+/* Rebuild the faces of cells, with meshing threads if any.
+ * Return 0 and add the faces count difference to delta, -1 on error.
+ */
+static int _rebuild_cells(PyMapObject *map, DirtyCell *cells, int count,
+						  unsigned long *t1, unsigned long *t2, long *delta)
 {
-    unsigned int x, y, z;
+	int i;
 
-    if (!PyArg_ParseTuple(args, "III", &x, &y, &z))
-        return NULL;
+	/* occlusion uses and sets neighbour cells: done before meshing */
+	for (i = 0; i < count; i++)
+	{
+		if (cells[i].col->cells[cells[i].cy].dirty & DIRTY_OCCLUSION)
+			_update_cell_occlusion(map, cells[i].col, cells[i].cy);
+	}
 
-	if (y >= BLOCK_COUNT_Y || z >= BLOCK_COUNT_Z || x >= BLOCK_COUNT_X)
-        return PyErr_Format(PyExc_ValueError, "coordinates out of world range");
+#ifndef __MORPHOS__
+	if (count > 1)
+	{
+		MeshPool *pool = _get_mesh_pool(map);
+
+		if (pool)
+			return _rebuild_cells_threaded(map, pool, cells, count, t1, t2, delta);
+	}
+#endif
+
+	for (i = 0; i < count; i++)
+		*delta += _rebuild_cell(map, cells[i].col, cells[i].cy, t1, t2);
 
-    return Py_BuildValue("B", MAP_BLOCK_ID(self->cells, x, y, z));
+	return PyErr_Occurred() ? -1 : 0;
 }
 
-static PyObject * map_set_blockid(PyMapObject *self, PyObject *args)
+static PyObject * map_generate_faces(PyMapObject *self, PyObject *args)
 {
-	unsigned char id;
-	unsigned int x, y, z;
+    unsigned long t1=0,t2=0;
+	MapColumn *col, *first, *last;
+	DirtyCell *cells;
+	long delta = 0;
+	int count = 0, cy, err;
 
-    if (!PyArg_ParseTuple(args, "BIII", &id, &x, &y, &z))
-        return NULL;
+	if (_parse_columns(self, args, &first, &last))
+		return NULL;
 
-   if (y >= BLOCK_COUNT_Y || z >= BLOCK_COUNT_Z || x >= BLOCK_COUNT_X)
-        return PyErr_Format(PyExc_ValueError, "coordinates out of world range");
+	for (col = first; col != last; col = col->next)
+		count += MAX_RENDER_CELLS;
 
-	MAP_BLOCK_ID(self->cells, x, y, z) = id;
-	Py_RETURN_NONE;
+	cells = malloc(MAX(count, 1) * sizeof(*cells));
+	if (!cells)
+		return PyErr_NoMemory();
+
+	/* Loop on window's block ids */
+	count = 0;
+	for (col = first; col != last; col = col->next)
+	{
+		for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+		{
+			cells[count].col = col;
+			cells[count++].cy = cy;
+		}
+	}
+
+	err = _rebuild_cells(self, cells, count, &t1, &t2, &delta);
+	free(cells);
+	if (err)
+		return NULL;
+
+	if (t1)
+	{
+		dprintf("faces=%lu/%lu (", t2, t1);
+		float r = (float)t2 / t1;
+		if (r < 0.1)
+			dprintf("< 0.1%%)\n");
+		else
+			dprintf("%.1f%%)\n", r);
+	}
+	else
+		dprintf("no faces!\n");
+
+	if (self->merged_count)
+		dprintf("greedy=%lu/%lu (%.1f%%)\n", self->greedy_count, self->merged_count,
+				100. * self->greedy_count / self->merged_count);
+
+    return PyLong_FromUnsignedLong(t2);
 }
 
-static PyObject * map_add_face(PyMapObject *self, PyObject *args)
+/* rebuild_cell(cx, cy, cz): regenerate the faces of one cell.
+ * Return the faces count difference.
+ */
+static PyObject * map_rebuild_cell(PyMapObject *self, PyObject *args)
 {
-    PyMeshObject *mesh;
-    unsigned char face_id;
-	unsigned int x, y, z;
+	unsigned long t1=0, t2=0;
+	MapColumn *col;
+	int cx, cy, cz;
+	long delta;
 
-    if (!PyArg_ParseTuple(args, "O!BIII", &PyMeshObject_Type, &mesh, &face_id,
-                          &x, &y, &z))
-        return NULL;
+	if (!PyArg_ParseTuple(args, "iii", &cx, &cy, &cz))
+		return NULL;
 
-	if (y >= BLOCK_COUNT_Y || z >= BLOCK_COUNT_Z || x >= BLOCK_COUNT_X)
-        return PyErr_Format(PyExc_ValueError, "coordinates out of world range");
+	if (cy < 0 || cy >= MAX_RENDER_CELLS)
+		return PyErr_Format(PyExc_ValueError, "cell coordinates out of world range");
 
-    //if (_add_face(self, mesh, face_id, x, y, z))
-	//	return NULL;
+	col = _get_column(self, cx, cz);
+	if (!col)
+		return PyErr_Format(PyExc_ValueError, "cluster (%d, %d) not loaded", cx, cz);
 
-	Py_RETURN_NONE;
+	delta = _rebuild_cell(self, col, cy, &t1, &t2);
+	if (PyErr_Occurred())
+		return NULL;
+
+	return PyInt_FromLong(delta);
 }
 
-static PyObject * map_add_blocks(PyMapObject *self, PyObject *args)
+/* rebuild_dirty(max_cells=-1): update the occlusion of all dirty cells, then
+ * regenerate the faces of at most max_cells cells (all if negative),
+ * nearest to the window center first.
+ * Return (rebuilt cells, faces count difference).
+ */
+static PyObject * map_rebuild_dirty(PyMapObject *self, PyObject *args)
 {
-    PyByteArrayObject *buffer;
-    uint8_t *data;
-    Py_ssize_t length;
-    unsigned int cx, cz, x, y, z;
+	unsigned long t1=0, t2=0;
+	int max_cells = -1, count = 0, cy, i;
+	long delta = 0;
+	DirtyCell *cells;
+	MapColumn *col;
 
-    if (!PyArg_ParseTuple(args, "O!II", &PyByteArray_Type, &buffer, &cx, &cz))
-        return NULL;
+	if (!PyArg_ParseTuple(args, "|i", &max_cells))
+		return NULL;
 
-    data = PyByteArray_AS_STRING(buffer);
+	if (!self->dirty_count)
+		return Py_BuildValue("ii", 0, 0);
 
-    if (cx >= WORLD_CLUSTER_X || cz >= WORLD_CLUSTER_Z)
-		return PyErr_Format(PyExc_ValueError, "coordinates out of world range");
+	/* occlusion first: neighbour cells may get dirty faces */
+	for (col = self->columns; col; col = col->next)
+		_update_dirty_occlusion(self, col);
 
-	for (x=0; x < CLUSTER_SIZE_X; x++)
+	cells = malloc(self->dirty_count * sizeof(*cells));
+	if (!cells)
+		return PyErr_NoMemory();
+
+	for (col = self->columns; col; col = col->next)
 	{
-		for (z=0; z < CLUSTER_SIZE_Z; z++)
+		const int dx = col->cx - self->center_cx;
+		const int dz = col->cz - self->center_cz;
+
+		for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
 		{
-			for (y=0; y < CLUSTER_SIZE_Y; y++, data++)
+			if (col->cells[cy].dirty & DIRTY_FACES)
 			{
-				const unsigned wx = cx*WORLD_CLUSTER_X + x;
-				const unsigned wz = cz*WORLD_CLUSTER_Z + z;
-				_set_block_id(self, *data, wx, y, wz);
+				cells[count].col = col;
+				cells[count].cy = cy;
+				cells[count].d2 = dx*dx + dz*dz;
+				count++;
 			}
 		}
 	}
 
-    Py_RETURN_NONE;
+	if ((max_cells >= 0) && (count > max_cells))
+	{
+		qsort(cells, count, sizeof(*cells), _cmp_dirty_cell);
+		count = max_cells;
+	}
+
+	i = _rebuild_cells(self, cells, count, &t1, &t2, &delta);
+	free(cells);
+	if (i)
+		return NULL;
+
+	return Py_BuildValue("il", count, delta);
 }
 
-static PyObject * map_do_occlusion(PyMapObject *self, PyObject *args)
+/* Mark faces of all loaded cells as outdated */
+static void _mark_all_faces_dirty(PyMapObject *map)
 {
-    unsigned int x, y, z;
+	MapColumn *col;
+	int cy;
 
-	for (x=0; x < BLOCK_COUNT_X; x++)
+	for (col = map->columns; col; col = col->next)
 	{
-		for (z=0; z < BLOCK_COUNT_Z; z++)
-		{
-			for (y=0; y < BLOCK_COUNT_Y; y++)
-			{
-				BlockInfo *bi = &MAP_BLOCK_INFO(self->cells, x, y, z);
-				if (bi->id != BID_AIR)
-					_do_block_occlusion(self, bi, x, y, z);
-			}
-		}
+		for (cy = 0; cy < MAX_RENDER_CELLS; cy++)
+			_set_dirty(map, &col->cells[cy], DIRTY_FACES);
 	}
-
-    Py_RETURN_NONE;
 }
 
-static PyObject * map_generate_faces(PyMapObject *self, PyObject *args)
+/* set_tile_textures(columns, rows, texids): textures of the terrain atlas
+ * tiles, columns*rows ids starting from the tile at texels (0, 0).
+ * Required by greedy meshing. Faces of loaded cells are made dirty.
+ */
+static PyObject * map_set_tile_textures(PyMapObject *self, PyObject *args)
 {
-    unsigned x=0, y=0, z=0;
-    unsigned long t1=0,t2=0;
+	PyObject *texids, *seq;
+	GLuint *tile_texids;
+	int columns, rows, i;
 
-	/* Loop on world's block ids */
-	for (x = 0; x < BLOCK_COUNT_X; x++)
-	{
-		for (z = 0; z < BLOCK_COUNT_Z; z++)
-		{
-			for (y = 0; y < BLOCK_COUNT_Y; y++)
-			{
-				MapCell *mc = &MAP_CELL(self->cells, x, y, z);
-				BlockInfo *bi = &mc->blocks_info[x&15][z&15][y&15];
-				if (bi->id == BID_AIR)
-					continue;
+	if (!PyArg_ParseTuple(args, "iiO", &columns, &rows, &texids))
+		return NULL;
 
-				PyMeshObject *mesh = self->meshes[bi->id];
-				if (mesh && (mesh->type == MESH_CUBE))
-				{
-					RenderCell *rc;
+	if ((columns <= 0) || (rows <= 0) || (columns * rows > UINT16_MAX))
+		return PyErr_Format(PyExc_ValueError, "invalid tiles count");
 
-					if (mesh->flags.alpha)
-						rc = &mc->blend_faces;
-					else
-						rc = &mc->static_faces;
+	seq = PySequence_Fast(texids, "texids must be a sequence");
+	if (!seq)
+		return NULL;
 
-					t1 += 6;
-					int i;
-					for (i=0; i < 6; i++)
-					{
-						if ((bi->occlusion & (1<<i)) == 0)
-						{ _add_face(rc, mesh, i, x, y, z); t2++; }
-					}
-				}
-			}
+	if (PySequence_Fast_GET_SIZE(seq) != columns * rows)
+	{
+		Py_DECREF(seq);
+		return PyErr_Format(PyExc_ValueError, "%d textures expected", columns * rows);
+	}
+
+	tile_texids = malloc(columns * rows * sizeof(*tile_texids));
+	if (!tile_texids)
+	{
+		Py_DECREF(seq);
+		return PyErr_NoMemory();
+	}
+
+	for (i = 0; i < columns * rows; i++)
+	{
+		tile_texids[i] = PyInt_AsLong(PySequence_Fast_GET_ITEM(seq, i));
+		if (PyErr_Occurred())
+		{
+			free(tile_texids);
+			Py_DECREF(seq);
+			return NULL;
 		}
 	}
+	Py_DECREF(seq);
 
-	if (t1)
+	free(self->tile_texids);
+	self->tile_texids = tile_texids;
+	self->tile_columns = columns;
+	self->tile_rows = rows;
+
+	_mark_all_faces_dirty(self);
+	Py_RETURN_NONE;
+}
+
+static size_t _render_greedy_cell(PyMapObject *map, MapCell *cell, PyCameraObject *camera,
+								  size_t rendered_faces)
+{
+	RenderFaceData *faces = cell->greedy_faces.faces;
+	size_t total = 0;
+	unsigned int i;
+
+	for (i = 0; i < cell->run_count; i++)
 	{
-		dprintf("faces=%lu/%lu (", t2, t1);
-		float r = (float)t2 / t1;
-		if (r < 0.1)
-			dprintf("< 0.1%%)\n");
-		else
-			dprintf("%.1f%%)\n", r);
+		const TileRun *run = &cell->tile_runs[i];
+		RenderCell rc = {faces: faces, count: run->count};
+
+		glBindTexture(GL_TEXTURE_2D, map->tile_texids[run->tile]);
+		total += _render_cell(&rc, camera, rendered_faces + total);
+		faces += run->count;
 	}
-	else
-		dprintf("no faces!\n");
 
-    return PyLong_FromUnsignedLong(t2);
+	return total;
 }
 
 static PyObject * map_render(PyMapObject *self, PyObject *args)
@@ -1230,34 +4633,59 @@ static PyObject * map_render(PyMapObject *self, PyObject *args)
     _enable_faces_render_states();
     _use_texture(terrain_tex_id);
 
-    /* Loop on all map's cell */
+    /* Loop on all window's cells */
     int i;
-    MapCell *cell = &self->cells[0][0][0];
+    MapColumn *col;
 
 #if 1
 	/* draw solid static faces */
-    for (i = 0; i < WORLD_CLUSTER_X*WORLD_CLUSTER_Z*MAX_RENDER_CELLS; i++, cell++)
+    for (col = self->columns; col; col = col->next)
     {
-		if (!cell->static_faces.count)
-			continue;
+		for (i = 0; i < MAX_RENDER_CELLS; i++)
+		{
+			MapCell *cell = &col->cells[i];
+
+			if (!cell->static_faces.count && !cell->greedy_faces.count)
+				continue;
 
-		if (camera->dirty)
-			cell->render = _is_point3D_renderable(cell->bsphere.x, cell->bsphere.y, cell->bsphere.z, camera);
+			if (camera->dirty)
+				cell->render = _is_point3D_renderable(cell->bsphere.x, cell->bsphere.y, cell->bsphere.z, camera);
 
-		if (cell->render)
-			total_faces += _render_cell(&cell->static_faces, camera, total_faces);
+			if (cell->render && cell->static_faces.count)
+				total_faces += _render_cell(&cell->static_faces, camera, total_faces);
+		}
     }
 
+	/* draw merged faces, tile textures are used */
+	if (terrain_tex_id >= 0 && self->greedy_count)
+	{
+		for (col = self->columns; col; col = col->next)
+		{
+			for (i = 0; i < MAX_RENDER_CELLS; i++)
+			{
+				MapCell *cell = &col->cells[i];
+
+				if (cell->greedy_faces.count && cell->render)
+					total_faces += _render_greedy_cell(self, cell, camera, total_faces);
+			}
+		}
+		_use_texture(terrain_tex_id);
+	}
+
 	/* draw translucent faces */
 	_enable_blend_faces_render();
-	cell = &self->cells[0][0][0];
-    for (i = 0; i < WORLD_CLUSTER_X*WORLD_CLUSTER_Z*MAX_RENDER_CELLS; i++, cell++)
+    for (col = self->columns; col; col = col->next)
     {
-		if (!cell->blend_faces.count)
-			continue;
+		for (i = 0; i < MAX_RENDER_CELLS; i++)
+		{
+			MapCell *cell = &col->cells[i];
+
+			if (!cell->blend_faces.count)
+				continue;
 
-		if (cell->render)
-			total_faces += _render_cell(&cell->blend_faces, camera, total_faces);
+			if (cell->render)
+				total_faces += _render_cell(&cell->blend_faces, camera, total_faces);
+		}
     }
 	_disable_blend_faces_render();
 #endif
@@ -1288,8 +4716,24 @@ static struct PyMethodDef map_methods[] = {
     {"clip_vector", (PyCFunction)map_clip_vector, METH_VARARGS, NULL},
 	{"add_face", (PyCFunction)map_add_face, METH_VARARGS, NULL},
 	{"add_blocks", (PyCFunction)map_add_blocks, METH_VARARGS, NULL},
-	{"generate_faces", (PyCFunction)map_generate_faces, METH_NOARGS, NULL},
-	{"do_occlusion", (PyCFunction)map_do_occlusion, METH_NOARGS, NULL},
+	{"get_blockdata", (PyCFunction)map_get_blockdata, METH_VARARGS, NULL},
+	{"generate_faces", (PyCFunction)map_generate_faces, METH_VARARGS, NULL},
+	{"do_occlusion", (PyCFunction)map_do_occlusion, METH_VARARGS, NULL},
+	{"rebuild_cell", (PyCFunction)map_rebuild_cell, METH_VARARGS, NULL},
+	{"rebuild_dirty", (PyCFunction)map_rebuild_dirty, METH_VARARGS, NULL},
+	{"set_tile_textures", (PyCFunction)map_set_tile_textures, METH_VARARGS, NULL},
+	{"recenter", (PyCFunction)map_recenter, METH_VARARGS, NULL},
+	{"get_cell_buffer", (PyCFunction)map_get_cell_buffer, METH_VARARGS, NULL},
+	{"fill", (PyCFunction)map_fill, METH_VARARGS, NULL},
+	{"replace", (PyCFunction)map_replace, METH_VARARGS, NULL},
+	{"copy", (PyCFunction)map_copy, METH_VARARGS, NULL},
+	{"paste", (PyCFunction)map_paste, METH_VARARGS, NULL},
+	{"has_cluster", (PyCFunction)map_has_cluster, METH_VARARGS, NULL},
+	{"in_window", (PyCFunction)map_in_window, METH_VARARGS, NULL},
+	{"pack_cells", (PyCFunction)map_pack_cells, METH_NOARGS, NULL},
+	{"storage_stats", (PyCFunction)map_storage_stats, METH_NOARGS, NULL},
+	{"save_snapshot", (PyCFunction)map_save_snapshot, METH_VARARGS, NULL},
+	{"load_snapshot", (PyCFunction)map_load_snapshot, METH_VARARGS, NULL},
     {NULL} /* sentinel */
 };
 
@@ -1300,6 +4744,84 @@ static PyMemberDef map_members[] = {
     {"drawn_clusters", T_UINT, offsetof(PyMapObject, stats.drawn_items), RO, NULL},
     {"drawn_faces", T_UINT, offsetof(PyMapObject, stats.drawn_subitems), RO, NULL},
     {"fog_enabled", T_UBYTE, offsetof(PyMapObject, fog_enabled), 0, NULL},
+    {"center_cx", T_INT, offsetof(PyMapObject, center_cx), RO, NULL},
+    {"center_cz", T_INT, offsetof(PyMapObject, center_cz), RO, NULL},
+    {"cluster_count", T_UINT, offsetof(PyMapObject, column_count), RO, NULL},
+    {"dirty_cells", T_UINT, offsetof(PyMapObject, dirty_count), RO, NULL},
+    {"face_count", T_ULONG, offsetof(PyMapObject, face_count), RO, NULL},
+    {"compact", T_UBYTE, offsetof(PyMapObject, compact), 0, NULL},
+    {"occlusion_masks", T_UBYTE, offsetof(PyMapObject, occlusion_masks), 0, NULL},
+    {"greedy_faces", T_ULONG, offsetof(PyMapObject, greedy_count), RO, NULL},
+    {"merged_faces", T_ULONG, offsetof(PyMapObject, merged_count), RO, NULL},
+    {NULL} /* sentinel */
+};
+
+static PyObject * map_get_greedy(PyMapObject *self, void *enclosure)
+{
+	return PyBool_FromLong(self->greedy);
+}
+
+static int map_set_greedy(PyMapObject *self, PyObject *value, void *enclosure)
+{
+	int res;
+
+	if (!value)
+	{
+		PyErr_SetString(PyExc_TypeError, "can't delete greedy attribute");
+		return -1;
+	}
+
+	res = PyObject_IsTrue(value);
+	if (res < 0)
+		return -1;
+
+	if (res != self->greedy)
+	{
+		self->greedy = res;
+		_mark_all_faces_dirty(self);
+	}
+	return 0;
+}
+
+static PyObject * map_get_mesh_threads(PyMapObject *self, void *enclosure)
+{
+	return PyInt_FromLong(self->mesh_threads);
+}
+
+static int map_set_mesh_threads(PyMapObject *self, PyObject *value, void *enclosure)
+{
+	long count;
+
+	if (!value)
+	{
+		PyErr_SetString(PyExc_TypeError, "can't delete mesh_threads attribute");
+		return -1;
+	}
+
+	count = PyInt_AsLong(value);
+	if ((count == -1) && PyErr_Occurred())
+		return -1;
+
+	if ((count < 0) || (count > MAX_MESH_THREADS))
+	{
+		PyErr_Format(PyExc_ValueError, "mesh_threads must be in [0, %d]", MAX_MESH_THREADS);
+		return -1;
+	}
+
+	/* the pool is restarted by the next rebuild */
+	self->mesh_threads = count;
+	return 0;
+}
+
+static PyObject * map_get_tile_count(PyMapObject *self, void *enclosure)
+{
+	return PyInt_FromLong(self->tile_columns * self->tile_rows);
+}
+
+static PyGetSetDef map_getseters[] = {
+    {"tile_count", (getter)map_get_tile_count, NULL, "number of tile textures set by set_tile_textures()", NULL},
+    {"greedy", (getter)map_get_greedy, (setter)map_set_greedy, "True to merge coplanar cube faces, faces of loaded cells become dirty on change", NULL},
+    {"mesh_threads", (getter)map_get_mesh_threads, (setter)map_set_mesh_threads, "number of meshing threads besides the main one, 0 to mesh in the main thread only", NULL},
     {NULL} /* sentinel */
 };
 
@@ -1317,6 +4839,79 @@ static PyTypeObject PyMapObject_Type = {
     tp_clear        : (inquiry)map_clear,
     tp_methods      : map_methods,
     tp_members      : map_members,
+    tp_getset       : map_getseters,
+};
+
+/*==== PyCellBufferObject ====================================================*/
+
+static void cellbuffer_dealloc(PyCellBufferObject *self)
+{
+	_cell_data_decref(self->data);
+	PyObject_Del(self);
+}
+
+static Py_ssize_t cellbuffer_length(PyCellBufferObject *self)
+{
+	return self->len;
+}
+
+static Py_ssize_t cellbuffer_getreadbuf(PyCellBufferObject *self, Py_ssize_t index,
+										const void **ptr)
+{
+	if (index != 0)
+	{
+		PyErr_SetString(PyExc_SystemError, "accessing non-existent buffer segment");
+		return -1;
+	}
+
+	*ptr = self->buf;
+	return self->len;
+}
+
+static Py_ssize_t cellbuffer_getsegcount(PyCellBufferObject *self, Py_ssize_t *lenp)
+{
+	if (lenp)
+		*lenp = self->len;
+	return 1;
+}
+
+static int cellbuffer_getbuffer(PyCellBufferObject *self, Py_buffer *view, int flags)
+{
+	return PyBuffer_FillInfo(view, (PyObject *)self, self->buf, self->len, 0, flags);
+}
+
+static PySequenceMethods cellbuffer_as_sequence = {
+	sq_length       : (lenfunc)cellbuffer_length,
+};
+
+static PyBufferProcs cellbuffer_as_buffer = {
+	bf_getreadbuffer  : (readbufferproc)cellbuffer_getreadbuf,
+	bf_getwritebuffer : (writebufferproc)cellbuffer_getreadbuf,
+	bf_getsegcount    : (segcountproc)cellbuffer_getsegcount,
+	bf_getcharbuffer  : (charbufferproc)cellbuffer_getreadbuf,
+	bf_getbuffer      : (getbufferproc)cellbuffer_getbuffer,
+};
+
+static PyMemberDef cellbuffer_members[] = {
+	{"cx", T_INT, offsetof(PyCellBufferObject, cx), RO, NULL},
+	{"cy", T_INT, offsetof(PyCellBufferObject, cy), RO, NULL},
+	{"cz", T_INT, offsetof(PyCellBufferObject, cz), RO, NULL},
+	{"layer", T_INT, offsetof(PyCellBufferObject, layer), RO, NULL},
+	{NULL} /* sentinel */
+};
+
+static PyTypeObject PyCellBufferObject_Type = {
+	PyObject_HEAD_INIT(NULL)
+
+	tp_name         : "lowlevel.CellBuffer",
+	tp_basicsize    : sizeof(PyCellBufferObject),
+	tp_flags        : Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER,
+	tp_doc          : "Data layer of a map cell, in X.Z.Y order",
+
+	tp_dealloc      : (destructor)cellbuffer_dealloc,
+	tp_as_sequence  : &cellbuffer_as_sequence,
+	tp_as_buffer    : &cellbuffer_as_buffer,
+	tp_members      : cellbuffer_members,
 };
 
 /*==== PyCameraObject ========================================================*/
@@ -1554,12 +5149,14 @@ initlowlevel(void)
         error |= PyType_Ready(&PyMeshObject_Type);
         error |= PyType_Ready(&PyCameraObject_Type);
         error |= PyType_Ready(&PyMapObject_Type);
+        error |= PyType_Ready(&PyCellBufferObject_Type);
 
         if (!error)
         {
             ADD_TYPE(m, "Mesh", &PyMeshObject_Type);
             ADD_TYPE(m, "Camera", &PyCameraObject_Type);
             ADD_TYPE(m, "Map", &PyMapObject_Type);
+            ADD_TYPE(m, "CellBuffer", &PyCellBufferObject_Type);
 
             INSI(m, "MESH_EMPTY", MESH_EMPTY);
             INSI(m, "MESH_CUBE", MESH_CUBE);
@@ -1573,6 +5170,19 @@ initlowlevel(void)
             INSI(m, "MESH_PANE", MESH_PANE);
             INSI(m, "MESH_STICKY", MESH_STICKY);
             INSI(m, "MESH_LEVER", MESH_LEVER);
+
+            INSI(m, "WORLD_CLUSTER_X", WORLD_CLUSTER_X);
+            INSI(m, "WORLD_CLUSTER_Z", WORLD_CLUSTER_Z);
+            INSI(m, "CLUSTER_SIZE_X", CLUSTER_SIZE_X);
+            INSI(m, "CLUSTER_SIZE_Y", CLUSTER_SIZE_Y);
+            INSI(m, "CLUSTER_SIZE_Z", CLUSTER_SIZE_Z);
+            INSI(m, "MAX_RENDER_CELLS", MAX_RENDER_CELLS);
+            INSI(m, "BLOCK_PER_CELL_Y", BLOCK_PER_CELL_Y);
+
+            INSI(m, "LAYER_IDS", LAYER_IDS);
+            INSI(m, "LAYER_DATA", LAYER_DATA);
+            INSI(m, "LAYER_SKYLIGHT", LAYER_SKYLIGHT);
+            INSI(m, "LAYER_BLOCKLIGHT", LAYER_BLOCKLIGHT);
         }
     }
 }
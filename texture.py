@@ -33,10 +33,13 @@ class GLTexture:
         self.load_and_bind(filename, self.texid, **k)
 
     def load_and_bind(self, filename, texid=0, sky=False, tile=False, mipmap=False):
-        "load and bind an opengl texture"
+        "load and bind an opengl texture, from a file or a pygame surface"
 
-        print "Set texture#%d from file '%s'" % (texid, filename)
-        imgsurf = pygame.image.load(filename)
+        if isinstance(filename, pygame.Surface):
+            imgsurf = filename
+        else:
+            print "Set texture#%d from file '%s'" % (texid, filename)
+            imgsurf = pygame.image.load(filename)
         imgstring = pygame.image.tostring(imgsurf, "RGBA", 1)
         self.width, self.height = imgsurf.get_size()
         glBindTexture(GL_TEXTURE_2D, texid)
@@ -66,3 +69,18 @@ class GLTexture:
     def cleanup(self):
         if self.texid is not None:
             glDeleteTextures(self.texid)
+
+def load_tile_textures(filename, ts, **k):
+    """Split a textures atlas of ts*ts texels tiles into one GLTexture per tile.
+
+    Return (columns, rows, textures), tiles are ordered as texture
+    coordinates, from the bottom left one.
+    """
+
+    atlas = pygame.image.load(filename)
+    width, height = atlas.get_size()
+    columns = width / ts
+    rows = height / ts
+    textures = [ GLTexture(atlas.subsurface((c*ts, height-(r+1)*ts, ts, ts)), **k)
+                 for r in xrange(rows) for c in xrange(columns) ]
+    return columns, rows, textures
@@ -14,6 +14,7 @@ gui_text = """Game fps: %3.1f
 Rendering time: %u ms
 Camena Far: %u
 Rendered faces: %u (%u/s)
+Greedy faces: %u for %u (%.1f%%)
 Camera: (%.3f, %.3f, %.3f), (%.3f, %.3f, %.3f)"""
 
 class GameScreen(screen.Screen):
@@ -64,6 +65,8 @@ class GameScreen(screen.Screen):
                 cam_pos = camera.position
                 cam_dir = camera.direction
                 camera.setup(self.flat)
+                if map.greedy and not map.tile_count:
+                    map.set_tile_textures(*entity.Mesh.get_tile_textures())
                 #gl.draw_sky(camera.position, camera.direction)
 
                 hit_node = map.render(camera, texid)
@@ -98,8 +101,13 @@ class GameScreen(screen.Screen):
                     gl.draw_rect(0, height-25*7-5, width-1, 25*7+5)
 
                     gl.set_color_rgb(1,1,1)
+                    if map.merged_faces:
+                        ratio = 100. * map.greedy_faces / map.merged_faces
+                    else:
+                        ratio = 100.
                     gl.text(0, height-20, gui_text % ((clock.get_fps(), map.rendering_time*1000, camera.far,
-                            map.drawn_faces, self.r_faces_per_sec) + cam_pos + cam_dir))
+                            map.drawn_faces, self.r_faces_per_sec,
+                            map.greedy_faces, map.merged_faces, ratio) + cam_pos + cam_dir))
                 else:
                     gl.set_color_rgba(0,0,0,.5)
                     GL.glRectf(0, 0, width-1, 20)